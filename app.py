@@ -1,32 +1,70 @@
 # app.py
 from fastapi                 import FastAPI, HTTPException, UploadFile, File, Form, Depends, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses       import FileResponse, JSONResponse
+from fastapi.responses       import FileResponse, JSONResponse, Response
+from fastapi.encoders        import jsonable_encoder
 from fastapi.staticfiles     import StaticFiles
 from sqlalchemy.orm          import Session, selectinload 
 from typing                  import List, Optional, Dict, Any, Tuple 
-from models                  import Site, BrandStyling, StyleAsset, StyleAssetVariant, Base, engine, SessionLocal, BrandLog as DBBrandLog
-from utils                   import generate_css, parse_css_variables, save_local_backup # Import save_local_backup
+from models                  import Site, BrandStyling, StyleAsset, StyleAssetVariant, Base, engine, SessionLocal, BrandLog as DBBrandLog, upgrade_schema
+from utils                   import parse_css_variables, save_local_backup, bump_revision, write_file_atomic # Import save_local_backup
+from utils                   import get_descendant_ids, get_ancestors_with_depth, get_descendants_with_depth
+from tokens                  import inheritance_key, pick_winner, token_models
+from utils                   import is_descendant_or_self, subtree_ids_query, add_to_inheritance_closure, move_in_inheritance_closure, remove_from_inheritance_closure, rebuild_inheritance_closure
+from cache                   import css_cache, CachedArtifact
+from builds                  import (build_scheduler, compile_css, compile_minified_css, compile_partial_css, partial_css_key,
+                                    compile_css_bundle, css_bundle_key, invalidate_styling_artifacts, publishes_minified,
+                                    prebuild_all, css_flights, CSS_BUILD_MODES, CSS_BUNDLE_SCOPES, CSS_BUNDLE_FORMATS)
+from uploads                 import save_image_upload, UploadSizeLimitMiddleware, MULTIPART_OVERHEAD, IMAGE_EXTENSIONS
+from blobs                   import blob_path_for_name, release_files, sweep_unreferenced_blobs
+from compression             import negotiate_encoding, JSONResponseGZipMiddleware
+from docs                    import compile_docs
+from exports                 import compile_export, save_export
+from images                  import derivative_pipeline
+from email.utils             import format_datetime, parsedate_to_datetime
+from urllib.parse            import quote
 from config                  import settings, CONTAINER_ASSET_DIR_ABS # Import settings and the absolute asset dir
-from collections             import defaultdict
 from sqlalchemy.orm          import selectinload
 
 import schemas       as schemas # Import the old schemas
 import os
 import shutil
 import json
-import uuid
 import re                                  # Import re for robust name formatting
 import datetime                            # Import datetime for backups
 
 import pathlib
+import anyio.to_thread
 
 
+def prepare_database():
+    """
+    Create missing tables/columns, re-derive the inheritance closure table from
+    master_brand_id and drop uploaded blobs that no asset references any more.
+    """
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema()
+    with SessionLocal() as closure_db:
+        rebuild_inheritance_closure(closure_db)
+        sweep_unreferenced_blobs(closure_db)
+
 # Create the database tables
-Base.metadata.create_all(bind=engine)
+prepare_database()
 
 app = FastAPI(title=settings.APP_NAME) # Use app name from settings
 
+# Route handlers are plain `def` functions because they use the synchronous SQLAlchemy
+# session and file I/O; Starlette runs them in a worker thread pool so a slow request
+# never blocks the event loop. The pool size bounds how many run concurrently.
+@app.on_event("startup")
+def limit_worker_threads():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.WORKER_THREADS
+
+@app.on_event("shutdown")
+def stop_build_scheduler():
+    build_scheduler.shutdown()
+    derivative_pipeline.shutdown()
+
 BACKUP_DIR = pathlib.Path("data/backup")
 BACKUP_DIR.mkdir(exist_ok=True)
 DB_FILE_PATH = pathlib.Path(settings.DB_URL.replace("sqlite:///", ""))
@@ -43,6 +81,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Abort oversized uploads while they stream in, before they are spooled to disk
+app.add_middleware(UploadSizeLimitMiddleware, max_body_size=settings.UPLOAD_SIZE_LIMIT + MULTIPART_OVERHEAD)
+
+# Compress large JSON responses built per request (cached artifacts are precompressed)
+app.add_middleware(JSONResponseGZipMiddleware, minimum_size=settings.COMPRESSION_MIN_SIZE, compresslevel=6)
+
 # Dependency to get the database session
 def get_db():
     db = SessionLocal()
@@ -80,6 +124,15 @@ os.makedirs("public", exist_ok=True)
 
 
 
+# Blobs are immutable (the name is the content hash), so clients may cache them forever
+BLOB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+BLOB_MEDIA_TYPES = {extension: media_type for media_type, extension in IMAGE_EXTENSIONS.items()}
+
+def get_blob_url(request: Request, file_name: str) -> str:
+    """Full URL of an uploaded blob, served by the /blobs route with immutable caching."""
+    base_url = settings.BASE_URL or str(request.base_url)
+    return f"{base_url.rstrip('/')}/blobs/{file_name}"
+
 # Helper function to generate the full asset URL
 def get_asset_url(request: Request, styling_id: int, file_name: str) -> str:
     """Generates the full URL for an asset file, ensuring correct static path."""
@@ -119,6 +172,44 @@ def get_asset_url(request: Request, styling_id: int, file_name: str) -> str:
 
     return full_url
 
+def is_not_modified(request: Request, artifact: CachedArtifact) -> bool:
+    """Evaluate If-None-Match (preferred) or If-Modified-Since against an artifact."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match uses weak comparison, so ignore any W/ prefix
+        candidates = [tag.strip() for tag in if_none_match.split(",")]
+        candidates = [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+        etags = {artifact.encoded_etag(encoding) for encoding in (None, *artifact.encodings)}
+        return "*" in candidates or not etags.isdisjoint(candidates)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and artifact.last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        last_modified = artifact.last_modified.replace(microsecond=0, tzinfo=datetime.timezone.utc)
+        return last_modified <= since
+    return False
+
+def artifact_response(request: Request, artifact: CachedArtifact, extra_headers: Optional[dict] = None) -> Response:
+    """
+    Return the artifact, or 304 Not Modified if the client's copy is current.
+    The body is the precompressed variant that best matches Accept-Encoding, if any.
+    """
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"), artifact.encodings)
+    headers = {"ETag": artifact.encoded_etag(encoding), **(extra_headers or {})}
+    if artifact.encodings:
+        headers["Vary"] = "Accept-Encoding"
+    if artifact.last_modified is not None:
+        headers["Last-Modified"] = format_datetime(artifact.last_modified.replace(tzinfo=datetime.timezone.utc), usegmt=True)
+    if is_not_modified(request, artifact):
+        return Response(status_code=304, headers=headers)
+    if encoding is None:
+        return Response(content=artifact.body, media_type=artifact.media_type, headers=headers)
+    headers["Content-Encoding"] = encoding
+    return Response(content=artifact.encodings[encoding], media_type=artifact.media_type, headers=headers)
+
 # Helper function to format asset name robustly
 def format_asset_name(name: str) -> str:
     """Formats a raw asset name into a valid CSS variable name (--variable-name)."""
@@ -186,6 +277,8 @@ def create_site(site: schemas.SiteCreate, db: Session = Depends(get_db), api_key
         site_id=db_site.id
     )
     db.add(default_styling)
+    db.flush()
+    add_to_inheritance_closure(default_styling.id, None, db)
     db.commit()
     db.refresh(default_styling)
     
@@ -235,10 +328,11 @@ def create_site(site: schemas.SiteCreate, db: Session = Depends(get_db), api_key
         )
         db.add(asset)
     
+    bump_revision(default_styling.id, db)
     db.commit()
     
-    # Generate initial CSS file with the preset dimensions
-    generate_css(default_styling.id, db)
+    # Queue the initial CSS build with the preset dimensions
+    build_scheduler.schedule([default_styling.id])
 
     return db_site
 
@@ -265,6 +359,10 @@ def update_site(site_id: int, site: schemas.SiteUpdate, db: Session = Depends(ge
 
     db.commit()
     db.refresh(db_site)
+
+    # The docs pages embed the site name
+    for (styling_id,) in db.query(BrandStyling.id).filter(BrandStyling.site_id == site_id).all():
+        invalidate_styling_artifacts(styling_id, db)
     return db_site
 
 @app.delete("/sites/{site_id}")
@@ -287,8 +385,21 @@ def delete_site(site_id: int, db: Session = Depends(get_db), api_key: str = Depe
     if os.path.exists(site_dir):
         shutil.rmtree(site_dir)
 
+    # Sub-brands outside the deleted set (e.g. on other sites) still need a rebuild
+    deleted_ids = {styling.id for styling in brand_stylings}
+    orphaned_ids = {
+        styling.id: [i for i in get_descendant_ids(styling.id, db) if i not in deleted_ids]
+        for styling in brand_stylings
+    }
+    for styling in brand_stylings:
+        remove_from_inheritance_closure(styling.id, db)
+    released_file_paths = [row.file_path for row in db.query(StyleAsset.file_path).filter(StyleAsset.brand_styling_id.in_(deleted_ids))]
+
     db.delete(db_site)
     db.commit()
+    release_files(released_file_paths, db)
+    for styling in brand_stylings:
+        invalidate_styling_artifacts(styling.id, db, descendant_ids=orphaned_ids[styling.id])
     return {"message": "Site deleted successfully"}
 
 @app.post("/sites/{site_id}/brand-stylings/", response_model=schemas.BrandStyling)
@@ -304,15 +415,12 @@ def create_brand_styling(site_id: int, styling: schemas.BrandStylingCreate, db:
         if master_brand is None:
             raise HTTPException(status_code=404, detail="Master brand styling not found")
 
-        # Prevent circular inheritance (a brand can't inherit from itself or from its descendants)
-        if styling.master_brand_id == styling.id:
-            raise HTTPException(status_code=400, detail="A brand cannot inherit from itself")
-
-        # For updates, we would need to check if this would create a circular reference
-        # But for creation, this isn't an issue since the styling doesn't exist yet
+        # A brand-new styling has no descendants yet, so it cannot create a cycle
 
     db_styling = BrandStyling(**styling.dict(), site_id=site_id)
     db.add(db_styling)
+    db.flush()
+    add_to_inheritance_closure(db_styling.id, db_styling.master_brand_id, db)
     db.commit()
     db.refresh(db_styling)
 
@@ -367,10 +475,11 @@ def create_brand_styling(site_id: int, styling: schemas.BrandStylingCreate, db:
             )
             db.add(asset)
 
+    bump_revision(db_styling.id, db)
     db.commit() # Commit after adding assets
 
-    # Generate initial CSS file with the new assets
-    generate_css(db_styling.id, db)
+    # Queues the initial CSS build; the master brands' inheritance listings now include this styling
+    invalidate_styling_artifacts(db_styling.id, db)
 
     return db_styling
 
@@ -389,6 +498,14 @@ def get_brand_styling(styling_id: int, db: Session = Depends(get_db), api_key: s
         raise HTTPException(status_code=404, detail="Brand styling not found")
     return db_styling
 
+@app.get("/brand-stylings/{styling_id}/revision", response_model=schemas.BrandStylingRevision)
+def get_brand_styling_revision(styling_id: int, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+    """Cheap change detection: returns only the revision counter, without loading any assets."""
+    row = db.query(BrandStyling.id, BrandStyling.revision, BrandStyling.updated_at).filter(BrandStyling.id == styling_id).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+    return {"id": row.id, "revision": row.revision, "updated_at": row.updated_at}
+
 @app.put("/brand-stylings/{styling_id}", response_model=schemas.BrandStyling)
 def update_brand_styling(
     styling_id: int,
@@ -413,27 +530,20 @@ def update_brand_styling(
         
         # Check if the new master would create a circular inheritance chain
         # (e.g., A inherits from B, and now B wants to inherit from A)
-        def check_circular_inheritance(brand_id, target_id):
-            """Recursively check if setting target_id as master would create a circular reference"""
-            brand = db.query(BrandStyling).filter(BrandStyling.id == brand_id).first()
-            if not brand or brand.master_brand_id is None:
-                return False
-            if brand.master_brand_id == target_id:
-                return True
-            return check_circular_inheritance(brand.master_brand_id, target_id)
-        
-        if check_circular_inheritance(styling.master_brand_id, styling_id):
+        if is_descendant_or_self(styling.master_brand_id, styling_id, db):
             raise HTTPException(status_code=400, detail="Circular inheritance detected")
 
     update_data = styling.dict(exclude_unset=True)
+    if "master_brand_id" in update_data and update_data["master_brand_id"] != db_styling.master_brand_id:
+        move_in_inheritance_closure(styling_id, update_data["master_brand_id"], db)
     for key, value in update_data.items():
         setattr(db_styling, key, value)
 
+    bump_revision(styling_id, db)
     db.commit()
     db.refresh(db_styling)
 
-    # Regenerate CSS
-    generate_css(styling_id, db)
+    invalidate_styling_artifacts(styling_id, db) # Queues the CSS rebuild
 
     return db_styling
 
@@ -449,27 +559,11 @@ def get_available_master_brands(
     if db_styling is None:
         raise HTTPException(status_code=404, detail="Brand styling not found")
     
-    # Get all stylings from the same site
-    site_stylings = db.query(BrandStyling).filter(BrandStyling.site_id == db_styling.site_id).all()
-    
-    # Find all sub-brands of the current styling (recursively)
-    sub_brand_ids = set()
-    
-    def collect_sub_brands(brand_id):
-        subs = db.query(BrandStyling).filter(BrandStyling.master_brand_id == brand_id).all()
-        for sub in subs:
-            sub_brand_ids.add(sub.id)
-            collect_sub_brands(sub.id)
-    
-    collect_sub_brands(styling_id)
-    
-    # Filter out the current styling and its sub-brands
-    available_masters = [
-        styling for styling in site_stylings 
-        if styling.id != styling_id and styling.id not in sub_brand_ids
-    ]
-    
-    return available_masters
+    # All stylings from the same site, minus the current styling and its sub-brands (at any depth)
+    return db.query(BrandStyling).filter(
+        BrandStyling.site_id == db_styling.site_id,
+        BrandStyling.id.not_in(subtree_ids_query(styling_id))
+    ).all()
 
 @app.get("/brand-stylings/{styling_id}/inheritance-chain", response_model=List[schemas.BrandStyling])
 def get_inheritance_chain(
@@ -478,27 +572,15 @@ def get_inheritance_chain(
     api_key: str = Depends(get_api_key)
 ):
     """Get the inheritance chain for a brand styling (current → master → master's master → etc.)"""
-    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if db_styling is None:
+    # The chain from the current styling up to the root master, nearest first
+    inheritance_chain = [styling for styling, _ in get_ancestors_with_depth(styling_id, db)]
+    if not inheritance_chain:
         raise HTTPException(status_code=404, detail="Brand styling not found")
-    
-    inheritance_chain = []
-    current = db_styling
-    
-    # Build the chain from the current styling up to the root master
-    while current:
-        inheritance_chain.append(current)
-        if current.master_brand_id is None:
-            break
-        current = db.query(BrandStyling).filter(BrandStyling.id == current.master_brand_id).first()
-        # Prevent infinite loops (shouldn't happen with our validation, but just in case)
-        if current and current.id in [s.id for s in inheritance_chain]:
-            break
-    
+
     return inheritance_chain
 
 @app.post("/brand-stylings/{styling_id}/sync", response_model=dict)
-async def sync_styling_from_css(
+def sync_styling_from_css(
     styling_id: int,
     css_content: str = Form(...),
     parsed_data: Optional[str] = Form(None),
@@ -570,18 +652,17 @@ async def sync_styling_from_css(
             raise HTTPException(status_code=400, detail="Invalid JSON data")
     
     # Save CSS file
-    css_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id))
-    os.makedirs(css_dir, exist_ok=True)
-    css_path = os.path.join(css_dir, "style.css")
+    css_path = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id), "style.css")
     
     try:
-        with open(css_path, "w") as f:
-            f.write(css_content)
+        write_file_atomic(css_path, css_content)
     except Exception as e:
         print(f"Error saving CSS file: {e}")
     
     # Commit changes
+    bump_revision(styling_id, db)
     db.commit()
+    invalidate_styling_artifacts(styling_id, db)
     
     return {
         "message": "CSS and database synchronized successfully",
@@ -628,12 +709,19 @@ def delete_brand_styling(styling_id: int, db: Session = Depends(get_db), api_key
     if os.path.exists(styling_dir):
         shutil.rmtree(styling_dir)
 
+    # Sub-brands lose the chain above this styling and need a rebuild
+    sub_brand_ids = get_descendant_ids(styling_id, db)
+    remove_from_inheritance_closure(styling_id, db)
+    released_file_paths = [row.file_path for row in db.query(StyleAsset.file_path).filter(StyleAsset.brand_styling_id == styling_id)]
+
     db.delete(db_styling)
     db.commit()
+    release_files(released_file_paths, db)
+    invalidate_styling_artifacts(styling_id, db, descendant_ids=sub_brand_ids)
     return {"message": "Brand styling deleted successfully"}
 
 @app.post("/brand-stylings/{styling_id}/assets/", response_model=schemas.StyleAsset) # Or schemas.StyleAssetWithInheritance if you prefer
-async def create_style_asset(
+def create_style_asset(
     styling_id: int,
     request: Request,
     asset_type: str = Form(...),
@@ -655,6 +743,7 @@ async def create_style_asset(
     db_asset_value_to_save = value
     db_asset_selector_to_save = selector_str 
     final_file_path = None
+    stored = None
 
     # Handle NEW "css_declaration" type
     if asset_type == "css_declaration":
@@ -710,19 +799,10 @@ async def create_style_asset(
 
         if asset_type == "image":
             if file:
-                if file.content_type not in settings.ALLOWED_IMAGE_TYPES:
-                    raise HTTPException(status_code=400, detail=f"Invalid image file type: {file.content_type}. Allowed types: {', '.join(settings.ALLOWED_IMAGE_TYPES)}")
-                file_extension = os.path.splitext(file.filename)[1]
-                unique_file_name = f"{uuid.uuid4()}{file_extension}"
-                relative_file_dir_in_assets = os.path.join("brands", str(styling_id), "images")
-                full_file_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, relative_file_dir_in_assets)
-                os.makedirs(full_file_dir, exist_ok=True)
-                full_file_path_on_disk = os.path.join(full_file_dir, unique_file_name)
-                try:
-                    with open(full_file_path_on_disk, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-                except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to save image file: {str(e)}")
-                db_asset_value_to_save = get_asset_url(request, styling_id, unique_file_name)
-                final_file_path = os.path.join(relative_file_dir_in_assets, unique_file_name).replace('\\', '/')
+                # Streams, size-checks and type-sniffs the upload before it lands in the images dir
+                stored = save_image_upload(file)
+                db_asset_value_to_save = get_blob_url(request, stored.file_name)
+                final_file_path = stored.relative_path
             elif value: 
                 db_asset_value_to_save = value
             else:
@@ -755,17 +835,20 @@ async def create_style_asset(
         is_important=is_important if is_important is not None else False, # Ensure boolean
         group_name=group_name
     )
+    if stored is not None:
+        set_image_metadata(db_asset, stored)
     db.add(db_asset)
+    bump_revision(styling_id, db)
     db.commit()
     db.refresh(db_asset)
-
-    generate_css(styling_id, db) # Regenerate CSS after adding asset
+    invalidate_styling_artifacts(styling_id, db) # Queues the CSS rebuild
+    derivative_pipeline.submit(db_asset.id, db_asset.file_path) # Resized/WebP copies, generated in the background
     
     # Return using the base StyleAsset schema; StyleAssetWithInheritance needs more context
     return db_asset
 
 @app.put("/brand-stylings/{styling_id}/assets/{asset_id}", response_model=schemas.StyleAsset)
-async def update_style_asset_in_styling(
+def update_style_asset_in_styling(
     styling_id: int,
     asset_id: int,
     request: Request,
@@ -791,6 +874,7 @@ async def update_style_asset_in_styling(
         raise HTTPException(status_code=404, detail="Style asset not found for this styling")
 
     updated_fields = False
+    released_file_path = None # Uploaded file to drop once the change is committed
 
     # Handle updates for "css_declaration" type
     if db_asset.type == "css_declaration":
@@ -861,38 +945,24 @@ async def update_style_asset_in_styling(
         
         if db_asset.type == "image":
             if file: # If a new file is uploaded
-                if file.content_type not in settings.ALLOWED_IMAGE_TYPES:
-                    raise HTTPException(status_code=400, detail=f"Invalid image file type.")
-                # Delete old file if it exists
-                if db_asset.file_path:
-                    full_old_file_path = os.path.join(CONTAINER_ASSET_DIR_ABS, db_asset.file_path)
-                    if os.path.exists(full_old_file_path): 
-                        try: os.remove(full_old_file_path)
-                        except OSError as e: print(f"Error deleting old file {full_old_file_path}: {e}")
-                
-                # Save new file
-                file_extension = os.path.splitext(file.filename)[1]
-                unique_file_name = f"{uuid.uuid4()}{file_extension}"
-                relative_file_dir_in_assets = os.path.join("brands", str(styling_id), "images")
-                full_file_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, relative_file_dir_in_assets)
-                os.makedirs(full_file_dir, exist_ok=True)
-                full_file_path_on_disk = os.path.join(full_file_dir, unique_file_name)
-                try:
-                    with open(full_file_path_on_disk, "wb") as buffer: shutil.copyfileobj(file.file, buffer)
-                except Exception as e: 
-                    raise HTTPException(status_code=500, detail="Failed to save updated image file.")
-                db_asset.file_path = os.path.join(relative_file_dir_in_assets, unique_file_name).replace('\\', '/')
-                db_asset.value = get_asset_url(request, styling_id, unique_file_name)
+                # Save the new file first, so a rejected upload leaves the current one in place
+                stored = save_image_upload(file)
+
+                # The old file is removed after the commit, once nothing references it
+                released_file_path = db_asset.file_path
+                db_asset.file_path = stored.relative_path
+                db_asset.value = get_blob_url(request, stored.file_name)
+                db_asset.derivatives = [] # Regenerated for the new file after the commit
+                set_image_metadata(db_asset, stored)
                 updated_fields = True
             elif value is not None and value != db_asset.value: # If image URL is updated directly
                  db_asset.value = value
-                 # If it previously had a local file and is now a URL, remove the old local file
+                 # If it previously had a local file and is now a URL, release the old local file
                  if db_asset.file_path:
-                    full_old_file_path = os.path.join(CONTAINER_ASSET_DIR_ABS, db_asset.file_path)
-                    if os.path.exists(full_old_file_path): 
-                        try: os.remove(full_old_file_path)
-                        except OSError as e: print(f"Error deleting old file {full_old_file_path}: {e}")
+                    released_file_path = db_asset.file_path
                     db_asset.file_path = None
+                    db_asset.derivatives = []
+                    set_image_metadata(db_asset, None)
                  updated_fields = True
         elif value is not None and value != db_asset.value: # Value for other non-image, non-css_declaration assets
             db_asset.value = value
@@ -910,9 +980,13 @@ async def update_style_asset_in_styling(
         updated_fields = True
 
     if updated_fields:
+        bump_revision(styling_id, db)
         db.commit()
         db.refresh(db_asset)
-        generate_css(styling_id, db) # Regenerate CSS only if changes were made
+        release_files([released_file_path], db)
+        invalidate_styling_artifacts(styling_id, db) # Queue a CSS rebuild only if changes were made
+        if file and db_asset.type == "image":
+            derivative_pipeline.submit(db_asset.id, db_asset.file_path)
     
     return db_asset
 
@@ -931,38 +1005,273 @@ def delete_style_asset_from_styling(styling_id: int, asset_id: int, db: Session
     if db_asset is None:
         raise HTTPException(status_code=404, detail="Style asset not found for this styling")
 
-    # Delete file if exists using CONTAINER_ASSET_DIR_ABS (absolute path)
-    if db_asset.file_path:
-        full_file_path = os.path.join(CONTAINER_ASSET_DIR_ABS, db_asset.file_path)
-        if os.path.exists(full_file_path):
-            os.remove(full_file_path)
+    released_file_path = db_asset.file_path
 
     db.delete(db_asset)
+    bump_revision(styling_id, db)
     db.commit()
-
-    # Regenerate CSS
-    generate_css(styling_id, db)
+    release_files([released_file_path], db) # Shared blobs stay while other assets use them
+    invalidate_styling_artifacts(styling_id, db) # Queues the CSS rebuild
 
     return {"message": "Style asset deleted successfully"}
 
+# Default UI group for new CSS variables, by asset type
+VARIABLE_TYPE_GROUPS = {"color": "Colors", "image": "Images", "font": "Typography", "dimension": "Dimensions"}
+
+def asset_uniqueness_key(asset_type: str, name: str, selector: Optional[str]) -> tuple:
+    """The scope in which an asset name must be unique within a styling (see create_style_asset)."""
+    if asset_type == "css_declaration":
+        return ("decl", selector, name)
+    if asset_type == "class_rule":
+        return ("class_rule", name)
+    return ("var", name)
+
+@app.post("/brand-stylings/{styling_id}/assets:batch", response_model=schemas.StyleAssetBatchResponse)
+def batch_mutate_style_assets(
+    styling_id: int,
+    batch: schemas.StyleAssetBatchRequest,
+    db: Session = Depends(get_db),
+    api_key: str = Depends(get_api_key)
+):
+    """
+    Apply many asset create/update/delete operations (including variants) in one transaction.
+    Operations are validated in order against the styling's assets as they would be after the
+    preceding operations. If any operation is invalid nothing is written and the per-operation
+    results are returned in the error detail. A successful batch triggers exactly one CSS rebuild.
+    """
+    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
+    if db_styling is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+
+    # One query for the whole styling; every duplicate check below runs against these maps
+    existing_assets = db.query(StyleAsset).options(selectinload(StyleAsset.variants)).filter(StyleAsset.brand_styling_id == styling_id).all()
+    assets_by_id = {asset.id: asset for asset in existing_assets}
+    taken_keys = {asset_uniqueness_key(asset.type, asset.name, asset.selector): asset.id for asset in existing_assets}
+
+    results: List[Dict[str, Any]] = []
+    pending_changes: Dict[int, Dict[str, Any]] = {} # asset_id -> field changes
+    variant_upserts: Dict[int, Dict[str, schemas.StyleAssetVariantCreate]] = {} # asset_id -> breakpoint -> variant
+    variant_deletes: Dict[int, set] = {} # asset_id -> breakpoints
+    to_create: List[Tuple[int, StyleAsset, List[schemas.StyleAssetVariantCreate]]] = []
+    to_delete: set = set()
+    has_errors = False
+
+    def current(asset: StyleAsset, field: str):
+        return pending_changes.get(asset.id, {}).get(field, getattr(asset, field))
+
+    for index, op in enumerate(batch.operations):
+        result: Dict[str, Any] = {"index": index, "op": op.op, "status": "ok", "id": op.id}
+        try:
+            if op.op == "create":
+                asset_type = op.asset_type
+                if not asset_type:
+                    raise ValueError("'asset_type' is required to create an asset.")
+                group_name = op.group_name
+                if asset_type == "css_declaration":
+                    if not op.selector or not op.selector.strip():
+                        raise ValueError("CSS declarations require a 'selector'.")
+                    if not op.name or not op.name.strip():
+                        raise ValueError("CSS declarations require a property 'name'.")
+                    name, selector = op.name.strip(), op.selector.strip()
+                    value = op.value if op.value is not None else ""
+                    group_name = group_name or "General Rules"
+                elif asset_type == "class_rule":
+                    if not op.name or not op.name.strip():
+                        raise ValueError("Legacy 'class_rule' needs a 'name' (which is the selector).")
+                    if op.value is None:
+                        raise ValueError("Legacy 'class_rule' needs a 'value' (which is the rule string).")
+                    name = selector = op.name.strip()
+                    value = op.value.strip()
+                    group_name = group_name or "Legacy Class Rules"
+                else:
+                    name = format_asset_name(op.name or "")
+                    if not name or name == "--":
+                        raise ValueError("Invalid asset name for CSS variable.")
+                    if op.value is None:
+                        raise ValueError("Value is required for this asset type (file uploads are not supported in batches).")
+                    selector, value = None, op.value
+                    group_name = group_name or VARIABLE_TYPE_GROUPS.get(asset_type, "General Variables")
+
+                key = asset_uniqueness_key(asset_type, name, selector)
+                if key in taken_keys:
+                    raise ValueError(f"An asset named '{name}' already exists" + (f" for selector '{selector}'." if selector else "."))
+                breakpoints = [v.breakpoint for v in op.variants]
+                if len(breakpoints) != len(set(breakpoints)):
+                    raise ValueError("Duplicate variant breakpoints.")
+
+                taken_keys[key] = None # Reserved for an asset created by this batch
+                new_asset = StyleAsset(
+                    brand_styling_id=styling_id, name=name, type=asset_type, value=value, selector=selector,
+                    description=op.description, is_important=bool(op.is_important), group_name=group_name
+                )
+                to_create.append((index, new_asset, op.variants))
+                result["name"] = name
+
+            elif op.op in ("update", "delete"):
+                asset = assets_by_id.get(op.id) if op.id is not None else None
+                if asset is None or asset.id in to_delete:
+                    raise ValueError(f"Style asset {op.id} not found for this styling.")
+                old_key = asset_uniqueness_key(asset.type, current(asset, "name"), current(asset, "selector"))
+
+                if op.op == "delete":
+                    to_delete.add(asset.id)
+                    pending_changes.pop(asset.id, None)
+                    variant_upserts.pop(asset.id, None)
+                    variant_deletes.pop(asset.id, None)
+                    if taken_keys.get(old_key) == asset.id:
+                        del taken_keys[old_key]
+                    result["name"] = asset.name
+                else:
+                    changes: Dict[str, Any] = {}
+                    if asset.type == "css_declaration":
+                        if op.name is not None: changes["name"] = op.name.strip()
+                        if op.selector is not None: changes["selector"] = op.selector.strip()
+                        if op.value is not None: changes["value"] = op.value.strip()
+                    elif asset.type == "class_rule":
+                        if op.name is not None: changes["name"] = changes["selector"] = op.name.strip()
+                        if op.value is not None: changes["value"] = op.value.strip()
+                    else:
+                        if op.name is not None:
+                            changes["name"] = format_asset_name(op.name)
+                            if not changes["name"] or changes["name"] == "--":
+                                raise ValueError("Invalid asset name provided.")
+                        if op.value is not None:
+                            changes["value"] = op.value
+                            if asset.type == "image" and op.value != current(asset, "value") and current(asset, "file_path"):
+                                changes["file_path"] = None # Switched from an uploaded file to a URL
+                    if op.description is not None: changes["description"] = op.description
+                    if op.is_important is not None: changes["is_important"] = op.is_important
+                    if op.group_name is not None: changes["group_name"] = op.group_name.strip()
+                    changes = {field: val for field, val in changes.items() if val != current(asset, field)}
+
+                    new_key = asset_uniqueness_key(asset.type, changes.get("name", current(asset, "name")), changes.get("selector", current(asset, "selector")))
+                    if new_key != old_key:
+                        if new_key in taken_keys and taken_keys[new_key] != asset.id:
+                            raise ValueError(f"An asset named '{new_key[-1]}' already exists in this scope.")
+                        if taken_keys.get(old_key) == asset.id:
+                            del taken_keys[old_key]
+                        taken_keys[new_key] = asset.id
+
+                    existing_breakpoints = {v.breakpoint for v in asset.variants} - variant_deletes.get(asset.id, set())
+                    existing_breakpoints |= set(variant_upserts.get(asset.id, {}))
+                    missing = [bp for bp in op.delete_variants if bp not in existing_breakpoints]
+                    if missing:
+                        raise ValueError(f"No variant for breakpoint(s) {', '.join(missing)}.")
+
+                    pending_changes.setdefault(asset.id, {}).update(changes)
+                    for bp in op.delete_variants:
+                        variant_upserts.get(asset.id, {}).pop(bp, None)
+                        variant_deletes.setdefault(asset.id, set()).add(bp)
+                    for variant in op.variants:
+                        variant_upserts.setdefault(asset.id, {})[variant.breakpoint] = variant
+                        variant_deletes.get(asset.id, set()).discard(variant.breakpoint)
+                    if not (changes or op.variants or op.delete_variants):
+                        result["status"] = "unchanged"
+                    result["name"] = changes.get("name", current(asset, "name"))
+            else:
+                raise ValueError(f"Unknown operation '{op.op}'. Use 'create', 'update' or 'delete'.")
+        except ValueError as e:
+            result["status"] = "error"
+            result["detail"] = str(e)
+            has_errors = True
+        results.append(result)
+
+    if has_errors:
+        for result in results:
+            if result["status"] != "error":
+                result["status"] = "skipped"
+        raise HTTPException(status_code=400, detail={"message": "Batch rejected; no operations were applied.", "results": results})
+
+    removed_files = []
+
+    # Deletes: set-based, variants first since SQLite does not enforce the FK cascade
+    if to_delete:
+        delete_ids = list(to_delete)
+        removed_files.extend(assets_by_id[asset_id].file_path for asset_id in delete_ids if assets_by_id[asset_id].file_path)
+        db.query(StyleAssetVariant).filter(StyleAssetVariant.asset_id.in_(delete_ids)).delete(synchronize_session=False)
+        db.query(StyleAsset).filter(StyleAsset.id.in_(delete_ids)).delete(synchronize_session=False)
+        for asset_id in delete_ids:
+            db.expunge(assets_by_id[asset_id])
+
+    # Updates and variant changes on already-loaded assets
+    for asset_id, changes in pending_changes.items():
+        asset = assets_by_id[asset_id]
+        if "file_path" in changes and asset.file_path:
+            removed_files.append(asset.file_path)
+            asset.derivatives = []
+            set_image_metadata(asset, None)
+        for field, val in changes.items():
+            setattr(asset, field, val)
+    removed_variant_count = 0
+    for asset_id, breakpoints in variant_deletes.items():
+        variants = assets_by_id[asset_id].variants
+        for v in [v for v in variants if v.breakpoint in breakpoints]:
+            variants.remove(v) # delete-orphan cascade deletes the row on flush
+            removed_variant_count += 1
+    new_variants: List[StyleAssetVariant] = []
+    for asset_id, upserts in variant_upserts.items():
+        existing_by_bp = {v.breakpoint: v for v in assets_by_id[asset_id].variants}
+        for bp, variant in upserts.items():
+            if bp in existing_by_bp:
+                existing_by_bp[bp].value = variant.value
+                existing_by_bp[bp].is_important = variant.is_important
+            else:
+                new_variants.append(StyleAssetVariant(asset_id=asset_id, breakpoint=bp, value=variant.value, is_important=variant.is_important))
+
+    # Creates: bulk insert, flushed once to obtain IDs for their variants
+    if to_create:
+        db.add_all([asset for _, asset, _ in to_create])
+        db.flush()
+        for _, asset, variants in to_create:
+            new_variants.extend(
+                StyleAssetVariant(asset_id=asset.id, breakpoint=v.breakpoint, value=v.value, is_important=v.is_important)
+                for v in variants
+            )
+    if new_variants:
+        db.add_all(new_variants)
+
+    changed = bool(to_delete or to_create or removed_variant_count or new_variants or variant_upserts or any(pending_changes.values()))
+    if changed:
+        bump_revision(styling_id, db)
+    db.commit()
+
+    release_files(removed_files, db)
+
+    created_by_index = {index: asset for index, asset, _ in to_create}
+    for result in results:
+        if result["op"] == "create":
+            result["status"] = "created"
+            result["id"] = created_by_index[result["index"]].id
+        elif result["op"] == "delete":
+            result["status"] = "deleted"
+        elif result["status"] == "ok":
+            result["status"] = "updated"
+
+    if changed:
+        invalidate_styling_artifacts(styling_id, db) # Queues exactly one CSS rebuild
+
+    return {"results": results}
+
 @app.get("/brand-stylings/{styling_id}/assets/") # Keep your existing decorator
-async def get_assets(styling_id: int, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+def get_assets(styling_id: int, request: Request, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+    cache_key = (styling_id, "assets")
+    cached = css_cache.get(cache_key)
+    if cached is not None:
+        return artifact_response(request, cached)
+    generation = css_cache.generation(cache_key)
+
     # Check if the styling_id exists in the database
     db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
     if db_styling is None:
         raise HTTPException(status_code=404, detail="Styling ID not found")
 
     # Return assets related to the styling WITH THEIR VARIANTS
-    assets = db.query(StyleAsset).filter(StyleAsset.brand_styling_id == styling_id).all() # Consider .options(selectinload(StyleAsset.variants)) for efficiency
+    assets = db.query(StyleAsset).options(selectinload(StyleAsset.variants), selectinload(StyleAsset.derivatives)).filter(
+        StyleAsset.brand_styling_id == styling_id
+    ).all()
     
     result = []
     for asset in assets:
-        # Get all variants for this asset
-        # This is an N+1 query pattern; selectinload is more efficient
-        variants = db.query(StyleAssetVariant).filter(
-            StyleAssetVariant.asset_id == asset.id
-        ).all()
-        
         # Convert to dict and add variants
         asset_dict = {
             "id": asset.id,
@@ -981,12 +1290,16 @@ async def get_assets(styling_id: int, db: Session = Depends(get_db), api_key: st
                     "breakpoint": v.breakpoint,
                     "value": v.value,
                     "is_important": v.is_important
-                } for v in variants
-            ]
+                } for v in asset.variants
+            ],
+            "derivatives": derivative_dicts(asset),
+            **image_metadata_dict(asset)
         }
         result.append(asset_dict)
     
-    return result
+    artifact = CachedArtifact(JSONResponse(content=result).body, "application/json", db_styling.updated_at)
+    css_cache.put(cache_key, artifact, generation=generation)
+    return artifact_response(request, artifact)
 
 @app.get("/brand-stylings/{styling_id}/assets/{asset_id}", response_model=schemas.StyleAsset)
 def get_style_asset_by_styling(styling_id: int, asset_id: int, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
@@ -1005,382 +1318,179 @@ def get_style_asset_by_styling(styling_id: int, asset_id: int, db: Session = Dep
 
     return db_asset
 
-@app.get("/brand/{styling_id}/css")
-def get_css(styling_id: int, db: Session = Depends(get_db)):
-    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if db_styling is None:
-        raise HTTPException(status_code=404, detail="Brand styling not found")
+@app.get("/blobs/{blob_name}")
+def get_blob(blob_name: str):
+    """Serve an uploaded file by content hash. The URL changes whenever the content does."""
+    blob_path = blob_path_for_name(blob_name)
+    if blob_path is None or not os.path.isfile(blob_path):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    return FileResponse(
+        blob_path,
+        media_type=BLOB_MEDIA_TYPES[os.path.splitext(blob_name)[1]],
+        headers={"Cache-Control": BLOB_CACHE_CONTROL, "X-Content-Type-Options": "nosniff"},
+    )
 
-    # Always regenerate CSS to ensure it includes any new variants
-    generate_css(styling_id, db)
+def resolve_css_mode(mode: Optional[str]) -> str:
+    mode = mode or settings.CSS_DEFAULT_MODE
+    if mode not in CSS_BUILD_MODES:
+        raise HTTPException(status_code=400, detail=f"CSS mode '{mode}' not supported. Supported modes: {', '.join(CSS_BUILD_MODES)}")
+    return mode
 
-    # Use CONTAINER_ASSET_DIR_ABS for the CSS file path
-    css_path = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id), "style.css")
-    if not os.path.exists(css_path):
-        raise HTTPException(status_code=500, detail="Failed to generate CSS file.")
+@app.get("/brand/bundle")
+def get_css_bundle(
+    request: Request,
+    ids: str,
+    scope: str = "layer",
+    minify: Optional[bool] = None,
+    format: str = "css",
+    db: Session = Depends(get_db)
+):
+    """
+    Several stylings' flattened stylesheets in one response, in the order given (ids=1,5,9).
+    scope=layer wraps each brand in its own @layer, scope=selector declares it under
+    CSS_BUNDLE_SELECTOR (e.g. [data-brand="5"]) instead of :root, scope=none just concatenates.
+    format=json returns {"scope", "stylings": [{"id", "etag", "css"}]} instead.
+    """
+    try:
+        styling_ids = list(dict.fromkeys(int(i) for i in ids.split(",") if i.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of brand styling IDs")
+    if not styling_ids:
+        raise HTTPException(status_code=400, detail="No brand styling IDs given")
+    if len(styling_ids) > settings.CSS_BUNDLE_MAX_STYLINGS:
+        raise HTTPException(status_code=400, detail=f"A bundle can contain at most {settings.CSS_BUNDLE_MAX_STYLINGS} stylings")
+    if scope not in CSS_BUNDLE_SCOPES:
+        raise HTTPException(status_code=400, detail=f"Bundle scope '{scope}' not supported. Supported scopes: {', '.join(CSS_BUNDLE_SCOPES)}")
+    if format not in CSS_BUNDLE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Bundle format '{format}' not supported. Supported formats: {', '.join(CSS_BUNDLE_FORMATS)}")
+    if minify is None:
+        minify = settings.CSS_DEFAULT_MINIFY
+
+    cached = css_cache.get(css_bundle_key(styling_ids, scope, minify, format))
+    if cached is not None:
+        return artifact_response(request, cached)
+
+    artifact, missing = compile_css_bundle(styling_ids, scope, minify, format, db)
+    if artifact is None:
+        raise HTTPException(status_code=404, detail=f"Brand styling(s) not found: {', '.join(map(str, missing))}")
+    return artifact_response(request, artifact)
 
-    return FileResponse(css_path, media_type="text/css")
+@app.get("/brand/{styling_id}/css")
+def get_css(
+    styling_id: int,
+    request: Request,
+    mode: Optional[str] = None,
+    minify: Optional[bool] = None,
+    groups: Optional[str] = None,
+    types: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Serve the compiled stylesheet. mode=import references the master brand via @import,
+    mode=flat merges the whole master-brand chain into one file.
+    minify=1 serves the comment-free build, with a SourceMap header pointing at
+    /brand/{styling_id}/css.map; without it the styling's minify_css setting decides.
+    groups=Colors,Typography and/or types=color,font serve only those groups / asset types.
+    """
+    mode = resolve_css_mode(mode)
+    if minify is None:
+        minify = publishes_minified(styling_id, db)
+
+    group_list = [g.strip() for g in (groups or "").split(",") if g.strip()]
+    type_list = [t.strip() for t in (types or "").split(",") if t.strip()]
+    if group_list or type_list:
+        cached = css_cache.get(partial_css_key(styling_id, mode, group_list, type_list, minify))
+        if cached is not None:
+            return artifact_response(request, cached)
+        artifact = compile_partial_css(styling_id, mode, group_list, type_list, minify, db)
+        if artifact is None:
+            raise HTTPException(status_code=404, detail="Brand styling not found")
+        return artifact_response(request, artifact)
+
+    # Serve from the in-memory cache when possible; every write endpoint invalidates it,
+    # so a hit (or a 304) never needs to touch the filesystem.
+    if minify:
+        source_map_header = {"SourceMap": f"/brand/{styling_id}/css.map?mode={mode}"}
+        cached = css_cache.get((styling_id, "css-min", mode))
+        if cached is not None:
+            return artifact_response(request, cached, source_map_header)
+        compiled = compile_minified_css(styling_id, mode, db)
+        if compiled is None:
+            raise HTTPException(status_code=404, detail="Brand styling not found")
+        return artifact_response(request, compiled[0], source_map_header)
+
+    cached = css_cache.get((styling_id, "css", mode))
+    if cached is not None:
+        return artifact_response(request, cached)
+
+    artifact = compile_css(styling_id, mode, db)
+    if artifact is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+    return artifact_response(request, artifact)
+
+@app.get("/brand/{styling_id}/css.map")
+def get_css_source_map(styling_id: int, request: Request, mode: Optional[str] = None, db: Session = Depends(get_db)):
+    """Source map of the minified stylesheet: each declaration maps to the asset ("assets/{asset_id}") that produced it."""
+    mode = resolve_css_mode(mode)
+    cached = css_cache.get((styling_id, "css-map", mode))
+    if cached is not None:
+        return artifact_response(request, cached)
+
+    compiled = compile_minified_css(styling_id, mode, db)
+    if compiled is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+    return artifact_response(request, compiled[1])
 
 # Export endpoints
 @app.get("/brand/{styling_id}/export/{format}")
-def export_styling(styling_id: int, format: str, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
-    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if db_styling is None:
-        raise HTTPException(status_code=404, detail="Brand styling not found")
-
-    assets = db.query(StyleAsset).filter(StyleAsset.brand_styling_id == styling_id).all()
-
-    # Use settings for export formats
-    if format not in settings.EXPORT_FORMATS:
-         raise HTTPException(status_code=400, detail=f"Export format '{format}' not supported. Supported formats: {', '.join(settings.EXPORT_FORMATS)}")
-
-    # Use CONTAINER_ASSET_DIR_ABS (absolute path) for export directory
-    export_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, "exports")
-    os.makedirs(export_dir, exist_ok=True) # Ensure export directory exists
-
-    # Sanitize styling name for filename
-    sanitized_name = re.sub(r'[^\w\-_\.]', '_', db_styling.name)
-
-    if format == "json":
-        # Export as JSON
-        export_data = {
-            "brand": {
-                "id": db_styling.id,
-                "name": db_styling.name,
-                "site_id": db_styling.site_id
-            },
-            "assets": [
-                {
-                    "name": asset.name,
-                    "type": asset.type,
-                    "value": asset.value,
-                    "description": asset.description
-                    # file_path is internal, no need to export
-                }
-                for asset in assets
-            ]
-        }
-
-        # Save to file using CONTAINER_ASSET_DIR_ABS (absolute path) for path
-        export_path = os.path.join(export_dir, f"{sanitized_name}_export.json")
-        try:
-            with open(export_path, "w") as f:
-                json.dump(export_data, f, indent=2)
-        except Exception as e:
-            print(f"Error saving JSON export for styling {styling_id}: {e}")
-            raise HTTPException(status_code=500, detail="Failed to generate JSON export.")
-
-
-        return FileResponse(export_path, media_type="application/json", filename=f"{sanitized_name}_export.json")
-
-    elif format == "scss":
-        # Export as SCSS variables
-        scss_content = "// SCSS Variables for " + db_styling.name + "\n\n"
-
-        for asset in assets:
-            # Ensure variable names in SCSS start with $
-            scss_name = asset.name.replace("--", "$")
-            scss_content += f"{scss_name}: {asset.value};\n"
-
-        # Save to file using CONTAINER_ASSET_DIR_ABS (absolute path) for path
-        export_path = os.path.join(export_dir, f"{sanitized_name}_variables.scss")
-        try:
-            with open(export_path, "w") as f:
-                f.write(scss_content)
-        except Exception as e:
-             print(f"Error saving SCSS export for styling {styling_id}: {e}")
-             raise HTTPException(status_code=500, detail="Failed to generate SCSS export.")
-
-
-        return FileResponse(export_path, media_type="text/plain", filename=f"{sanitized_name}_variables.scss")
-
-    # Add other export formats here as needed (e.g., android, ios)
-    # elif format == "android":
-    #     pass # Implement Android export logic
-    # elif format == "ios":
-    #      pass # Implement iOS export logic
+def export_styling(request: Request, styling_id: int, format: str, save: bool = False, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+    """
+    Export a styling's tokens. The export is built in memory once per revision and cached;
+    with ?save=true a copy is also written to exports/{id}/{revision}/ (see X-Export-Path).
+    """
+    cache_key, artifact, file_name = compile_export(styling_id, format, db)
+    headers = {"Content-Disposition": attachment_disposition(file_name)}
+    if save:
+        headers["X-Export-Path"] = save_export(cache_key, artifact, file_name)
+    return artifact_response(request, artifact, headers)
+
+def attachment_disposition(file_name: str) -> str:
+    """Content-Disposition for a download, as FileResponse(filename=...) builds it."""
+    quoted = quote(file_name)
+    if quoted != file_name:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{file_name}"'
+
+def derivative_dicts(asset: StyleAsset) -> List[Dict[str, Any]]:
+    return [{"id": d.id, "width": d.width, "format": d.format, "file_path": d.file_path} for d in asset.derivatives]
+
+def image_metadata_dict(asset: StyleAsset) -> Dict[str, Any]:
+    return {
+        "image_width": asset.image_width,
+        "image_height": asset.image_height,
+        "image_format": asset.image_format,
+        "placeholder": asset.placeholder,
+    }
 
-    else:
-         # This else should technically not be reached due to the initial format check,
-         # but keeping it as a fallback is fine.
-        raise HTTPException(status_code=400, detail=f"Export format '{format}' not supported.")
+def set_image_metadata(asset: StyleAsset, stored) -> None:
+    """Record the size/format/placeholder of a newly stored upload (or clear them with None)."""
+    asset.image_width = stored.width if stored else None
+    asset.image_height = stored.height if stored else None
+    asset.image_format = stored.image_format if stored else None
+    asset.placeholder = stored.placeholder if stored else None
 
 # Documentation endpoint
-# PASTE THIS CODE BLOCK INTO app.py
-
-# REPLACE this function in app.py
-
-def render_variants_html(asset: StyleAsset, asset_type: str) -> str:
-    """Helper function to render an asset's variants as an HTML list."""
-    if not asset.variants:
-        return ""
-    
-    sorted_variants = sorted(asset.variants, key=lambda v: v.breakpoint)
-    
-    variants_html = '<div class="variants-info"><strong>Variants:</strong><ul>'
-    for variant in sorted_variants:
-        important_tag = " !important" if variant.is_important else ""
-        
-        # If the parent asset is a color, add a swatch for the variant
-        if asset_type == 'color':
-            swatch_html = f'<span class="variant-swatch" style="background-color:{variant.value};"></span>'
-            variants_html += f'<li>{swatch_html}<em>{variant.breakpoint}:</em> <code>{variant.value}{important_tag}</code></li>'
-        else:
-            # For other types, just show the text
-            variants_html += f'<li><em>{variant.breakpoint}:</em> <code>{variant.value}{important_tag}</code></li>'
-            
-    variants_html += '</ul></div>'
-    return variants_html
-# PASTE THIS HELPER FUNCTION INTO app.py
-
-def resolve_css_var(value: str, asset_map: Dict[str, str], visited: Optional[set] = None) -> Optional[str]:
-    """Recursively resolves a CSS variable (e.g., var(--my-var)) to its final value."""
-    if visited is None:
-        visited = set()
-
-    # Regex to find a var() reference
-    var_match = re.match(r'^\s*var\((--[a-zA-Z0-9-_]+)\)\s*$', value.strip())
-    
-    if not var_match:
-        return value  # Not a variable or malformed, return the original value
-
-    var_name = var_match.group(1)
-    
-    # Check for circular references
-    if var_name in visited:
-        print(f"Warning: Circular reference detected for variable {var_name}")
-        return None 
-    
-    visited.add(var_name)
-    
-    next_value = asset_map.get(var_name)
-    
-    if next_value is None:
-        print(f"Warning: Variable {var_name} not found in asset map during resolution.")
-        return None
-
-    # Recursively resolve the next value in the chain
-    return resolve_css_var(next_value, asset_map, visited)
-
-# REPLACE the existing generate_docs function in app.py with this:
-
 @app.get("/brand/{styling_id}/docs")
 def generate_docs(request: Request, styling_id: int, db: Session = Depends(get_db)):
-    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if db_styling is None:
-        raise HTTPException(status_code=404, detail="Brand styling not found")
-
-    site = db.query(Site).filter(Site.id == db_styling.site_id).first()
-    if site is None:
-         raise HTTPException(status_code=404, detail="Associated site not found.")
-
-    assets = db.query(StyleAsset).options(selectinload(StyleAsset.variants)).filter(StyleAsset.brand_styling_id == styling_id).all()
-    asset_map = {asset.name: asset.value for asset in assets if asset.name.startswith('--')}
-
-    # Group assets
-    colors = [a for a in assets if a.type == "color"]
-    images = [a for a in assets if a.type == "image"]
-    dimensions = [a for a in assets if a.type == "dimension"]
-    fonts = [a for a in assets if a.type == "font"]
-    selector_assets = [a for a in assets if a.type in ["css_declaration", "class_rule"]]
-    grouped_selectors = defaultdict(list)
-    for asset in selector_assets:
-        selector_key = asset.selector if asset.type == "css_declaration" and asset.selector else asset.name
-        grouped_selectors[selector_key].append(asset)
-    variable_types = ["color", "image", "dimension", "font", "css_declaration", "class_rule"]
-    other = [a for a in assets if a.type not in variable_types]
-
-    html = f"""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{db_styling.name} - Style Guide</title>
-        <link rel="stylesheet" href="/brand/{styling_id}/css">
-        <style>
-            body {{ font-family: system-ui, -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, 'Open Sans', 'Helvetica Neue', sans-serif; margin: 0; padding: 2rem; line-height: 1.6; background-color: #fdfdfd; color: #333; }}
-            h1, h2, h3 {{ margin-top: 2.5em; border-bottom: 1px solid #eee; padding-bottom: 8px; font-weight: 600; }}
-            h2 {{ font-size: 1.8em; }} h3 {{ font-size: 1.4em; border-bottom-style: dashed; }}
-            .container {{ max-width: 1200px; margin: 0 auto; }}
-            .header {{ border-bottom: 1px solid #ddd; padding-bottom: 20px; margin-bottom: 40px; text-align: center; }}
-            .grid {{ display: grid; grid-template-columns: repeat(auto-fill, minmax(220px, 1fr)); gap: 25px; }}
-            .item {{ border-radius: 8px; overflow: hidden; box-shadow: 0 4px 12px rgba(0,0,0,0.07); background: white; transition: transform 0.2s ease-in-out; }}
-            .item:hover {{ transform: translateY(-3px); }}
-            .preview {{ height: 120px; display: flex; align-items: center; justify-content: center; background-color: #f5f5f5; border-bottom: 1px solid #eee; }}
-            .preview img {{ max-width: 100%; max-height: 120px; object-fit: contain; }}
-            .info {{ padding: 15px; }}
-            .info p {{ margin: 5px 0; color: #666; font-size: 0.9em;}}
-            table {{ width: 100%; border-collapse: collapse; margin: 20px 0; background: white; box-shadow: 0 4px 12px rgba(0,0,0,0.07); border-radius: 8px; overflow: hidden;}}
-            table th, table td {{ text-align: left; padding: 14px; border-bottom: 1px solid #f0f0f0; }}
-            table tr:last-child td {{ border-bottom: none; }}
-            table th {{ background-color: #f9f9f9; font-weight: 600; }}
-            .asset-value code {{ background-color: #eef; color: #55d; padding: 3px 6px; border-radius: 4px; font-size: 0.95em;}}
-            .variants-info {{ margin-top: 12px; padding-top: 12px; border-top: 1px dashed #ccc; }}
-            .variants-info ul {{ margin: 8px 0 0 0; padding-left: 0; list-style-type: none; font-size: 0.9em; color: #555; }}
-            .variants-info li {{ margin-bottom: 6px; display: flex; align-items: center; }}
-            .variants-info em {{ margin-right: 5px; min-width: 70px; display: inline-block; text-align: right; }}
-            .variant-swatch {{ display: inline-block; width: 14px; height: 14px; border-radius: 4px; border: 1px solid rgba(0,0,0,0.15); margin-right: 8px; flex-shrink: 0; }}
-            .selector-block {{ margin-bottom: 3em; }}
-            code {{ font-family: 'SF Mono', 'Fira Code', 'Consolas', 'Courier New', monospace; }}
-            pre > code {{ display: block; background-color: #2d2d2d; color: #f1f1f1; padding: 15px; border-radius: 4px; white-space: pre-wrap; }}
-            
-            /* --- STYLES FOR THE NEW PDF BUTTON --- */
-            .print-button {{
-                display: inline-block;
-                margin: 1rem 0;
-                padding: 8px 16px;
-                border: 1px solid #ccc;
-                border-radius: 5px;
-                background-color: #f0f0f0;
-                cursor: pointer;
-                font-size: 0.9em;
-                font-weight: 500;
-            }}
-            .print-button:hover {{
-                background-color: #e0e0e0;
-                border-color: #bbb;
-            }}
-            /* --- HIDE BUTTON AND OTHER UI ELEMENTS FOR PRINTING --- */
-            @media print {{
-                body {{ padding: 1cm; }}
-                .print-button, #css-import-section {{
-                    display: none !important;
-                }}
-                .item, table {{
-                    page-break-inside: avoid;
-                }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <div class="header">
-                <h1>{db_styling.name} - Style Guide</h1>
-                <p>Site: {site.name}</p>
-                <p>{db_styling.description or ""}</p>
-                <button onclick="window.print()" class="print-button">Download as PDF</button>
-            </div>
-    """
-
-    if colors:
-        html += '<h2>Colors</h2><div class="grid">'
-        for color in sorted(colors, key=lambda x: x.name):
-            html += f"""
-                    <div class="item">
-                        <div class="preview" style="background-color: {color.value};"></div>
-                        <div class="info">
-                            <strong>{color.name}</strong><br>
-                            <code>{color.value}</code>
-                            <p>{color.description or ""}</p>
-                            {render_variants_html(color, color.type)}
-                        </div>
-                    </div>"""
-        html += "</div>"
-    
-    if images:
-        html += '<h2>Images</h2><div class="grid">'
-        for image in sorted(images, key=lambda x: x.name):
-            resolved_value = resolve_css_var(image.value, asset_map)
-            if resolved_value:
-                image_src = resolved_value.strip()
-                if image_src.lower().startswith('url(') and image_src.endswith(')'):
-                    image_src = image_src[4:-1].strip().strip('\'"')
-                
-                html += f"""
-                        <div class="item">
-                            <div class="preview"><img src="{image_src}" alt="{image.name}"></div>
-                            <div class="info">
-                                <strong>{image.name}</strong><br>
-                                <code>{image.value}</code>
-                                <p>{image.description or ""}</p>
-                                {render_variants_html(image, image.type)}
-                            </div>
-                        </div>"""
-        html += "</div>"
-
-    if dimensions:
-        html += "<h2>Dimensions</h2><table><thead><tr><th>Name</th><th>Value</th><th>Description</th></tr></thead><tbody>"
-        for dim in sorted(dimensions, key=lambda x: x.name):
-            html += f"""
-                    <tr>
-                        <td>{dim.name}</td>
-                        <td class="asset-value"><code>{dim.value}</code>{render_variants_html(dim, dim.type)}</td>
-                        <td>{dim.description or ""}</td>
-                    </tr>"""
-        html += "</tbody></table>"
-
-    if fonts:
-        html += "<h2>Fonts</h2><table><thead><tr><th>Name</th><th>Value</th><th>Description</th></tr></thead><tbody>"
-        for font in sorted(fonts, key=lambda x: x.name):
-            html += f"""
-                    <tr>
-                        <td>{font.name}</td>
-                        <td class="asset-value"><code>{font.value}</code>{render_variants_html(font, font.type)}</td>
-                        <td>{font.description or ""}</td>
-                    </tr>"""
-        html += "</tbody></table>"
-    
-    if grouped_selectors:
-        html += "<h2>Selectors</h2>"
-        for selector, declarations in sorted(grouped_selectors.items()):
-            html += f"<div class='selector-block'><h3><code>{selector}</code></h3>"
-            if len(declarations) == 1 and declarations[0].type == 'class_rule':
-                html += f"<pre><code>{declarations[0].value}</code></pre>"
-            else:
-                html += "<table><thead><tr><th>Property</th><th>Value</th><th>Description</th></tr></thead><tbody>"
-                for decl in sorted(declarations, key=lambda d: d.name):
-                    html += f"""
-                        <tr>
-                            <td>{decl.name}</td>
-                            <td class="asset-value"><code>{decl.value}</code>{render_variants_html(decl, decl.type)}</td>
-                            <td>{decl.description or ""}</td>
-                        </tr>"""
-                html += "</tbody></table>"
-            html += "</div>"
-    
-    if other:
-        html += "<h2>Other Variables</h2><table><thead><tr><th>Name</th><th>Type</th><th>Value</th><th>Description</th></tr></thead><tbody>"
-        for var in sorted(other, key=lambda x: x.name):
-            html += f"""
-                    <tr>
-                        <td>{var.name}</td>
-                        <td>{var.type}</td>
-                        <td class="asset-value"><code>{var.value}</code>{render_variants_html(var, var.type)}</td>
-                        <td>{var.description or ""}</td>
-                    </tr>"""
-        html += "</tbody></table>"
-
-    full_css_url = f"{str(request.base_url).rstrip('/')}/brand/{styling_id}/css"
-    html += f"""
-            <div id="css-import-section">
-                <h2>CSS Import</h2>
-                <p>Use the following snippet to include these styles in your project:</p>
-                <pre><code id="css-import-code">@import url('{full_css_url}');</code></pre>
-                <p>Or via a link tag:</p>
-                <pre><code id="css-link-code">&lt;link rel="stylesheet" href="{full_css_url}"&gt;</code></pre>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-
-    docs_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id))
-    os.makedirs(docs_dir, exist_ok=True)
-    docs_path = os.path.join(docs_dir, "docs.html")
-
-    try:
-        with open(docs_path, "w", encoding="utf-8") as f:
-            f.write(html)
-    except Exception as e:
-         print(f"Error saving documentation file for styling {styling_id}: {e}")
-         raise HTTPException(status_code=500, detail="Failed to generate documentation file.")
-
-    return FileResponse(docs_path, media_type="text/html")
+    cache_key = (styling_id, "docs", str(request.base_url))
+    cached = css_cache.get(cache_key)
+    if cached is not None:
+        return artifact_response(request, cached)
+    return artifact_response(request, compile_docs(styling_id, str(request.base_url), db))
 
 
 @app.post("/brand/{styling_id}/update-css")
-async def update_css(styling_id: int, css_content: str = Form(...), db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+def update_css(styling_id: int, css_content: str = Form(...), db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
     """
     Update the CSS file for a brand styling.
     This endpoint allows direct editing of the CSS file through the UI.
@@ -1392,16 +1502,11 @@ async def update_css(styling_id: int, css_content: str = Form(...), db: Session
     if db_styling is None:
         raise HTTPException(status_code=404, detail="Brand styling not found")
 
-    # Create the directory if it doesn't exist using CONTAINER_ASSET_DIR_ABS (absolute path)
-    css_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id))
-    os.makedirs(css_dir, exist_ok=True)
-
     # Save the CSS content to the file using CONTAINER_ASSET_DIR_ABS (absolute path)
-    css_path = os.path.join(css_dir, "style.css")
+    css_path = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id), "style.css")
 
     try:
-        with open(css_path, "w") as f:
-            f.write(css_content)
+        write_file_atomic(css_path, css_content)
 
         return {"message": "CSS updated successfully (Note: Database assets are not synchronized with this endpoint. Use /sync for full bidirectional sync.)"}
     except Exception as e:
@@ -1485,93 +1590,59 @@ def get_brand_styling_inheritance(styling_id: int, db: Session = Depends(get_db)
     return inheritance_info
 
 @app.get("/brand-stylings/{styling_id}/assets-with-inheritance", response_model=List[schemas.StyleAssetWithInheritance])
-async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+def get_assets_with_inheritance(styling_id: int, request: Request, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
     print(f"\n[BACKEND DEBUG] get_assets_with_inheritance called for styling_id: {styling_id}")
-    current_viewed_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if not current_viewed_styling:
+    cache_key = (styling_id, "assets-with-inheritance")
+    cached = css_cache.get(cache_key)
+    if cached is not None:
+        return artifact_response(request, cached)
+    generation = css_cache.generation(cache_key)
+
+    # Step 1: Determine the stylings to include in the analysis and their specificity order.
+    # Ancestors and descendants each come from a single recursive query, whatever the tree shape.
+    ancestors_with_depth = get_ancestors_with_depth(styling_id, db)
+    if not ancestors_with_depth:
         print(f"[BACKEND DEBUG] Styling ID {styling_id} not found in DB.")
         raise HTTPException(status_code=404, detail="Styling ID not found")
+    current_viewed_styling = ancestors_with_depth[0][0]
     print(f"[BACKEND DEBUG] Current Viewed Styling: ID={current_viewed_styling.id}, Name='{current_viewed_styling.name}', MasterID={current_viewed_styling.master_brand_id}")
 
-    # Step 1: Determine the stylings to include in the analysis and their specificity order.
-    stylings_for_analysis_with_spec: List[Tuple[BrandStyling, int]] = []
-    ancestor_chain: List[BrandStyling] = []
-    temp_ancestor_traversal = current_viewed_styling
-    processed_ancestor_ids = {current_viewed_styling.id}
-    
-    print("[BACKEND DEBUG] Building ancestor chain...")
-    while temp_ancestor_traversal and temp_ancestor_traversal.master_brand_id is not None:
-        if temp_ancestor_traversal.master_brand_id in processed_ancestor_ids:
-            print(f"[BACKEND DEBUG] WARNING: Circular dependency detected fetching ancestors for {current_viewed_styling.id}. Current link: {temp_ancestor_traversal.master_brand_id}")
-            break
-        parent_styling = db.query(BrandStyling).filter(BrandStyling.id == temp_ancestor_traversal.master_brand_id).first()
-        if not parent_styling:
-            print(f"[BACKEND DEBUG] Parent styling with ID {temp_ancestor_traversal.master_brand_id} not found.")
-            break
-        ancestor_chain.append(parent_styling)
-        processed_ancestor_ids.add(parent_styling.id)
-        temp_ancestor_traversal = parent_styling
-    ancestor_chain.reverse()
-
-    for i, ancestor in enumerate(ancestor_chain):
-        stylings_for_analysis_with_spec.append((ancestor, i))
-        print(f"[BACKEND DEBUG] Added Ancestor: ID={ancestor.id}, Name='{ancestor.name}', SpecIndex={i}")
-    
-    current_specificity_index = len(ancestor_chain)
-    stylings_for_analysis_with_spec.append((current_viewed_styling, current_specificity_index))
-    print(f"[BACKEND DEBUG] Added Current: ID={current_viewed_styling.id}, Name='{current_viewed_styling.name}', SpecIndex={current_specificity_index}")
-
-    descendant_stylings_to_add: List[Tuple[BrandStyling, int]] = []
-    queue: List[Tuple[BrandStyling, int]] = [(current_viewed_styling, current_specificity_index)]
-    visited_for_descendants = set(processed_ancestor_ids)
-    head = 0
-    print("[BACKEND DEBUG] Building descendant list...")
-    while head < len(queue):
-        parent_for_desc, parent_spec_idx = queue[head]
-        head += 1
-        if parent_for_desc is None or parent_for_desc.id is None: continue
-        children = db.query(BrandStyling).filter(BrandStyling.master_brand_id == parent_for_desc.id).all()
-        for child in children:
-            if child.id not in visited_for_descendants:
-                child_spec_idx = parent_spec_idx + 1 
-                descendant_stylings_to_add.append((child, child_spec_idx))
-                visited_for_descendants.add(child.id)
-                queue.append((child, child_spec_idx))
-                print(f"[BACKEND DEBUG] Added Descendant: ID={child.id}, Name='{child.name}', SpecIndex={child_spec_idx} (Parent ID: {parent_for_desc.id})")
-    
-    descendant_stylings_to_add.sort(key=lambda x: (x[1], x[0].id))
-    stylings_for_analysis_with_spec.extend(descendant_stylings_to_add)
+    # The root master gets specificity 0, the viewed styling len(ancestors), descendants deeper still
+    current_specificity_index = len(ancestors_with_depth) - 1
+    stylings_for_analysis_with_spec: List[Tuple[BrandStyling, int]] = [
+        (styling, current_specificity_index - depth) for styling, depth in reversed(ancestors_with_depth)
+    ]
+    ancestor_ids = {styling.id for styling, _ in ancestors_with_depth}
+    stylings_for_analysis_with_spec.extend(
+        (styling, current_specificity_index + depth)
+        for styling, depth in get_descendants_with_depth(styling_id, db)
+        if styling.id not in ancestor_ids # Only possible with a (corrupt) inheritance cycle
+    )
     print(f"[BACKEND DEBUG] Total stylings for analysis (count: {len(stylings_for_analysis_with_spec)})")
 
-    # Step 2 & 3: Collect all assets, grouping them by a unique key.
+    # Step 2 & 3: Collect all assets (with variants) of every styling in scope in one query,
+    # grouping them by a unique key.
+    spec_by_styling_id = {styling.id: spec_idx for styling, spec_idx in stylings_for_analysis_with_spec}
+    # The listing is dropped when any styling in scope changes, not only this one
+    depends_on = sorted(i for i in spec_by_styling_id if i != styling_id)
+    generation = css_cache.with_dependencies(generation, depends_on)
+    scoped_assets = db.query(StyleAsset).options(selectinload(StyleAsset.variants), selectinload(StyleAsset.derivatives)).filter(
+        StyleAsset.brand_styling_id.in_(list(spec_by_styling_id))
+    ).order_by(StyleAsset.id).all()
+    scoped_assets.sort(key=lambda a: spec_by_styling_id[a.brand_styling_id])
+    print(f"[BACKEND DEBUG] Found {len(scoped_assets)} physical assets across the analysis scope.")
+
     all_scoped_assets_by_key: Dict[str, List[Tuple[StyleAsset, int]]] = {}
-    print("[BACKEND DEBUG] Collecting assets from analysis scope...")
-    for styling_in_scope, spec_idx in stylings_for_analysis_with_spec:
-        if styling_in_scope is None or styling_in_scope.id is None: continue
-        assets_in_styling = db.query(StyleAsset).options(selectinload(StyleAsset.variants)).filter(StyleAsset.brand_styling_id == styling_in_scope.id).all()
-        print(f"[BACKEND DEBUG] Styling ID {styling_in_scope.id} ('{styling_in_scope.name}'): Found {len(assets_in_styling)} physical assets.")
-        for asset_model in assets_in_styling:
-            if not (asset_model and asset_model.name and asset_model.type and asset_model.value is not None): 
-                print(f"[BACKEND DEBUG] SKIPPING asset from Styling ID {styling_in_scope.id} due to None value or missing essential field: Name='{asset_model.name if asset_model else 'N/A'}'")
-                continue
+    for asset_model in scoped_assets:
+        if not (asset_model and asset_model.name and asset_model.type and asset_model.value is not None): 
+            print(f"[BACKEND DEBUG] SKIPPING asset from Styling ID {asset_model.brand_styling_id} due to None value or missing essential field: Name='{asset_model.name if asset_model else 'N/A'}'")
+            continue
             
-            # --- MODIFICATION START ---
-            # Create a unique key to correctly identify conflicts.
-            asset_key = ""
-            if asset_model.type == "css_declaration" and asset_model.selector:
-                # For declarations, the key is a combination of its selector and property name.
-                asset_key = f"decl::{asset_model.selector}::{asset_model.name}"
-            elif asset_model.type != "css_declaration" and not asset_model.selector:
-                # For global CSS variables, the key is just the variable name.
-                asset_key = f"var::{asset_model.name}"
-            else:
-                # Fallback for legacy or other types.
-                asset_key = f"other::{asset_model.name}"
-
-            if asset_key not in all_scoped_assets_by_key:
-                all_scoped_assets_by_key[asset_key] = []
-            all_scoped_assets_by_key[asset_key].append((asset_model, spec_idx))
-            # --- MODIFICATION END ---
+        # Create a unique key to correctly identify conflicts.
+        asset_key = inheritance_key(asset_model)
+        if asset_key not in all_scoped_assets_by_key:
+            all_scoped_assets_by_key[asset_key] = []
+        all_scoped_assets_by_key[asset_key].append((asset_model, spec_by_styling_id[asset_model.brand_styling_id]))
 
     print(f"[BACKEND DEBUG] all_scoped_assets_by_key populated. Number of unique asset keys found: {len(all_scoped_assets_by_key)}")
 
@@ -1579,14 +1650,7 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
     winning_assets_orm_map: Dict[str, StyleAsset] = {}
     print("[BACKEND DEBUG] Determining winning assets...")
     for asset_key, declarations_with_spec in all_scoped_assets_by_key.items():
-        if not declarations_with_spec: continue
-        declarations_with_spec.sort(key=lambda x: x[1]) 
-        important_declarations = [d for d in declarations_with_spec if d[0].is_important]
-        winner_model: Optional[StyleAsset] = None
-        if important_declarations:
-            winner_model = important_declarations[-1][0]
-        elif declarations_with_spec:
-            winner_model = declarations_with_spec[-1][0]
+        winner_model: Optional[StyleAsset] = pick_winner(declarations_with_spec)
         if winner_model:
             winning_assets_orm_map[asset_key] = winner_model
     print(f"[BACKEND DEBUG] winning_assets_orm_map populated. Number of winning assets: {len(winning_assets_orm_map)}")
@@ -1596,7 +1660,7 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
     processed_asset_keys_in_current_styling = set()
 
     # Part 5.1: Process assets physically present in the current_viewed_styling
-    assets_physically_in_viewed_styling = db.query(StyleAsset).options(selectinload(StyleAsset.variants)).filter(StyleAsset.brand_styling_id == styling_id).all()
+    assets_physically_in_viewed_styling = [a for a in scoped_assets if a.brand_styling_id == styling_id]
     print(f"[BACKEND DEBUG] Part 5.1: Processing {len(assets_physically_in_viewed_styling)} assets physically in styling ID {styling_id}")
 
     for physical_asset_in_current_styling in assets_physically_in_viewed_styling:
@@ -1604,18 +1668,9 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
             print(f"[BACKEND DEBUG] SKIPPING a physical asset due to missing name or object.")
             continue
         
-        # --- MODIFICATION START ---
         # Generate the same unique key for the physical asset to perform lookups.
-        asset_key = ""
-        if physical_asset_in_current_styling.type == "css_declaration" and physical_asset_in_current_styling.selector:
-            asset_key = f"decl::{physical_asset_in_current_styling.selector}::{physical_asset_in_current_styling.name}"
-        elif physical_asset_in_current_styling.type != "css_declaration" and not physical_asset_in_current_styling.selector:
-            asset_key = f"var::{physical_asset_in_current_styling.name}"
-        else:
-            asset_key = f"other::{physical_asset_in_current_styling.name}"
-        
+        asset_key = inheritance_key(physical_asset_in_current_styling)
         processed_asset_keys_in_current_styling.add(asset_key)
-        # --- MODIFICATION END ---
         
         asset_dict: Dict[str, Any] = {
            "id": physical_asset_in_current_styling.id,
@@ -1629,6 +1684,8 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
             "group_name": physical_asset_in_current_styling.group_name,
             "selector": physical_asset_in_current_styling.selector,
             "variants": [{"id": v.id, "breakpoint": v.breakpoint, "value": v.value, "is_important": v.is_important} for v in (physical_asset_in_current_styling.variants or [])],
+            "derivatives": derivative_dicts(physical_asset_in_current_styling),
+            **image_metadata_dict(physical_asset_in_current_styling),
             "source": "local",
             "overridden": False, 
             "master_asset_id": None,
@@ -1655,14 +1712,7 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
                 d_tuple for d_tuple in all_scoped_assets_by_key.get(asset_key, []) 
                 if d_tuple[0].id != physical_asset_in_current_styling.id
             ]
-            most_specific_beaten_asset_orm = None
-            if other_declarations_with_spec:
-                other_declarations_with_spec.sort(key=lambda x_tuple: x_tuple[1])
-                important_other = [d_tuple for d_tuple in other_declarations_with_spec if d_tuple[0].is_important]
-                if important_other:
-                    most_specific_beaten_asset_orm = important_other[-1][0]
-                elif other_declarations_with_spec:
-                    most_specific_beaten_asset_orm = other_declarations_with_spec[-1][0]
+            most_specific_beaten_asset_orm = pick_winner(other_declarations_with_spec)
             
             if most_specific_beaten_asset_orm:
                 asset_dict["master_asset_id"] = most_specific_beaten_asset_orm.id
@@ -1695,6 +1745,8 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
             "group_name": winner_orm.group_name,
             "selector": winner_orm.selector,
             "variants": [{"id": v.id, "breakpoint": v.breakpoint, "value": v.value, "is_important": v.is_important} for v in (winner_orm.variants or [])],
+            "derivatives": derivative_dicts(winner_orm),
+            **image_metadata_dict(winner_orm),
             "source": "inherited",
             "overridden": False, 
             "master_asset_id": None, 
@@ -1705,10 +1757,16 @@ async def get_assets_with_inheritance(styling_id: int, db: Session = Depends(get
     
     result_assets.sort(key=lambda x: (x.get('group_name', 'ZZZ').lower(), x.get('name', '').lower()))
     print(f"[BACKEND DEBUG] FINAL result_assets (count: {len(result_assets)}). Returning to frontend.")
-    return result_assets
+
+    # Validate against the response model here, since a plain Response bypasses FastAPI's validation
+    payload = jsonable_encoder([schemas.StyleAssetWithInheritance(**asset) for asset in result_assets])
+    last_modified = max((s.updated_at for s, _ in stylings_for_analysis_with_spec if s.updated_at), default=None)
+    artifact = CachedArtifact(JSONResponse(content=payload).body, "application/json", last_modified)
+    css_cache.put(cache_key, artifact, generation=generation, depends_on=depends_on)
+    return artifact_response(request, artifact)
 
 @app.get("/brand-stylings/{styling_id}/compare-asset/{asset_name}")
-async def compare_asset_with_master(styling_id: int, asset_name: str, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+def compare_asset_with_master(styling_id: int, asset_name: str, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
     """Compare a local asset with its master brand version if it exists."""
     # Format the asset name consistently
     formatted_asset_name = format_asset_name(asset_name)
@@ -1766,20 +1824,15 @@ def get_master_brands(exclude: Optional[int] = None, db: Session = Depends(get_d
     """Get all brand stylings that can be used as master brands."""
     query = db.query(BrandStyling)
     
-    # Exclude the specified styling ID if provided
-    if exclude is not None:
-        query = query.filter(BrandStyling.id != exclude)
-        
-    # Also exclude any stylings that have this styling as their master
+    # Exclude the specified styling ID and all of its sub-brands (at any depth)
     # to prevent circular inheritance
     if exclude is not None:
-        sub_brands_query = db.query(BrandStyling.id).filter(BrandStyling.master_brand_id == exclude)
-        query = query.filter(~BrandStyling.id.in_(sub_brands_query))
+        query = query.filter(BrandStyling.id != exclude, BrandStyling.id.not_in(subtree_ids_query(exclude)))
     
     return query.all()
 
 @app.post("/brand-stylings/{styling_id}/assets/{asset_id}/variants/", response_model=schemas.StyleAssetVariant)
-async def create_asset_variant(
+def create_asset_variant(
     styling_id: int,
     asset_id: int,
     variant: schemas.StyleAssetVariantCreate,
@@ -1813,16 +1866,15 @@ async def create_asset_variant(
     )
     
     db.add(db_variant)
+    bump_revision(styling_id, db)
     db.commit()
     db.refresh(db_variant)
-    
-    # Regenerate CSS
-    generate_css(styling_id, db)
+    invalidate_styling_artifacts(styling_id, db) # Queues the CSS rebuild
     
     return db_variant
 
 @app.get("/brand-stylings/{styling_id}/assets/{asset_id}/variants/", response_model=List[schemas.StyleAssetVariant])
-async def get_asset_variants(
+def get_asset_variants(
     styling_id: int,
     asset_id: int,
     db: Session = Depends(get_db),
@@ -1845,7 +1897,7 @@ async def get_asset_variants(
     return variants
 
 @app.put("/brand-stylings/{styling_id}/assets/{asset_id}/variants/{variant_id}", response_model=schemas.StyleAssetVariant)
-async def update_asset_variant(
+def update_asset_variant(
     styling_id: int,
     asset_id: int,
     variant_id: int,
@@ -1876,16 +1928,15 @@ async def update_asset_variant(
     for key, value in update_data.items():
         setattr(db_variant, key, value)
     
+    bump_revision(styling_id, db)
     db.commit()
     db.refresh(db_variant)
-    
-    # Regenerate CSS
-    generate_css(styling_id, db)
+    invalidate_styling_artifacts(styling_id, db) # Queues the CSS rebuild
     
     return db_variant
 
 @app.delete("/brand-stylings/{styling_id}/assets/{asset_id}/variants/{variant_id}")
-async def delete_asset_variant(
+def delete_asset_variant(
     styling_id: int,
     asset_id: int,
     variant_id: int,
@@ -1912,26 +1963,30 @@ async def delete_asset_variant(
     
     # Delete the variant
     db.delete(db_variant)
+    bump_revision(styling_id, db)
     db.commit()
-    
-    # Regenerate CSS
-    generate_css(styling_id, db)
+    invalidate_styling_artifacts(styling_id, db) # Queues the CSS rebuild
     
     return {"message": "Variant deleted successfully"}
 
+@app.get("/brand-stylings/{styling_id}/build-status")
+def get_build_status(styling_id: int, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+    """Whether a CSS rebuild is pending, running or done for a styling."""
+    revision = db.query(BrandStyling.revision).filter(BrandStyling.id == styling_id).scalar()
+    if revision is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+    status = build_scheduler.status(styling_id)
+    status["revision"] = revision
+    return status
+
 @app.get("/brand-stylings/{styling_id}/preview-css")
 def preview_css(styling_id: int, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
-    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if db_styling is None:
+    cached = css_cache.get((styling_id, "css", "import"))
+    artifact = cached if cached is not None else compile_css(styling_id, "import", db)
+    if artifact is None:
         raise HTTPException(status_code=404, detail="Brand styling not found")
     
-    generate_css(styling_id, db)
-    css_path = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id), "style.css")
-    
-    with open(css_path, "r") as f:
-        css_content = f.read()
-    
-    return {"css": css_content}
+    return {"css": artifact.body.decode("utf-8")}
 
 #log endpoint 
 @app.post("/brand-stylings/{styling_id}/logs/", response_model=schemas.BrandLog) # Use BrandLogResponse
@@ -2022,6 +2077,31 @@ def get_db_info(db: Session = Depends(get_db), api_key: str = Depends(get_api_ke
         "record_counts": record_counts
     }
 
+@app.get("/system/build-status")
+def get_system_build_status(api_key: str = Depends(get_api_key)):
+    """
+    Counters for the background CSS build queue, the compiled-artifact cache, the token model
+    cache and CSS build coalescing (coalesced: requests that waited for a build already running).
+    """
+    return {"builds": build_scheduler.stats(), "cache": css_cache.stats(), "tokens": token_models.stats(), "coalescing": css_flights.stats()}
+
+@app.post("/system/rebuild")
+def rebuild_all(request: Request, ids: Optional[str] = None, db: Session = Depends(get_db), api_key: str = Depends(get_api_key)):
+    """
+    Precompile CSS, docs and exports for every styling (or ids=1,5,9) in a process pool and
+    load them into the cache, so no visitor pays the compile cost after a restore or deploy.
+    Returns the build report (throughput and per-styling failures).
+    """
+    if ids:
+        try:
+            styling_ids = list(dict.fromkeys(int(i) for i in ids.split(",") if i.strip()))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ids must be a comma-separated list of brand styling IDs")
+    else:
+        styling_ids = [row.id for row in db.query(BrandStyling.id).order_by(BrandStyling.id)]
+    db.close() # Workers open their own sessions; don't hold this one for the whole build
+    return prebuild_all(styling_ids, str(request.base_url), settings.BUILD_WORKERS)
+
 @app.get("/system/backups")
 def get_backup_list(api_key: str = Depends(get_api_key)):
     """Lists all available backup files."""
@@ -2060,6 +2140,8 @@ def restore_database(filename: str, db: Session = Depends(get_db), api_key: str
     try:
         db.close() # Ensure DB is not locked
         shutil.copy(backup_file, DB_FILE_PATH)
+        prepare_database() # Older backups may predate the closure table or newer columns
+        css_cache.clear()
         return {"message": f"Successfully restored from {filename}. The application will now reload."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to restore database: {e}")
@@ -2106,6 +2188,7 @@ def create_new_database(db: Session = Depends(get_db), api_key: str = Depends(ge
     try:
         db.close()
         os.remove(DB_FILE_PATH)
+        css_cache.clear()
         # The application will auto-create a new DB on the next request
         # because Base.metadata.create_all(bind=engine) is called at startup.
         return {"message": "New database created. The application will now reload."}
@@ -0,0 +1,103 @@
+# blobs.py
+import glob
+import os
+import re
+import time
+from typing import Iterable, Optional
+
+from sqlalchemy.orm import Session
+
+from config import CONTAINER_ASSET_DIR_ABS
+from models import StyleAsset
+
+# Uploaded files are stored once per content hash under assets/blobs/{sha[:2]}/{sha}{ext}.
+# StyleAsset.file_path holds that relative path; the number of assets pointing at a blob
+# is its reference count, so there is no separate counter to keep in sync.
+BLOB_DIR = "blobs"
+BLOB_ROOT_ABS = os.path.join(CONTAINER_ASSET_DIR_ABS, BLOB_DIR)
+
+# {sha}{ext} for uploads, {sha}-{width}w{ext} for the image derivatives generated from them
+BLOB_NAME_RE = re.compile(r"^([0-9a-f]{64})(-[0-9]+w)?\.(png|jpg|gif|webp|svg)$")
+
+# A blob linked this recently may belong to an upload whose asset row is not committed
+# yet, so it is never deleted as unreferenced; the startup sweep collects it later.
+BLOB_GRACE_SECONDS = 300
+
+
+def blob_relative_path(file_name: str) -> str:
+    """Path of a blob relative to the asset directory (the value stored in StyleAsset.file_path)."""
+    return f"{BLOB_DIR}/{file_name[:2]}/{file_name}"
+
+
+def blob_path_for_name(file_name: str) -> Optional[str]:
+    """Absolute path of a blob from its public name, or None if the name is not a valid blob name."""
+    if not BLOB_NAME_RE.match(file_name):
+        return None
+    return os.path.join(CONTAINER_ASSET_DIR_ABS, blob_relative_path(file_name))
+
+
+def link_blob(tmp_path: str, sha256: str, extension: str) -> str:
+    """
+    Move a fully written temp file into the store under its content hash and return the
+    blob name. If the same content is already stored, the temp file is dropped instead.
+    """
+    file_name = f"{sha256}{extension}"
+    target = os.path.join(CONTAINER_ASSET_DIR_ABS, blob_relative_path(file_name))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.exists(target):
+        os.unlink(tmp_path)
+        os.utime(target) # Restart the grace period for the new reference
+    else:
+        os.replace(tmp_path, target)
+    return file_name
+
+
+def release_files(file_paths: Iterable[Optional[str]], db: Session) -> None:
+    """
+    Delete asset files that no StyleAsset references any more. Call after the commit
+    that dropped the references. Shared blobs stay until their last reference is gone;
+    a blob's derivatives are deleted along with it.
+    """
+    for file_path in set(filter(None, file_paths)):
+        if db.query(StyleAsset.id).filter(StyleAsset.file_path == file_path).first() is not None:
+            continue
+        full_file_path = os.path.join(CONTAINER_ASSET_DIR_ABS, file_path)
+        try:
+            if file_path.startswith(f"{BLOB_DIR}/") and time.time() - os.path.getmtime(full_file_path) < BLOB_GRACE_SECONDS:
+                continue
+            os.remove(full_file_path)
+            if file_path.startswith(f"{BLOB_DIR}/"):
+                source_stem = os.path.splitext(full_file_path)[0]
+                for derivative_path in glob.glob(f"{glob.escape(source_stem)}-*w.*"):
+                    os.remove(derivative_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting file {full_file_path}: {e}")
+
+
+def sweep_unreferenced_blobs(db: Session) -> int:
+    """
+    Remove stored blobs, their derivatives and stale temp files that no asset references.
+    Returns the number of files removed.
+    """
+    if not os.path.isdir(BLOB_ROOT_ABS):
+        return 0
+    # Derivatives share the hash of their source blob, so references are compared by hash
+    referenced_hashes = {
+        os.path.basename(row.file_path)[:64]
+        for row in db.query(StyleAsset.file_path).filter(StyleAsset.file_path.like(f"{BLOB_DIR}/%"))
+    }
+    cutoff = time.time() - BLOB_GRACE_SECONDS
+    removed = 0
+    for dir_path, _, file_names in os.walk(BLOB_ROOT_ABS):
+        for file_name in file_names:
+            full_file_path = os.path.join(dir_path, file_name)
+            if file_name[:64] in referenced_hashes or os.path.getmtime(full_file_path) > cutoff:
+                continue
+            try:
+                os.remove(full_file_path)
+                removed += 1
+            except OSError as e:
+                print(f"Error deleting unreferenced blob {full_file_path}: {e}")
+    return removed
@@ -0,0 +1,103 @@
+# branding_server.py
+"""
+Command line entry point.
+
+    python -m branding_server build --all [--workers N] [--base-url URL]
+    python -m branding_server build --ids 1,5,9
+    python -m branding_server export-static --out DIR [--public-url URL] [--ids 1,5,9]
+
+build precompiles CSS and docs (written to the asset directory) and renders every export
+for the given stylings in a process pool; run it as a warm-up step before starting the server.
+export-static writes a versioned tree of every brand's published files, with a manifest,
+for a static host or CDN origin (see static_export.py).
+"""
+import argparse
+import json
+import os
+import sys
+
+from config import settings
+
+
+def open_database():
+    """Session on an up-to-date schema (the server normally does this at startup)."""
+    from models import Base, SessionLocal, engine, upgrade_schema
+    from utils import rebuild_inheritance_closure
+
+    Base.metadata.create_all(bind=engine)
+    upgrade_schema()
+    db = SessionLocal()
+    rebuild_inheritance_closure(db)
+    return db
+
+
+def parse_ids(ids: str):
+    return list(dict.fromkeys(int(i) for i in ids.split(",") if i.strip()))
+
+
+def build_command(args) -> int:
+    from builds import prebuild_all
+    from models import BrandStyling
+
+    db = open_database()
+    try:
+        if args.all:
+            styling_ids = [row.id for row in db.query(BrandStyling.id).order_by(BrandStyling.id)]
+        else:
+            styling_ids = parse_ids(args.ids)
+    finally:
+        db.close()
+
+    report = prebuild_all(styling_ids, args.base_url, args.workers, fill_cache=False)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(
+            f"Built {report['built']}/{report['stylings']} stylings in {report['seconds']}s "
+            f"({report['stylings_per_second']} stylings/s, {report['workers']} workers)"
+        )
+        for failure in report["failures"]:
+            print(f"  styling {failure['styling_id']} failed: {failure['error']}")
+    return 1 if report["failed"] else 0
+
+
+def export_static_command(args) -> int:
+    from static_export import export_static
+
+    db = open_database()
+    try:
+        manifest = export_static(args.out, args.public_url, db, parse_ids(args.ids) if args.ids else None)
+    finally:
+        db.close()
+    print(f"Exported {len(manifest['stylings'])} stylings to {os.path.join(args.out, manifest['version'])}")
+    for failure in manifest["failures"]:
+        print(f"  styling {failure['styling_id']} failed: {failure['error']}")
+    return 1 if manifest["failures"] else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m branding_server", description=settings.APP_DESCRIPTION)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="precompile CSS, docs and exports")
+    target = build.add_mutually_exclusive_group(required=True)
+    target.add_argument("--all", action="store_true", help="build every brand styling")
+    target.add_argument("--ids", help="comma-separated brand styling IDs")
+    build.add_argument("--workers", type=int, default=settings.BUILD_WORKERS, help="worker processes")
+    build.add_argument("--base-url", default=(settings.BASE_URL or "http://localhost:8000").rstrip("/") + "/",
+                       help="public URL of the server, embedded in the docs pages")
+    build.add_argument("--json", action="store_true", help="print the report as JSON")
+    build.set_defaults(handler=build_command)
+
+    export = commands.add_parser("export-static", help="write every brand's published files to a static directory tree")
+    export.add_argument("--out", required=True, help="export directory; each run adds a version under it")
+    export.add_argument("--public-url", default="", help="URL the directory is served from (default: root-relative URLs)")
+    export.add_argument("--ids", help="comma-separated brand styling IDs (default: all)")
+    export.set_defaults(handler=export_static_command)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,576 @@
+# builds.py
+import datetime
+import json
+import multiprocessing
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from cache import css_cache, CachedArtifact
+from config import settings
+from cssmin import minify_css, build_source_map
+from docs import compile_docs
+from exports import compile_export, EXPORTERS
+from models import BrandStyling, SessionLocal
+from tokens import compile_tokens
+from utils import build_css, build_flat_css, build_css_fragments, write_css, get_ancestor_ids, get_descendant_ids
+
+# "import" references the master brand via @import, "flat" merges the whole chain
+CSS_BUILD_MODES = ("import", "flat")
+
+
+class SingleFlight:
+    """
+    In-process request coalescing: at most one build per key runs at a time, and callers
+    that ask for the same key meanwhile wait for it and share its result (or exception)
+    instead of building again. After a deploy or cache flush, a burst of requests for one
+    brand then costs one build rather than one per request.
+    """
+
+    class Flight:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Tuple, "SingleFlight.Flight"] = {}
+        self.builds = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def run(self, key: Tuple, build: Callable[[], Any]) -> Any:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = SingleFlight.Flight()
+                self.builds += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = build()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._flights), "builds": self.builds, "coalesced": self.coalesced, "failures": self.failures}
+
+
+# Shared by every CSS build path (requests, the build queue, bundles). Flights are keyed by
+# cache key and generation token: every write bumps the generation along with the revision,
+# so a request made after a change never joins a build of the previous revision.
+css_flights = SingleFlight()
+
+
+def chain_last_modified(styling_id: int, db: Session):
+    """Last-Modified of a build: the latest updated_at over the inheritance chain, whose assets it contains."""
+    model = compile_tokens(styling_id, db)
+    return model.updated_at if model is not None else None
+
+
+def compile_css(styling_id: int, mode: str, db: Session) -> Optional[CachedArtifact]:
+    """
+    Compile a styling's stylesheet and store it in the shared cache.
+    Returns None if the styling does not exist.
+    """
+    cache_key = (styling_id, "css", mode)
+    generation = css_cache.generation(cache_key)
+
+    def build():
+        if mode == "flat":
+            css_content = build_flat_css(styling_id, db)
+        else:
+            css_content = build_css(styling_id, db)
+        if css_content is None:
+            return None
+
+        # Keep the on-disk copy (the @import build) in sync for preview/export consumers
+        if mode == "import" and not write_css(styling_id, css_content):
+            print(f"Warning: could not write style.css for styling {styling_id}; serving from memory only.")
+
+        last_modified = chain_last_modified(styling_id, db)
+        artifact = CachedArtifact(css_content.encode("utf-8"), "text/css", last_modified)
+        css_cache.put(cache_key, artifact, generation=generation)
+        return artifact
+
+    return css_flights.run((cache_key, generation), build)
+
+
+def compile_minified_css(styling_id: int, mode: str, db: Session) -> Optional[Tuple[CachedArtifact, CachedArtifact]]:
+    """
+    Compile the minified stylesheet and its source map, and cache both next to (not
+    instead of) the readable build. The map points every declaration at the asset it
+    came from. Minified output is only served from memory, never written to disk.
+    Returns (css, source map) or None if the styling does not exist.
+    """
+    css_key = (styling_id, "css-min", mode)
+    map_key = (styling_id, "css-map", mode)
+    css_generation = css_cache.generation(css_key)
+    map_generation = css_cache.generation(map_key)
+
+    def build():
+        if mode == "flat":
+            css_content = build_flat_css(styling_id, db, annotate=True)
+        else:
+            css_content = build_css(styling_id, db, annotate=True)
+        if css_content is None:
+            return None
+
+        minified, positions = minify_css(css_content)
+        source_map = build_source_map("style.min.css", positions, source_root="assets")
+        last_modified = chain_last_modified(styling_id, db)
+        css_artifact = CachedArtifact(minified.encode("utf-8"), "text/css", last_modified)
+        map_artifact = CachedArtifact(source_map.encode("utf-8"), "application/json", last_modified)
+        css_cache.put(css_key, css_artifact, generation=css_generation)
+        css_cache.put(map_key, map_artifact, generation=map_generation)
+        return css_artifact, map_artifact
+
+    return css_flights.run((css_key, css_generation, map_generation), build)
+
+
+def partial_css_key(styling_id: int, mode: str, groups: Sequence[str], types: Sequence[str], minify: bool) -> Tuple:
+    """Cache key of a partial bundle; the group and type filters are order- and case-insensitive."""
+    return (styling_id, "css-partial", mode, tuple(sorted({g.lower() for g in groups})), tuple(sorted(set(types))), minify)
+
+
+def compile_partial_css(
+    styling_id: int,
+    mode: str,
+    groups: Sequence[str],
+    types: Sequence[str],
+    minify: bool,
+    db: Session,
+) -> Optional[CachedArtifact]:
+    """
+    Stylesheet limited to some groups and/or asset types, concatenated from per-group
+    fragments. Fragments are cached on their own (per group, mode and type filter), so
+    another combination of the same groups only renders the groups not seen yet.
+    In import mode the master brand is @imported with the same filter.
+    Returns None if the styling does not exist.
+    """
+    bundle_key = partial_css_key(styling_id, mode, groups, types, minify)
+    groups_key, types_key = bundle_key[3], bundle_key[4]
+    generation = css_cache.generation(bundle_key)
+
+    def fragment_key(group):
+        return (styling_id, "css-fragment", mode, group, types_key)
+
+    # All fragments of a styling share one generation token
+    fragment_generation = css_cache.generation(fragment_key(None))
+
+    def build():
+        fragments = {}
+        if groups_key:
+            for group in groups_key:
+                cached = css_cache.get(fragment_key(group))
+                if cached is not None:
+                    fragments[group] = cached.body.decode("utf-8")
+            missing = [group for group in groups_key if group not in fragments]
+        else:
+            missing = None # Every group that has assets of the requested types
+
+        query = {}
+        if groups_key:
+            query["groups"] = ",".join(groups_key)
+        if types_key:
+            query["types"] = ",".join(types_key)
+        import_query = "?" + urllib.parse.urlencode(query, safe=",")
+        built = build_css_fragments(styling_id, db, flat=(mode == "flat"), groups=missing, types=types_key, import_query=import_query)
+        if built is None:
+            return None
+        css_parts, new_fragments = built
+        last_modified = chain_last_modified(styling_id, db)
+        for group, fragment in new_fragments.items():
+            group = group.lower()
+            fragments[group] = fragment
+            css_cache.put(fragment_key(group), CachedArtifact(fragment.encode("utf-8"), "text/css", last_modified), generation=fragment_generation)
+
+        filters = "; ".join(f"{name}: {value}" for name, value in query.items())
+        css_content = "\n".join([*css_parts, f"/* Partial bundle ({filters}) */", *(fragments[g] for g in sorted(fragments))]).strip()
+        if minify:
+            css_content = minify_css(css_content)[0]
+        artifact = CachedArtifact(css_content.encode("utf-8"), "text/css", last_modified)
+        css_cache.put(bundle_key, artifact, generation=generation)
+        return artifact
+
+    return css_flights.run((bundle_key, generation), build)
+
+
+# How each brand in a bundle is kept apart: @layer, a scoping selector, or not at all
+CSS_BUNDLE_SCOPES = ("layer", "selector", "none")
+CSS_BUNDLE_FORMATS = ("css", "json")
+
+
+def compile_scoped_css(styling_id: int, selector: str, minify: bool, db: Session) -> Optional[CachedArtifact]:
+    """Flat stylesheet declared on selector instead of :root, as used in bundles. None if the styling does not exist."""
+    cache_key = (styling_id, "css-scoped", selector, minify)
+    generation = css_cache.generation(cache_key)
+
+    def build():
+        css_content = build_flat_css(styling_id, db, scope=selector)
+        if css_content is None:
+            return None
+        if minify:
+            css_content = minify_css(css_content)[0]
+        last_modified = chain_last_modified(styling_id, db)
+        artifact = CachedArtifact(css_content.encode("utf-8"), "text/css", last_modified)
+        css_cache.put(cache_key, artifact, generation=generation)
+        return artifact
+
+    return css_flights.run((cache_key, generation), build)
+
+
+def bundle_member_css(styling_id: int, scope: str, minify: bool, db: Session) -> Optional[CachedArtifact]:
+    """
+    A styling's stylesheet as it goes into a bundle, from the compiled cache when possible.
+    Bundles always use the flat build: @import cannot appear inside @layer or mid-file.
+    """
+    if scope == "selector":
+        selector = settings.CSS_BUNDLE_SELECTOR.format(id=styling_id)
+        cached = css_cache.get((styling_id, "css-scoped", selector, minify))
+        return cached if cached is not None else compile_scoped_css(styling_id, selector, minify, db)
+    if minify:
+        cached = css_cache.get((styling_id, "css-min", "flat"))
+        if cached is not None:
+            return cached
+        compiled = compile_minified_css(styling_id, "flat", db)
+        return compiled[0] if compiled is not None else None
+    cached = css_cache.get((styling_id, "css", "flat"))
+    return cached if cached is not None else compile_css(styling_id, "flat", db)
+
+
+def css_bundle_key(styling_ids: Sequence[int], scope: str, minify: bool, output_format: str) -> Tuple:
+    # Not tied to one styling: a bundle is cached as depending on each of its members
+    return (None, "css-bundle", tuple(styling_ids), scope, minify, output_format)
+
+
+def compile_css_bundle(
+    styling_ids: Sequence[int],
+    scope: str,
+    minify: bool,
+    output_format: str,
+    db: Session,
+) -> Tuple[Optional[CachedArtifact], List[int]]:
+    """
+    Concatenate the compiled stylesheets of several stylings, in the given order, into one
+    stylesheet (output_format="css") or a JSON document with one entry per styling.
+    Returns (artifact, []) or (None, missing styling IDs).
+    """
+    cache_key = css_bundle_key(styling_ids, scope, minify, output_format)
+    generation = css_cache.generation(cache_key, depends_on=styling_ids)
+
+    def build():
+        members = {}
+        missing = []
+        for styling_id in styling_ids:
+            member = bundle_member_css(styling_id, scope, minify, db)
+            if member is None:
+                missing.append(styling_id)
+            else:
+                members[styling_id] = member
+        if missing:
+            return None, missing
+
+        last_modified = max((m.last_modified for m in members.values() if m.last_modified is not None), default=None)
+        if output_format == "json":
+            body = json.dumps({
+                "scope": scope,
+                "stylings": [
+                    {"id": styling_id, "etag": member.etag, "css": member.body.decode("utf-8")}
+                    for styling_id, member in members.items()
+                ],
+            }).encode("utf-8")
+            artifact = CachedArtifact(body, "application/json", last_modified)
+        else:
+            newline, separator = ("", "") if minify else ("\n", "\n\n")
+            parts = []
+            if scope == "layer":
+                layers = [settings.CSS_BUNDLE_LAYER.format(id=styling_id) for styling_id in members]
+                # Declaring the order up front makes later brands win, whatever the rules inside
+                parts.append(f"@layer {', '.join(layers)};")
+                for layer, member in zip(layers, members.values()):
+                    parts.append(f"@layer {layer} {{{newline}{member.body.decode('utf-8')}{newline}}}")
+            else:
+                parts.extend(member.body.decode("utf-8") for member in members.values())
+            artifact = CachedArtifact(separator.join(parts).encode("utf-8"), "text/css", last_modified)
+        css_cache.put(cache_key, artifact, generation=generation, depends_on=styling_ids)
+        return artifact, []
+
+    return css_flights.run((cache_key, generation), build)
+
+
+# styling_id -> (generation token, minify_css setting). Checked on every CSS request without
+# ?minify=, so cache hits and 304s stay free of database queries; every write to a styling
+# bumps its generation, which retires the entry.
+minify_settings: Dict[int, Tuple[Tuple, bool]] = {}
+
+
+def publishes_minified(styling_id: int, db: Session) -> bool:
+    """Whether the styling serves minified CSS when the request does not ask for either."""
+    generation = css_cache.generation((styling_id, "minify-setting"))
+    known = minify_settings.get(styling_id)
+    if known is not None and known[0] == generation:
+        return known[1]
+    row = db.query(BrandStyling.minify_css).filter(BrandStyling.id == styling_id).first()
+    if row is None:
+        return settings.CSS_DEFAULT_MINIFY # Unknown styling: not worth remembering
+    minify = settings.CSS_DEFAULT_MINIFY if row.minify_css is None else row.minify_css
+    minify_settings[styling_id] = (generation, minify)
+    return minify
+
+
+class BuildScheduler:
+    """
+    Debounced, coalescing build queue that rebuilds stylesheets off the request path.
+
+    Each schedule() call (re)starts a short debounce window for the styling; all
+    requests that arrive within it collapse into a single build. The window is
+    capped at a few multiples of the debounce so a continuous stream of edits
+    still gets built. A styling is never built twice concurrently: if it changes
+    mid-build, the follow-up build waits for the running one to finish.
+    """
+
+    def __init__(self, max_workers: int, debounce_seconds: float):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="css-build")
+        self._debounce = debounce_seconds
+        self._max_delay = debounce_seconds * 4
+        self._cond = threading.Condition()
+        self._pending: Dict[int, Tuple[float, float]] = {}  # styling_id -> (first requested, due)
+        self._running = set()
+        self._last_built_at: Dict[int, datetime.datetime] = {}
+        self._last_error: Dict[int, str] = {}
+        self._dispatcher: Optional[threading.Thread] = None
+        self._stopped = False
+        self.requested = 0
+        self.builds = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def schedule(self, styling_ids: Iterable[int]) -> None:
+        now = time.monotonic()
+        with self._cond:
+            for styling_id in styling_ids:
+                self.requested += 1
+                if styling_id in self._pending:
+                    first_requested, _ = self._pending[styling_id]
+                    due = min(now + self._debounce, first_requested + self._max_delay)
+                    self._pending[styling_id] = (first_requested, due)
+                    self.coalesced += 1
+                else:
+                    self._pending[styling_id] = (now, now + self._debounce)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_loop, name="css-build-dispatcher", daemon=True)
+                self._dispatcher.start()
+            self._cond.notify()
+
+    def status(self, styling_id: int) -> dict:
+        with self._cond:
+            if styling_id in self._running:
+                state = "building"
+            elif styling_id in self._pending:
+                state = "pending"
+            else:
+                state = "idle"
+            return {
+                "styling_id": styling_id,
+                "state": state,
+                "last_built_at": self._last_built_at.get(styling_id),
+                "last_error": self._last_error.get(styling_id),
+            }
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "running": len(self._running),
+                "requested": self.requested,
+                "builds": self.builds,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+                "debounce_ms": int(self._debounce * 1000),
+            }
+
+    def shutdown(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    now = time.monotonic()
+                    waiting = {sid: due for sid, (_, due) in self._pending.items() if sid not in self._running}
+                    ready = [sid for sid, due in waiting.items() if due <= now]
+                    if ready:
+                        break
+                    # Sleep until the next build is due, or until a running build finishes
+                    timeout = min(waiting.values()) - now if waiting else None
+                    self._cond.wait(timeout)
+                for styling_id in ready:
+                    del self._pending[styling_id]
+                    self._running.add(styling_id)
+            for i, styling_id in enumerate(ready):
+                try:
+                    self._executor.submit(self._run, styling_id)
+                except RuntimeError:
+                    # shutdown() ran since the lock was released: the executor takes no more work
+                    with self._cond:
+                        self._running.difference_update(ready[i:])
+                    return
+
+    def _run(self, styling_id: int) -> None:
+        try:
+            db = SessionLocal()
+            try:
+                minify = publishes_minified(styling_id, db)
+                for mode in CSS_BUILD_MODES:
+                    compile_css(styling_id, mode, db)
+                    if minify:
+                        compile_minified_css(styling_id, mode, db)
+            finally:
+                db.close()
+            with self._cond:
+                self.builds += 1
+                self._last_built_at[styling_id] = datetime.datetime.utcnow()
+                self._last_error.pop(styling_id, None)
+        except Exception as e:
+            print(f"Error rebuilding CSS for styling {styling_id}: {e}")
+            with self._cond:
+                self.failures += 1
+                self._last_error[styling_id] = str(e)
+        finally:
+            with self._cond:
+                self._running.discard(styling_id)
+                self._cond.notify()
+
+
+# Shared instance used by the API
+build_scheduler = BuildScheduler(
+    max_workers=settings.CSS_BUILD_WORKERS,
+    debounce_seconds=settings.CSS_BUILD_DEBOUNCE_MS / 1000,
+)
+
+
+def invalidate_styling_artifacts(styling_id: int, db: Session, descendant_ids: Optional[List[int]] = None):
+    """
+    Drop cached CSS/docs/JSON for a styling after a write and queue the rebuild.
+    Sub-brands are dropped and rebuilt too, since their flattened CSS and @import
+    header are derived from their masters. Artifacts cached as depending on one of
+    them (bundles, the inheritance listings they appeared in) go with them. Pass
+    descendant_ids when the styling has already been removed from the inheritance tree.
+    """
+    css_cache.invalidate(styling_id)
+    minify_settings.pop(styling_id, None)
+    if descendant_ids is None:
+        descendant_ids = get_descendant_ids(styling_id, db)
+    for descendant_id in descendant_ids:
+        css_cache.invalidate(descendant_id)
+    # The masters' inheritance listings include their sub-brands, including one that just joined the tree
+    for ancestor_id in get_ancestor_ids(styling_id, db):
+        css_cache.invalidate(ancestor_id, "assets-with-inheritance")
+    build_scheduler.schedule([styling_id, *descendant_ids])
+
+
+# Kinds of artifact prebuild_styling() compiles
+PREBUILD_KINDS = ("css", "css-min", "css-map", "docs", "export")
+
+
+def prebuild_styling(styling_id: int, base_url: str, collect: bool) -> Tuple[int, List[Tuple[Tuple, CachedArtifact]], Optional[str]]:
+    """
+    Compile a styling's CSS (both modes, readable and minified), docs and exports. style.css
+    and docs.html are written as usual; exports only exist in memory. Runs in a worker process
+    of prebuild_all(); with collect=True the compiled artifacts are sent back to be cached
+    by the caller. Returns (styling_id, [(cache key, artifact)], error or None).
+    """
+    artifacts = []
+    db = SessionLocal()
+    try:
+        for mode in CSS_BUILD_MODES:
+            artifact = compile_css(styling_id, mode, db)
+            if artifact is None:
+                return styling_id, [], "Brand styling not found"
+            artifacts.append(((styling_id, "css", mode), artifact))
+            minified = compile_minified_css(styling_id, mode, db)
+            if minified is not None:
+                artifacts.append(((styling_id, "css-min", mode), minified[0]))
+                artifacts.append(((styling_id, "css-map", mode), minified[1]))
+        artifacts.append(((styling_id, "docs", base_url), compile_docs(styling_id, base_url, db)))
+        for format in EXPORTERS:
+            cache_key, artifact, _ = compile_export(styling_id, format, db)
+            artifacts.append((cache_key, artifact))
+    except HTTPException as e:
+        return styling_id, [], e.detail
+    except Exception as e:
+        return styling_id, [], str(e)
+    finally:
+        db.close()
+    return styling_id, artifacts if collect else [], None
+
+
+def prebuild_all(styling_ids: Sequence[int], base_url: str, max_workers: int, fill_cache: bool = True) -> dict:
+    """
+    Precompile every artifact of many stylings in a process pool, e.g. as a warm-up after a
+    deploy or restore. With fill_cache the results go into this process's artifact cache
+    (unless the styling changed while it was being built). Returns a throughput/failure report.
+    """
+    started = time.monotonic()
+    max_workers = max(1, min(max_workers, len(styling_ids)))
+    # Generations only depend on (styling, kind), so they can be taken before the keys are known
+    generations = {(styling_id, kind): css_cache.generation((styling_id, kind)) for styling_id in styling_ids for kind in PREBUILD_KINDS}
+    built = 0
+    cached = 0
+    failures = []
+    if styling_ids:
+        # spawn: the API process runs threads, which must not be forked
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(prebuild_styling, styling_id, base_url, fill_cache): styling_id for styling_id in styling_ids}
+            for future in as_completed(futures):
+                try:
+                    styling_id, artifacts, error = future.result()
+                except Exception as e: # The worker process died
+                    styling_id, artifacts, error = futures[future], [], str(e) or type(e).__name__
+                if error is not None:
+                    failures.append({"styling_id": styling_id, "error": error})
+                    continue
+                built += 1
+                for key, artifact in artifacts:
+                    cached += css_cache.put(key, artifact, generation=generations[key[:2]])
+
+    seconds = time.monotonic() - started
+    return {
+        "stylings": len(styling_ids),
+        "built": built,
+        "failed": len(failures),
+        "failures": sorted(failures, key=lambda f: f["styling_id"]),
+        "artifacts_cached": cached,
+        "workers": max_workers,
+        "seconds": round(seconds, 3),
+        "stylings_per_second": round(built / seconds, 2) if seconds > 0 else None,
+    }
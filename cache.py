@@ -0,0 +1,186 @@
+# cache.py
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from compression import compress_variants
+from config import settings
+
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag derived from the artifact content."""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+class CachedArtifact:
+    """
+    A compiled artifact (CSS, docs, JSON...) held in memory, with its validators and
+    its gzip/brotli encoded bodies, compressed once here rather than on every request.
+    """
+    __slots__ = ("body", "media_type", "etag", "last_modified", "encodings")
+
+    def __init__(self, body: bytes, media_type: str, last_modified: Optional[datetime.datetime] = None):
+        self.body = body
+        self.media_type = media_type
+        self.etag = make_etag(body)
+        self.last_modified = last_modified
+        self.encodings: Dict[str, bytes] = compress_variants(body, media_type)
+
+    def encoded_etag(self, encoding: Optional[str]) -> str:
+        """Each content coding is a different representation, so it gets its own strong ETag."""
+        return self.etag if encoding is None else f'{self.etag[:-1]}-{encoding}"'
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(data) for data in self.encodings.values())
+
+
+class ArtifactCache:
+    """
+    Process-level LRU cache of compiled artifacts, bounded by a byte budget.
+
+    Keys are tuples of ``(styling_id, kind, *variant)``, e.g. ``(3, "css")``,
+    so every artifact of a styling, or every artifact of a kind, can be
+    dropped in one call when something changes. An artifact built from other
+    stylings too (an inheritance listing, a bundle) is put with depends_on
+    and is dropped along with any of them.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple, CachedArtifact]" = OrderedDict()
+        self._keys_by_styling: Dict[int, set] = {}
+        self._dependencies: Dict[Tuple, Tuple[int, ...]] = {}
+        self._styling_generations: Dict[int, int] = {}
+        self._kind_generations: Dict[str, int] = {}
+        self._styling_kind_generations: Dict[Tuple[int, str], int] = {}
+        self._epoch = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple) -> Optional[CachedArtifact]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def generation(self, key: Tuple, depends_on: Iterable[int] = ()) -> Tuple:
+        """
+        Token to read *before* building an artifact and pass back to put().
+        If the styling (or the artifact kind, or one of the stylings in
+        depends_on) is invalidated while the build runs, the stale result is
+        discarded instead of being cached.
+        """
+        with self._lock:
+            return self._generation(key, tuple(depends_on))
+
+    def with_dependencies(self, generation: Tuple, depends_on: Iterable[int]) -> Tuple:
+        """
+        Extend a token read with generation(key) by the stylings the artifact turned out
+        to depend on, for builds that only learn them (e.g. from the inheritance tree)
+        after they started.
+        """
+        with self._lock:
+            return generation[:-1] + (self._dependency_generations(tuple(depends_on)),)
+
+    def put(self, key: Tuple, artifact: CachedArtifact, generation: Optional[Tuple] = None, depends_on: Iterable[int] = ()) -> bool:
+        if artifact.size > self.max_bytes:
+            return False
+        depends_on = tuple(depends_on)
+        with self._lock:
+            if generation is not None and generation != self._generation(key, depends_on):
+                return False
+            self._discard(key)
+            self._entries[key] = artifact
+            self._keys_by_styling.setdefault(key[0], set()).add(key)
+            if depends_on:
+                self._dependencies[key] = depends_on
+                for styling_id in depends_on:
+                    self._keys_by_styling.setdefault(styling_id, set()).add(key)
+            self._size += artifact.size
+            while self._size > self.max_bytes and self._entries:
+                oldest_key = next(iter(self._entries))
+                self._discard(oldest_key)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, styling_id: int, kind: Optional[str] = None) -> None:
+        """
+        Drop every cached artifact of a styling, and every artifact that depends on it.
+        With kind, drop only the styling's own artifacts of that kind.
+        """
+        with self._lock:
+            if kind is None:
+                self._styling_generations[styling_id] = self._styling_generations.get(styling_id, 0) + 1
+                keys = list(self._keys_by_styling.get(styling_id, ()))
+            else:
+                self._styling_kind_generations[(styling_id, kind)] = self._styling_kind_generations.get((styling_id, kind), 0) + 1
+                keys = [key for key in self._keys_by_styling.get(styling_id, ()) if key[0] == styling_id and key[1] == kind]
+            for key in keys:
+                self._discard(key)
+
+    def invalidate_kind(self, kind: str) -> None:
+        """Drop every cached artifact of one kind, across all stylings."""
+        with self._lock:
+            self._kind_generations[kind] = self._kind_generations.get(kind, 0) + 1
+            for key in [k for k in self._entries if k[1] == kind]:
+                self._discard(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._keys_by_styling.clear()
+            self._dependencies.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _generation(self, key: Tuple, depends_on: Tuple[int, ...] = ()) -> Tuple:
+        # Caller must hold the lock
+        return (
+            self._epoch,
+            self._styling_generations.get(key[0], 0),
+            self._kind_generations.get(key[1], 0),
+            self._styling_kind_generations.get(key[:2], 0),
+            self._dependency_generations(depends_on),
+        )
+
+    def _dependency_generations(self, depends_on: Tuple[int, ...]) -> Tuple[int, ...]:
+        # Caller must hold the lock
+        return tuple(self._styling_generations.get(styling_id, 0) for styling_id in depends_on)
+
+    def _discard(self, key: Hashable) -> None:
+        # Caller must hold the lock
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        for styling_id in (key[0], *self._dependencies.pop(key, ())):
+            keys = self._keys_by_styling.get(styling_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_styling[styling_id]
+
+
+# Shared instance used by the API
+css_cache = ArtifactCache(max_bytes=settings.CSS_CACHE_MAX_BYTES)
@@ -0,0 +1,95 @@
+# compression.py
+import gzip
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+
+from config import settings
+
+try:
+    import brotli
+except ImportError: # Pinned in requirements.txt; outside the image, only gzip is offered without it
+    brotli = None
+
+# Text formats worth compressing; images (other than SVG) are already compressed
+COMPRESSIBLE_MEDIA_TYPES = (
+    "text/",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+# Preferred first when the client accepts several equally
+SUPPORTED_ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def is_compressible(media_type: Optional[str]) -> bool:
+    return bool(media_type) and media_type.startswith(COMPRESSIBLE_MEDIA_TYPES)
+
+
+def compress_variants(body: bytes, media_type: str) -> Dict[str, bytes]:
+    """
+    Precompressed copies of an artifact body, keyed by content coding. Done once when the
+    artifact is built, at maximum compression, since it is then served many times.
+    Bodies below COMPRESSION_MIN_SIZE, and codings that do not shrink the body, are skipped.
+    """
+    if len(body) < settings.COMPRESSION_MIN_SIZE or not is_compressible(media_type):
+        return {}
+    variants = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {coding: data for coding, data in variants.items() if len(data) < len(body)}
+
+
+def negotiate_encoding(accept_encoding: Optional[str], available) -> Optional[str]:
+    """
+    Pick a content coding from the Accept-Encoding header among the available ones, or
+    None for the identity body. Highest q-value wins; ties follow SUPPORTED_ENCODINGS.
+    """
+    if not accept_encoding or not available:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+    best, best_q = None, 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if coding in available and q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class JSONResponseGZipResponder(GZipResponder):
+    async def send_with_gzip(self, message):
+        if message["type"] == "http.response.start":
+            # Anything that is not JSON (files, images, precompressed artifacts) passes through untouched
+            if not Headers(raw=message["headers"]).get("content-type", "").startswith("application/json"):
+                self.content_encoding_set = True
+                self.initial_message = message
+                return
+        await super().send_with_gzip(message)
+
+
+class JSONResponseGZipMiddleware(GZipMiddleware):
+    """
+    Gzip API responses that are built per request (JSON only) once they reach minimum_size.
+    Cached artifacts carry their own precompressed bodies and are negotiated in artifact_response.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = JSONResponseGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
@@ -1,9 +1,12 @@
 # config.py
 import os
-from pydantic import BaseSettings
+from pydantic import BaseSettings, validator
 from dotenv import load_dotenv
 from typing import Optional, List # Import Optional here
 
+# Durability policies for generated files (see Settings.FILE_FSYNC)
+FSYNC_POLICIES = ("none", "file", "full")
+
 # Load environment variables from .env file if it exists
 load_dotenv()
 
@@ -28,6 +31,56 @@ class Settings(BaseSettings):
     ASSET_DIR: str = os.getenv("ASSET_DIR", "assets")
     UPLOAD_SIZE_LIMIT: int = int(os.getenv("UPLOAD_SIZE_LIMIT", "10485760"))  # 10MB
 
+    # Compiled CSS cache (in-memory, per process). 0 disables caching.
+    CSS_CACHE_MAX_BYTES: int = int(os.getenv("CSS_CACHE_MAX_BYTES", "33554432"))  # 32MB
+
+    # Compiled design-token models kept in memory (per process), shared by the CSS, docs,
+    # export and backup emitters. 0 disables keeping them.
+    TOKEN_MODEL_CACHE_SIZE: int = int(os.getenv("TOKEN_MODEL_CACHE_SIZE", "256"))
+
+    # Default build for GET /brand/{id}/css when no ?mode= is given:
+    # "import" references the master brand with @import, "flat" merges the whole chain into one file
+    CSS_DEFAULT_MODE: str = os.getenv("CSS_DEFAULT_MODE", "import")
+
+    # Serve comment-free CSS (with a source map) when no ?minify= is given and the
+    # styling has no minify_css setting of its own
+    CSS_DEFAULT_MINIFY: bool = os.getenv("CSS_DEFAULT_MINIFY", "False").lower() == "true"
+
+    # Responses smaller than this are sent uncompressed; larger CSS/docs/JSON artifacts are
+    # stored gzip- (and, if the brotli package is installed, brotli-) compressed
+    COMPRESSION_MIN_SIZE: int = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+    # GET /brand/bundle: most stylings per request, and how each brand is isolated:
+    # a cascade layer (scope=layer) or a selector its variables and rules are nested under (scope=selector)
+    CSS_BUNDLE_MAX_STYLINGS: int = int(os.getenv("CSS_BUNDLE_MAX_STYLINGS", "50"))
+    CSS_BUNDLE_LAYER: str = os.getenv("CSS_BUNDLE_LAYER", "brand-{id}")
+    CSS_BUNDLE_SELECTOR: str = os.getenv("CSS_BUNDLE_SELECTOR", '[data-brand="{id}"]')
+
+    # Background CSS build queue: worker threads, and the window within which
+    # repeated edits to the same styling collapse into a single rebuild
+    CSS_BUILD_WORKERS: int = int(os.getenv("CSS_BUILD_WORKERS", "2"))
+    CSS_BUILD_DEBOUNCE_MS: int = int(os.getenv("CSS_BUILD_DEBOUNCE_MS", "250"))
+
+    # Generated files (style.css, docs.html, exports, backups) are written to a temp file and
+    # renamed into place, so readers never see a partial file. FILE_FSYNC sets how durable the
+    # write is before the rename: "none" (the files can always be rebuilt from the database),
+    # "file" (flush the file's data) or "full" (also flush the directory entry)
+    FILE_FSYNC: str = os.getenv("FILE_FSYNC", "none")
+
+    # Worker processes for full rebuilds (POST /system/rebuild, python -m branding_server build)
+    BUILD_WORKERS: int = int(os.getenv("BUILD_WORKERS", str(os.cpu_count() or 2)))
+
+    # Worker threads that run the (synchronous) request handlers; also caps concurrent DB sessions
+    WORKER_THREADS: int = int(os.getenv("WORKER_THREADS", "40"))
+
+    # Responsive image derivatives generated after upload (process pool, off the request path)
+    IMAGE_WORKERS: int = int(os.getenv("IMAGE_WORKERS", "2"))
+    IMAGE_DERIVATIVE_WIDTHS: list = [int(w) for w in os.getenv("IMAGE_DERIVATIVE_WIDTHS", "320,640,1280").split(",") if w.strip()]
+
+    # Inline placeholders are rendered during the upload request, which decodes the image
+    # (JPEGs at up to 1/8 scale). Larger images are stored without a placeholder.
+    PLACEHOLDER_MAX_PIXELS: int = int(os.getenv("PLACEHOLDER_MAX_PIXELS", "16777216"))  # 4096 x 4096
+
     # Security settings
     API_KEY_REQUIRED: bool = os.getenv("API_KEY_REQUIRED", "False").lower() == "true"
     API_KEY: str = os.getenv("API_KEY", "")
@@ -80,6 +133,13 @@ class Settings(BaseSettings):
     BASE_URL: Optional[str] = os.getenv("BASE_URL", None)
 
 
+    @validator("FILE_FSYNC")
+    def check_file_fsync(cls, value):
+        # Fail at startup: rejected at write time, a typo would only disable the on-disk copies
+        if value not in FSYNC_POLICIES:
+            raise ValueError(f"must be one of {', '.join(FSYNC_POLICIES)}, got '{value}'")
+        return value
+
     class Config:
         env_file = ".env"
         case_sensitive = True
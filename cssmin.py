@@ -0,0 +1,103 @@
+# cssmin.py
+import json
+import re
+from typing import List, Tuple
+
+# Comments, strings and whitespace runs; everything else is copied through
+CSS_TOKEN_RE = re.compile(r"""/\*.*?\*/|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|\s+""", re.DOTALL)
+ASSET_MARKER_RE = re.compile(r"/\*@asset:(\d+)\*/")
+
+# Whitespace next to these characters never matters. ":" only sheds the space after it,
+# since "a :hover" and "a:hover" are different selectors; "+", "-" and ">" are left alone
+# because of calc() and combinators.
+NO_SPACE_AROUND = set("{};,")
+NO_SPACE_BEFORE = NO_SPACE_AROUND | {"!", ")"}
+NO_SPACE_AFTER = NO_SPACE_AROUND | {":", "("}
+
+BASE64_DIGITS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+
+def minify_css(css: str) -> Tuple[str, List[Tuple[int, int]]]:
+    """
+    Strip comments and redundant whitespace from compiled CSS. The output is a single line.
+    Returns (minified CSS, [(output column, asset ID)]) where each pair records where the
+    declaration following an ASSET_MARKER starts (render_css(..., annotate=True)).
+    """
+    out: List[str] = []
+    length = 0
+    positions: List[Tuple[int, int]] = []
+    pending_space = False
+    position = 0
+
+    def emit(text: str, is_string: bool = False):
+        nonlocal length, pending_space
+        if not is_string:
+            text = text.replace(";}", "}")
+            if text[0] == "}" and out and out[-1][-1] == ";":
+                out[-1] = out[-1][:-1] # The last declaration in a block needs no ";"
+                length -= 1
+        if pending_space and out and out[-1][-1:] not in NO_SPACE_AFTER and text[0] not in NO_SPACE_BEFORE:
+            out.append(" ")
+            length += 1
+        pending_space = False
+        out.append(text)
+        length += len(text)
+
+    for match in CSS_TOKEN_RE.finditer(css):
+        if match.start() > position:
+            emit(css[position:match.start()])
+        token = match.group(0)
+        if token.startswith("/*"):
+            marker = ASSET_MARKER_RE.fullmatch(token)
+            if marker:
+                # The declaration starts after any space that emit() may still insert
+                column = length + (1 if pending_space and out and out[-1][-1:] not in NO_SPACE_AFTER else 0)
+                positions.append((column, int(marker.group(1))))
+            elif out:
+                pending_space = True # A comment separates tokens like whitespace does
+        elif token[0] in "\"'":
+            emit(token, is_string=True)
+        else:
+            pending_space = bool(out)
+        position = match.end()
+    if position < len(css):
+        emit(css[position:])
+
+    return "".join(out), positions
+
+
+def _vlq(value: int) -> str:
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    encoded = ""
+    while True:
+        digit = value & 31
+        value >>= 5
+        encoded += BASE64_DIGITS[digit | (32 if value else 0)]
+        if not value:
+            return encoded
+
+
+def build_source_map(file_name: str, positions: List[Tuple[int, int]], source_root: str) -> str:
+    """
+    Source map (v3) for a single-line minified stylesheet. Every declaration maps back to
+    a "source" named after its asset ({source_root}/{asset_id}), so dev tools show which
+    asset a rule came from.
+    """
+    sources: List[str] = []
+    source_index = {}
+    segments = []
+    previous_column = previous_source = 0
+    for column, asset_id in positions:
+        if asset_id not in source_index:
+            source_index[asset_id] = len(sources)
+            sources.append(f"{source_root}/{asset_id}")
+        index = source_index[asset_id]
+        segments.append(_vlq(column - previous_column) + _vlq(index - previous_source) + "AA")
+        previous_column, previous_source = column, index
+    return json.dumps({
+        "version": 3,
+        "file": file_name,
+        "sources": sources,
+        "names": [],
+        "mappings": ",".join(segments),
+    })
@@ -0,0 +1,316 @@
+# docs.py
+import datetime
+import os
+import re
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from cache import css_cache, CachedArtifact
+from config import CONTAINER_ASSET_DIR_ABS
+from models import Site, StyleAsset
+from tokens import compile_tokens
+from utils import responsive_image_sources, write_file_atomic
+
+
+def render_image_preview_html(asset: StyleAsset, image_src: str) -> str:
+    """
+    <img> for the docs page. For uploaded images it carries the intrinsic size (so the page
+    lays out before the image arrives), shows the inline placeholder until the lazy-loaded
+    original replaces it, and is wrapped in a WebP-first <picture> when derivatives exist.
+    """
+    if image_src != asset.value or not asset.file_path:
+        return f'<img src="{image_src}" alt="{asset.name}">'
+    attributes = ' loading="lazy" decoding="async"'
+    if asset.image_width and asset.image_height:
+        attributes += f' width="{asset.image_width}" height="{asset.image_height}"'
+    if asset.placeholder:
+        attributes += f' style="background: url({asset.placeholder}) center / contain no-repeat;"'
+    sources = responsive_image_sources(asset)
+    if not sources:
+        return f'<img src="{image_src}" alt="{asset.name}"{attributes}>'
+    sizes = "(max-width: 600px) 100vw, 300px"
+    webp_source = f'<source type="image/webp" srcset="{sources["srcsets"]["webp"]}" sizes="{sizes}">' if "webp" in sources["srcsets"] else ""
+    source_format = next((fmt for fmt in sources["srcsets"] if fmt != "webp"), None)
+    img_srcset = f' srcset="{sources["srcsets"][source_format]}" sizes="{sizes}"' if source_format else ""
+    return f'<picture>{webp_source}<img src="{image_src}"{img_srcset} alt="{asset.name}"{attributes}></picture>'
+
+def render_variants_html(asset: StyleAsset, asset_type: str) -> str:
+    """Helper function to render an asset's variants as an HTML list."""
+    if not asset.variants:
+        return ""
+    
+    sorted_variants = sorted(asset.variants, key=lambda v: v.breakpoint)
+    
+    variants_html = '<div class="variants-info"><strong>Variants:</strong><ul>'
+    for variant in sorted_variants:
+        important_tag = " !important" if variant.is_important else ""
+        
+        # If the parent asset is a color, add a swatch for the variant
+        if asset_type == 'color':
+            swatch_html = f'<span class="variant-swatch" style="background-color:{variant.value};"></span>'
+            variants_html += f'<li>{swatch_html}<em>{variant.breakpoint}:</em> <code>{variant.value}{important_tag}</code></li>'
+        else:
+            # For other types, just show the text
+            variants_html += f'<li><em>{variant.breakpoint}:</em> <code>{variant.value}{important_tag}</code></li>'
+            
+    variants_html += '</ul></div>'
+    return variants_html
+
+def resolve_css_var(value: str, asset_map: Dict[str, str], visited: Optional[set] = None) -> Optional[str]:
+    """Recursively resolves a CSS variable (e.g., var(--my-var)) to its final value."""
+    if visited is None:
+        visited = set()
+
+    # Regex to find a var() reference
+    var_match = re.match(r'^\s*var\((--[a-zA-Z0-9-_]+)\)\s*$', value.strip())
+    
+    if not var_match:
+        return value  # Not a variable or malformed, return the original value
+
+    var_name = var_match.group(1)
+    
+    # Check for circular references
+    if var_name in visited:
+        print(f"Warning: Circular reference detected for variable {var_name}")
+        return None 
+    
+    visited.add(var_name)
+    
+    next_value = asset_map.get(var_name)
+    
+    if next_value is None:
+        print(f"Warning: Variable {var_name} not found in asset map during resolution.")
+        return None
+
+    # Recursively resolve the next value in the chain
+    return resolve_css_var(next_value, asset_map, visited)
+
+
+def compile_docs(styling_id: int, base_url: str, db: Session) -> CachedArtifact:
+    """
+    Render a styling's HTML style guide, save it as brands/{id}/docs.html and cache it.
+    The page embeds absolute URLs, so it is cached per base URL.
+    """
+    cache_key = (styling_id, "docs", base_url)
+    generation = css_cache.generation(cache_key)
+    html, updated_at = render_docs(styling_id, base_url, db)
+
+    docs_path = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id), "docs.html")
+
+    try:
+        write_file_atomic(docs_path, html)
+    except Exception as e:
+         print(f"Error saving documentation file for styling {styling_id}: {e}")
+         raise HTTPException(status_code=500, detail="Failed to generate documentation file.")
+
+    artifact = CachedArtifact(html.encode("utf-8"), "text/html", updated_at)
+    css_cache.put(cache_key, artifact, generation=generation)
+    return artifact
+
+
+def render_docs(styling_id: int, base_url: str, db: Session) -> Tuple[str, Optional[datetime.datetime]]:
+    """The style guide page of a styling and the time anything in its inheritance chain last changed."""
+    model = compile_tokens(styling_id, db)
+    if model is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+    db_styling = model.styling
+
+    site = db.query(Site).filter(Site.id == db_styling.site_id).first()
+    if site is None:
+         raise HTTPException(status_code=404, detail="Associated site not found.")
+
+    assets = model.tokens
+    # var() references resolve against the whole chain, so values inherited from a master work too
+    asset_map = {name: token.value for name, token in model.variables.items() if name.startswith('--')}
+
+    # Group assets
+    colors = [a for a in assets if a.type == "color"]
+    images = [a for a in assets if a.type == "image"]
+    dimensions = [a for a in assets if a.type == "dimension"]
+    fonts = [a for a in assets if a.type == "font"]
+    selector_assets = [a for a in assets if a.type in ["css_declaration", "class_rule"]]
+    grouped_selectors = defaultdict(list)
+    for asset in selector_assets:
+        selector_key = asset.selector if asset.type == "css_declaration" and asset.selector else asset.name
+        grouped_selectors[selector_key].append(asset)
+    variable_types = ["color", "image", "dimension", "font", "css_declaration", "class_rule"]
+    other = [a for a in assets if a.type not in variable_types]
+
+    html = f"""
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>{db_styling.name} - Style Guide</title>
+        <link rel="stylesheet" href="/brand/{styling_id}/css">
+        <style>
+            body {{ font-family: system-ui, -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, 'Open Sans', 'Helvetica Neue', sans-serif; margin: 0; padding: 2rem; line-height: 1.6; background-color: #fdfdfd; color: #333; }}
+            h1, h2, h3 {{ margin-top: 2.5em; border-bottom: 1px solid #eee; padding-bottom: 8px; font-weight: 600; }}
+            h2 {{ font-size: 1.8em; }} h3 {{ font-size: 1.4em; border-bottom-style: dashed; }}
+            .container {{ max-width: 1200px; margin: 0 auto; }}
+            .header {{ border-bottom: 1px solid #ddd; padding-bottom: 20px; margin-bottom: 40px; text-align: center; }}
+            .grid {{ display: grid; grid-template-columns: repeat(auto-fill, minmax(220px, 1fr)); gap: 25px; }}
+            .item {{ border-radius: 8px; overflow: hidden; box-shadow: 0 4px 12px rgba(0,0,0,0.07); background: white; transition: transform 0.2s ease-in-out; }}
+            .item:hover {{ transform: translateY(-3px); }}
+            .preview {{ height: 120px; display: flex; align-items: center; justify-content: center; background-color: #f5f5f5; border-bottom: 1px solid #eee; }}
+            .preview img {{ max-width: 100%; max-height: 120px; object-fit: contain; }}
+            .info {{ padding: 15px; }}
+            .info p {{ margin: 5px 0; color: #666; font-size: 0.9em;}}
+            table {{ width: 100%; border-collapse: collapse; margin: 20px 0; background: white; box-shadow: 0 4px 12px rgba(0,0,0,0.07); border-radius: 8px; overflow: hidden;}}
+            table th, table td {{ text-align: left; padding: 14px; border-bottom: 1px solid #f0f0f0; }}
+            table tr:last-child td {{ border-bottom: none; }}
+            table th {{ background-color: #f9f9f9; font-weight: 600; }}
+            .asset-value code {{ background-color: #eef; color: #55d; padding: 3px 6px; border-radius: 4px; font-size: 0.95em;}}
+            .variants-info {{ margin-top: 12px; padding-top: 12px; border-top: 1px dashed #ccc; }}
+            .variants-info ul {{ margin: 8px 0 0 0; padding-left: 0; list-style-type: none; font-size: 0.9em; color: #555; }}
+            .variants-info li {{ margin-bottom: 6px; display: flex; align-items: center; }}
+            .variants-info em {{ margin-right: 5px; min-width: 70px; display: inline-block; text-align: right; }}
+            .variant-swatch {{ display: inline-block; width: 14px; height: 14px; border-radius: 4px; border: 1px solid rgba(0,0,0,0.15); margin-right: 8px; flex-shrink: 0; }}
+            .selector-block {{ margin-bottom: 3em; }}
+            code {{ font-family: 'SF Mono', 'Fira Code', 'Consolas', 'Courier New', monospace; }}
+            pre > code {{ display: block; background-color: #2d2d2d; color: #f1f1f1; padding: 15px; border-radius: 4px; white-space: pre-wrap; }}
+            
+            /* --- STYLES FOR THE NEW PDF BUTTON --- */
+            .print-button {{
+                display: inline-block;
+                margin: 1rem 0;
+                padding: 8px 16px;
+                border: 1px solid #ccc;
+                border-radius: 5px;
+                background-color: #f0f0f0;
+                cursor: pointer;
+                font-size: 0.9em;
+                font-weight: 500;
+            }}
+            .print-button:hover {{
+                background-color: #e0e0e0;
+                border-color: #bbb;
+            }}
+            /* --- HIDE BUTTON AND OTHER UI ELEMENTS FOR PRINTING --- */
+            @media print {{
+                body {{ padding: 1cm; }}
+                .print-button, #css-import-section {{
+                    display: none !important;
+                }}
+                .item, table {{
+                    page-break-inside: avoid;
+                }}
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="header">
+                <h1>{db_styling.name} - Style Guide</h1>
+                <p>Site: {site.name}</p>
+                <p>{db_styling.description or ""}</p>
+                <button onclick="window.print()" class="print-button">Download as PDF</button>
+            </div>
+    """
+
+    if colors:
+        html += '<h2>Colors</h2><div class="grid">'
+        for color in sorted(colors, key=lambda x: x.name):
+            html += f"""
+                    <div class="item">
+                        <div class="preview" style="background-color: {color.value};"></div>
+                        <div class="info">
+                            <strong>{color.name}</strong><br>
+                            <code>{color.value}</code>
+                            <p>{color.description or ""}</p>
+                            {render_variants_html(color, color.type)}
+                        </div>
+                    </div>"""
+        html += "</div>"
+    
+    if images:
+        html += '<h2>Images</h2><div class="grid">'
+        for image in sorted(images, key=lambda x: x.name):
+            resolved_value = resolve_css_var(image.value, asset_map)
+            if resolved_value:
+                image_src = resolved_value.strip()
+                if image_src.lower().startswith('url(') and image_src.endswith(')'):
+                    image_src = image_src[4:-1].strip().strip('\'"')
+                
+                html += f"""
+                        <div class="item">
+                            <div class="preview">{render_image_preview_html(image, image_src)}</div>
+                            <div class="info">
+                                <strong>{image.name}</strong><br>
+                                <code>{image.value}</code>
+                                <p>{image.description or ""}</p>
+                                {render_variants_html(image, image.type)}
+                            </div>
+                        </div>"""
+        html += "</div>"
+
+    if dimensions:
+        html += "<h2>Dimensions</h2><table><thead><tr><th>Name</th><th>Value</th><th>Description</th></tr></thead><tbody>"
+        for dim in sorted(dimensions, key=lambda x: x.name):
+            html += f"""
+                    <tr>
+                        <td>{dim.name}</td>
+                        <td class="asset-value"><code>{dim.value}</code>{render_variants_html(dim, dim.type)}</td>
+                        <td>{dim.description or ""}</td>
+                    </tr>"""
+        html += "</tbody></table>"
+
+    if fonts:
+        html += "<h2>Fonts</h2><table><thead><tr><th>Name</th><th>Value</th><th>Description</th></tr></thead><tbody>"
+        for font in sorted(fonts, key=lambda x: x.name):
+            html += f"""
+                    <tr>
+                        <td>{font.name}</td>
+                        <td class="asset-value"><code>{font.value}</code>{render_variants_html(font, font.type)}</td>
+                        <td>{font.description or ""}</td>
+                    </tr>"""
+        html += "</tbody></table>"
+    
+    if grouped_selectors:
+        html += "<h2>Selectors</h2>"
+        for selector, declarations in sorted(grouped_selectors.items()):
+            html += f"<div class='selector-block'><h3><code>{selector}</code></h3>"
+            if len(declarations) == 1 and declarations[0].type == 'class_rule':
+                html += f"<pre><code>{declarations[0].value}</code></pre>"
+            else:
+                html += "<table><thead><tr><th>Property</th><th>Value</th><th>Description</th></tr></thead><tbody>"
+                for decl in sorted(declarations, key=lambda d: d.name):
+                    html += f"""
+                        <tr>
+                            <td>{decl.name}</td>
+                            <td class="asset-value"><code>{decl.value}</code>{render_variants_html(decl, decl.type)}</td>
+                            <td>{decl.description or ""}</td>
+                        </tr>"""
+                html += "</tbody></table>"
+            html += "</div>"
+    
+    if other:
+        html += "<h2>Other Variables</h2><table><thead><tr><th>Name</th><th>Type</th><th>Value</th><th>Description</th></tr></thead><tbody>"
+        for var in sorted(other, key=lambda x: x.name):
+            html += f"""
+                    <tr>
+                        <td>{var.name}</td>
+                        <td>{var.type}</td>
+                        <td class="asset-value"><code>{var.value}</code>{render_variants_html(var, var.type)}</td>
+                        <td>{var.description or ""}</td>
+                    </tr>"""
+        html += "</tbody></table>"
+
+    full_css_url = f"{base_url.rstrip('/')}/brand/{styling_id}/css"
+    html += f"""
+            <div id="css-import-section">
+                <h2>CSS Import</h2>
+                <p>Use the following snippet to include these styles in your project:</p>
+                <pre><code id="css-import-code">@import url('{full_css_url}');</code></pre>
+                <p>Or via a link tag:</p>
+                <pre><code id="css-link-code">&lt;link rel="stylesheet" href="{full_css_url}"&gt;</code></pre>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+    return html, model.updated_at
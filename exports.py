@@ -0,0 +1,347 @@
+# exports.py
+import io
+import json
+import os
+import re
+import zipfile
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from cache import css_cache, CachedArtifact
+from config import settings, CONTAINER_ASSET_DIR_ABS
+from tokens import compile_tokens, TokenModel, VARIABLE, DECLARATION, LEGACY_RULE
+from utils import write_file_atomic
+
+# Formats made of several files are delivered as a zip archive
+ARCHIVE_MEDIA_TYPE = "application/zip"
+
+# 1 rem/em in CSS pixels, which map 1:1 to Android dp and iOS points
+ROOT_FONT_SIZE = 16
+
+
+def emit_json_export(model: TokenModel) -> Iterator[str]:
+    export_data = {
+        "brand": {
+            "id": model.styling.id,
+            "name": model.styling.name,
+            "site_id": model.styling.site_id
+        },
+        "assets": [
+            {
+                "name": asset.name,
+                "type": asset.type,
+                "value": asset.value,
+                "description": asset.description
+                # file_path is internal, no need to export
+            }
+            for asset in model.tokens
+        ]
+    }
+    return json.JSONEncoder(indent=2).iterencode(export_data)
+
+
+def scss_variable_name(name: str) -> str:
+    """--brand-primary -> $brand-primary"""
+    return "$" + (name[2:] if name.startswith("--") else name)
+
+
+def emit_scss_export(model: TokenModel) -> Iterator[str]:
+    yield "// SCSS Variables for " + model.styling.name + "\n\n"
+    rules = {}
+    for asset in model.tokens:
+        if asset.kind == VARIABLE:
+            yield f"{scss_variable_name(asset.name)}: {asset.value};\n"
+        elif asset.kind == DECLARATION:
+            # Declarations are properties of a selector, not variables: emit them as rule blocks
+            important_suffix = " !important" if asset.is_important else ""
+            rules.setdefault(asset.selector, []).append(f"  {asset.name}: {asset.value}{important_suffix};")
+        elif asset.kind == LEGACY_RULE:
+            rules.setdefault(asset.name, []).append(f"  /* LEGACY RULE STRING: {(asset.value or '').strip()} */")
+    if rules:
+        yield "\n// Selectors & Rules\n"
+        for selector, declarations in sorted(rules.items()):
+            yield f"{selector} {{\n" + "\n".join(declarations) + "\n}\n"
+
+
+# Mobile exports: an app has no @import, so they carry the whole flattened chain with
+# var() references resolved. Values a platform cannot express (gradients, calc(), % ...)
+# are left out.
+
+HEX_COLOR_RE = re.compile(r"^#([0-9a-fA-F]{3,4}|[0-9a-fA-F]{6}|[0-9a-fA-F]{8})$")
+RGB_COLOR_RE = re.compile(r"^rgba?\(\s*([^)]*)\)$", re.IGNORECASE)
+NAMED_COLORS = {"black": (0, 0, 0, 255), "white": (255, 255, 255, 255), "transparent": (0, 0, 0, 0)}
+LENGTH_RE = re.compile(r"^(-?\d*\.?\d+)(px|dp|dip|pt|rem|em)?$", re.IGNORECASE)
+
+
+def parse_css_color(value: str) -> Optional[Tuple[int, int, int, int]]:
+    """(red, green, blue, alpha) in 0-255 for hex, rgb()/rgba() and a few named colors; None otherwise."""
+    value = value.strip()
+    if value.lower() in NAMED_COLORS:
+        return NAMED_COLORS[value.lower()]
+    match = HEX_COLOR_RE.match(value)
+    if match:
+        digits = match.group(1)
+        if len(digits) <= 4:
+            digits = "".join(d * 2 for d in digits)
+        channels = [int(digits[i:i + 2], 16) for i in range(0, len(digits), 2)]
+        return tuple(channels) if len(channels) == 4 else (*channels, 255)
+    match = RGB_COLOR_RE.match(value)
+    if not match:
+        return None
+    parts = [p for p in re.split(r"[\s,/]+", match.group(1).strip()) if p]
+    if len(parts) not in (3, 4):
+        return None
+    try:
+        rgb = [round(float(p[:-1]) * 2.55) if p.endswith("%") else round(float(p)) for p in parts[:3]]
+        alpha = 255
+        if len(parts) == 4:
+            alpha = round(float(parts[3][:-1]) * 2.55) if parts[3].endswith("%") else round(float(parts[3]) * 255)
+    except ValueError:
+        return None
+    return tuple(min(max(c, 0), 255) for c in (*rgb, alpha))
+
+
+def parse_css_length(value: str) -> Optional[Tuple[float, str]]:
+    """(number, unit) with unit "dp" (px, dp, rem/em at ROOT_FONT_SIZE) or "pt"; None for anything else."""
+    match = LENGTH_RE.match(value.strip())
+    if not match:
+        return None
+    number, unit = float(match.group(1)), (match.group(2) or "").lower()
+    if unit == "" and number != 0:
+        return None # Unitless numbers (line heights, weights...) are not lengths
+    if unit in ("rem", "em"):
+        return number * ROOT_FONT_SIZE, "dp"
+    return number, "pt" if unit == "pt" else "dp"
+
+
+def format_number(number: float) -> str:
+    return f"{number:g}"
+
+
+def mobile_tokens(model: TokenModel, types: Tuple[str, ...]):
+    """The winning variables of the given types with their resolved values, in ID order."""
+    for token in model.winners:
+        if token.kind == VARIABLE and token.type in types:
+            yield token, model.resolve(token.value)
+
+
+def android_resource_name(name: str) -> str:
+    """--brand-primary -> brand_primary (lowercase letters, digits and _, starting with a letter)."""
+    resource_name = re.sub(r"[^a-z0-9_]+", "_", name.lower()).strip("_") or "token"
+    return resource_name if resource_name[0].isalpha() else "token_" + resource_name
+
+
+def emit_android_values(model: TokenModel, types: Tuple[str, ...], element: str, convert) -> Iterator[str]:
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield f"<!-- Brand styling {model.styling.id}, revision {model.styling.revision}. Generated; do not edit. -->\n"
+    yield "<resources>\n"
+    seen = set()
+    for token, value in mobile_tokens(model, types):
+        resource_name = android_resource_name(token.name)
+        converted = convert(value) if value is not None else None
+        if resource_name in seen or converted is None:
+            # XML comments cannot contain "--", so the note names the resource, not the variable
+            reason = "duplicate name" if resource_name in seen else f"not a plain {element}"
+            yield f"    <!-- skipped {resource_name}: {reason} -->\n"
+            continue
+        seen.add(resource_name)
+        yield f'    <{element} name="{resource_name}">{converted}</{element}>\n'
+    yield "</resources>\n"
+
+
+def android_color(value: str) -> Optional[str]:
+    rgba = parse_css_color(value)
+    if rgba is None:
+        return None
+    red, green, blue, alpha = rgba
+    return f"#{red:02X}{green:02X}{blue:02X}" if alpha == 255 else f"#{alpha:02X}{red:02X}{green:02X}{blue:02X}"
+
+
+def android_dimension(value: str) -> Optional[str]:
+    length = parse_css_length(value)
+    return f"{format_number(length[0])}{length[1]}" if length else None
+
+
+def emit_android_export(model: TokenModel) -> Iterator[bytes]:
+    """res/values/colors.xml and dimens.xml, zipped."""
+    return emit_archive([
+        ("res/values/colors.xml", emit_android_values(model, ("color",), "color", android_color)),
+        ("res/values/dimens.xml", emit_android_values(model, ("dimension", "spacing"), "dimen", android_dimension)),
+    ])
+
+
+SWIFT_KEYWORDS = {"class", "default", "enum", "extension", "func", "import", "in", "internal", "is", "let",
+                  "private", "protocol", "public", "return", "self", "static", "struct", "switch", "var", "where"}
+
+
+def swift_identifier(name: str) -> str:
+    """--brand-primary -> brandPrimary"""
+    words = [w for w in re.split(r"[^A-Za-z0-9]+", name) if w] or ["token"]
+    identifier = words[0][0].lower() + words[0][1:] + "".join(w[0].upper() + w[1:] for w in words[1:])
+    if identifier[0].isdigit():
+        identifier = "_" + identifier
+    return f"`{identifier}`" if identifier in SWIFT_KEYWORDS else identifier
+
+
+def ios_color_name(name: str) -> str:
+    """Name of a color in the asset catalog (and of its .colorset folder)."""
+    return re.sub(r"[^\w\-]+", "_", name.lstrip("-")) or "token"
+
+
+def ios_colorset(rgba: Tuple[int, int, int, int]) -> str:
+    red, green, blue, alpha = rgba
+    return json.dumps({
+        "colors": [{
+            "color": {
+                "color-space": "srgb",
+                "components": {"red": f"0x{red:02X}", "green": f"0x{green:02X}", "blue": f"0x{blue:02X}", "alpha": f"{alpha / 255:.3f}"},
+            },
+            "idiom": "universal",
+        }],
+        "info": {"author": "xcode", "version": 1},
+    }, indent=2)
+
+
+def ios_colors(model: TokenModel):
+    """[(token, asset catalog name, rgba)] of the colors iOS can express, the first of each name only."""
+    colors, seen = [], set()
+    for token, value in mobile_tokens(model, ("color",)):
+        rgba = parse_css_color(value) if value is not None else None
+        color_name = ios_color_name(token.name)
+        if rgba is not None and color_name not in seen:
+            seen.add(color_name)
+            colors.append((token, color_name, rgba))
+    return colors
+
+
+def emit_swift_tokens(model: TokenModel, colors) -> Iterator[str]:
+    yield "// BrandTokens.swift\n"
+    yield f"// Brand styling {model.styling.id}, revision {model.styling.revision}. Generated; do not edit.\n"
+    yield "import SwiftUI\n\npublic enum BrandTokens {\n"
+    yield "    /// Colors from BrandTokens.xcassets\n    public enum Colors {\n"
+    for token, color_name, _ in colors:
+        yield f"        /// {token.name}\n"
+        yield f'        public static let {swift_identifier(token.name)} = Color("{color_name}")\n'
+    yield "    }\n\n    /// Lengths in points\n    public enum Dimensions {\n"
+    seen = set()
+    for token, value in mobile_tokens(model, ("dimension", "spacing")):
+        length = parse_css_length(value) if value is not None else None
+        identifier = swift_identifier(token.name)
+        if length is None or identifier in seen:
+            continue
+        seen.add(identifier)
+        yield f"        /// {token.name}: {' '.join(token.value.split())}\n"
+        yield f"        public static let {identifier}: CGFloat = {format_number(length[0])}\n"
+    yield "    }\n}\n"
+
+
+def emit_ios_export(model: TokenModel) -> Iterator[bytes]:
+    """BrandTokens.xcassets (one colorset per color) and BrandTokens.swift, zipped."""
+    colors = ios_colors(model)
+    catalog_info = json.dumps({"info": {"author": "xcode", "version": 1}}, indent=2)
+    members = [("BrandTokens.xcassets/Contents.json", [catalog_info])]
+    members += [(f"BrandTokens.xcassets/{color_name}.colorset/Contents.json", [ios_colorset(rgba)]) for _, color_name, rgba in colors]
+    members.append(("BrandTokens.swift", emit_swift_tokens(model, colors)))
+    return emit_archive(members)
+
+
+class ArchiveStream(io.RawIOBase):
+    """Write-only, unseekable sink for zipfile that hands back what has been written so far."""
+
+    def __init__(self):
+        self.pending = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.pending.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.pending)
+        self.pending.clear()
+        return data
+
+
+def emit_archive(members: Iterable[Tuple[str, Iterable[str]]]) -> Iterator[bytes]:
+    """
+    Zip the given (path, text chunks) members as they are produced. Timestamps are fixed,
+    so the same tokens always give the same bytes.
+    """
+    stream = ArchiveStream()
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for path, chunks in members:
+            info = zipfile.ZipInfo(path, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, "w") as member:
+                for chunk in chunks:
+                    member.write(chunk.encode("utf-8"))
+            yield stream.drain()
+    yield stream.drain()
+
+
+# format -> (emitter(token model) yielding str or bytes chunks, file name suffix, media type)
+EXPORTERS = {
+    "json": (emit_json_export, "_export.json", "application/json"),
+    "scss": (emit_scss_export, "_variables.scss", "text/plain"),
+    "android": (emit_android_export, "_android.zip", ARCHIVE_MEDIA_TYPE),
+    "ios": (emit_ios_export, "_ios.zip", ARCHIVE_MEDIA_TYPE),
+}
+
+
+def encode_chunks(chunks: Iterable[Union[str, bytes]]) -> bytes:
+    return b"".join(chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in chunks)
+
+
+def compile_export(styling_id: int, format: str, db: Session) -> Tuple[Tuple, CachedArtifact, str]:
+    """
+    A styling's export in the given format at its current revision: from the artifact cache,
+    or rendered from the token model and cached. Nothing is written to disk, so concurrent
+    exports (or brands whose names sanitize alike) cannot clobber each other.
+    Returns (cache key, artifact, download file name).
+    """
+    model = compile_tokens(styling_id, db)
+    if model is None:
+        raise HTTPException(status_code=404, detail="Brand styling not found")
+
+    if format not in settings.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Export format '{format}' not supported. Supported formats: {', '.join(settings.EXPORT_FORMATS)}")
+    if format not in EXPORTERS:
+        raise HTTPException(status_code=400, detail=f"Export format '{format}' not supported.")
+
+    emit, suffix, media_type = EXPORTERS[format]
+    # Sanitize styling name for filename
+    file_name = re.sub(r'[^\w\-_\.]', '_', model.styling.name) + suffix
+    # Keyed by the revisions of the whole chain: the mobile formats are flattened
+    cache_key = (styling_id, "export", format, model.revisions)
+    artifact = css_cache.get(cache_key)
+    if artifact is None:
+        generation = css_cache.generation(cache_key)
+        artifact = CachedArtifact(encode_chunks(emit(model)), media_type, model.updated_at)
+        css_cache.put(cache_key, artifact, generation=generation)
+    return cache_key, artifact, file_name
+
+
+def save_export(cache_key: Tuple, artifact: CachedArtifact, file_name: str) -> str:
+    """
+    Write a disk copy of an export from compile_export() as exports/{styling_id}/{revision}/{file_name}.
+    Returns its path relative to the asset directory.
+    """
+    styling_id, _, _, revisions = cache_key
+    revision = revisions[-1][1]
+    relative_path = os.path.join("exports", str(styling_id), str(revision), file_name)
+    try:
+        write_file_atomic(os.path.join(CONTAINER_ASSET_DIR_ABS, relative_path), artifact.body)
+    except Exception as e:
+        print(f"Error saving export {file_name} for styling {styling_id}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to save export.")
+    return relative_path
+
+
+def render_export(styling_id: int, format: str, db: Session) -> Tuple[bytes, str, str]:
+    """A styling's export in the given format: (content, file name, media type)."""
+    _, artifact, file_name = compile_export(styling_id, format, db)
+    return artifact.body, file_name, artifact.media_type
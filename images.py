@@ -0,0 +1,155 @@
+# images.py
+import base64
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional, Sequence
+
+from config import settings, CONTAINER_ASSET_DIR_ABS
+
+# Raster formats we resize/re-encode; SVG is already resolution-independent and GIF may be animated
+DERIVATIVE_SOURCE_FORMATS = {".png": "png", ".jpg": "jpeg", ".webp": "webp"}
+FORMAT_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+FORMAT_MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+SAVE_OPTIONS = {
+    "png": {"optimize": True},
+    "jpeg": {"quality": 82, "optimize": True, "progressive": True},
+    "webp": {"quality": 80, "method": 4},
+}
+
+# Longest side of the inline placeholder; browsers upscale it into a soft blur
+PLACEHOLDER_SIZE = 16
+
+
+def render_placeholder(image, max_pixels: int) -> Optional[str]:
+    """
+    A tiny WebP of the image as a data: URI (a few hundred bytes), to show while the original loads.
+    Rendered during the upload request, so the decode is bounded: JPEGs are decoded at a reduced
+    scale, other formats in full, and None is returned if that is more than max_pixels.
+    """
+    image.draft("RGB", (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE)) # No-op unless the image is a not yet loaded JPEG
+    width, height = image.size # The size that will be decoded, after draft()
+    if width * height > max_pixels:
+        return None
+    thumbnail = image.copy() if image.mode in ("RGB", "RGBA", "L") else image.convert("RGBA")
+    thumbnail.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="WEBP", quality=40)
+    return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def process_image(source_path: str, widths: Sequence[int]) -> dict:
+    """
+    Write resized copies of an image (in its own format and as WebP) next to it, as
+    {stem}-{width}w{ext}, plus a full-size WebP. Runs in a worker process. Files that
+    already exist (the same blob processed for another asset) are reused.
+    Returns [(width, format, absolute path)].
+    """
+    from PIL import Image
+
+    stem, extension = os.path.splitext(source_path)
+    source_format = DERIVATIVE_SOURCE_FORMATS[extension]
+    results = []
+    with Image.open(source_path) as image:
+        image.load()
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA") # Palette/CMYK/16-bit: resample in a full-colour mode
+        source_width, source_height = image.size
+        targets = [(w, fmt) for w in sorted(set(widths)) if w < source_width for fmt in dict.fromkeys((source_format, "webp"))]
+        if source_format != "webp":
+            targets.append((source_width, "webp"))
+
+        for width, fmt in targets:
+            path = f"{stem}-{width}w{FORMAT_EXTENSIONS[fmt]}"
+            if not os.path.exists(path):
+                height = max(1, round(source_height * width / source_width))
+                resized = image if width == source_width else image.resize((width, height), Image.LANCZOS)
+                if fmt == "jpeg" and resized.mode not in ("RGB", "L"):
+                    resized = resized.convert("RGB")
+                with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".derivative-", delete=False) as tmp:
+                    resized.save(tmp, format=fmt.upper(), **SAVE_OPTIONS[fmt])
+                os.replace(tmp.name, path)
+            results.append((width, fmt, path))
+    return results
+
+
+class DerivativePipeline:
+    """
+    Generates responsive derivatives of uploaded images in a process pool, then records
+    them against the StyleAsset and queues a CSS rebuild. Nothing here runs on the
+    request thread: submit() only hands the work to the pool.
+    """
+
+    def __init__(self, max_workers: int, widths: Sequence[int]):
+        self._max_workers = max_workers
+        self._widths = tuple(widths)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def submit(self, asset_id: int, file_path: Optional[str]) -> None:
+        """Queue derivative generation for an asset's uploaded file (a path relative to the asset dir)."""
+        if not file_path or os.path.splitext(file_path)[1] not in DERIVATIVE_SOURCE_FORMATS:
+            return
+        source_path = os.path.join(CONTAINER_ASSET_DIR_ABS, file_path)
+        future = self._pool().submit(process_image, source_path, self._widths)
+        future.add_done_callback(lambda f: self._record(asset_id, file_path, f))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: the API process runs threads, which must not be forked
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self._max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _record(self, asset_id: int, file_path: str, future: Future) -> None:
+        # Imported here so worker processes only need Pillow, not the database layer
+        from builds import invalidate_styling_artifacts
+        from models import SessionLocal, StyleAsset, StyleAssetDerivative
+        from utils import bump_revision
+
+        if future.cancelled():
+            return
+        try:
+            processed = future.result()
+        except Exception as e:
+            print(f"Error generating image derivatives for asset {asset_id}: {e}")
+            return
+
+        db = SessionLocal()
+        try:
+            asset = db.query(StyleAsset).filter(StyleAsset.id == asset_id).first()
+            if asset is None or asset.file_path != file_path:
+                return # Deleted or replaced while the derivatives were being generated
+            asset.derivatives = [
+                StyleAssetDerivative(
+                    width=width,
+                    format=fmt,
+                    file_path=os.path.relpath(path, CONTAINER_ASSET_DIR_ABS).replace('\\', '/'),
+                )
+                for width, fmt, path in processed
+            ]
+            bump_revision(asset.brand_styling_id, db)
+            db.commit()
+            invalidate_styling_artifacts(asset.brand_styling_id, db)
+        except Exception as e:
+            print(f"Error recording image derivatives for asset {asset_id}: {e}")
+        finally:
+            db.close()
+
+
+# Shared instance used by the API
+derivative_pipeline = DerivativePipeline(
+    max_workers=settings.IMAGE_WORKERS,
+    widths=settings.IMAGE_DERIVATIVE_WIDTHS,
+)
@@ -1,5 +1,5 @@
 
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, Boolean, create_engine, ForeignKeyConstraint, DateTime
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, Boolean, create_engine, ForeignKeyConstraint, DateTime, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker, backref
 
@@ -39,6 +39,13 @@ class BrandStyling(Base):
     # New column for inheritance
     master_brand_id = Column(Integer, ForeignKey("brand_stylings.id"), nullable=True)
 
+    # Bumped on every write to the styling or its assets/variants (cheap change detection)
+    revision = Column(Integer, default=0, server_default="0", nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=True)
+
+    # Publish minified CSS by default; None follows CSS_DEFAULT_MINIFY
+    minify_css = Column(Boolean, nullable=True)
+
     # Relationships
     site = relationship("Site", back_populates="brand_stylings")
     assets = relationship("StyleAsset", back_populates="brand_styling", cascade="all, delete-orphan")
@@ -49,6 +56,17 @@ class BrandStyling(Base):
                              backref=backref("master_brand", remote_side=[id]),
                              foreign_keys=[master_brand_id])
 
+class BrandInheritance(Base):
+    """
+    Closure table of the master/sub-brand tree: one row per (ancestor, descendant) pair,
+    including a depth-0 row for each styling itself. Maintained alongside master_brand_id.
+    """
+    __tablename__ = "brand_inheritance"
+
+    ancestor_id = Column(Integer, ForeignKey("brand_stylings.id", ondelete="CASCADE"), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey("brand_stylings.id", ondelete="CASCADE"), primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+
 class StyleAsset(Base):
     __tablename__ = "style_assets"
 
@@ -62,9 +80,17 @@ class StyleAsset(Base):
     group_name = Column(String, default="General") 
     selector = Column(String, nullable=True)
 
+    # Metadata of an uploaded image, so clients can lay it out before downloading it
+    image_width = Column(Integer, nullable=True)
+    image_height = Column(Integer, nullable=True)
+    image_format = Column(String, nullable=True)  # 'png', 'jpeg', 'gif', 'webp', 'svg'
+    placeholder = Column(Text, nullable=True)  # Tiny blurred preview as a data: URI
+
     brand_styling_id = Column(Integer, ForeignKey("brand_stylings.id"))
     brand_styling = relationship("BrandStyling", back_populates="assets")
     variants = relationship("StyleAssetVariant", back_populates="asset", cascade="all, delete-orphan")
+    derivatives = relationship("StyleAssetDerivative", back_populates="asset", cascade="all, delete-orphan",
+                               order_by="(StyleAssetDerivative.format, StyleAssetDerivative.width)")
     
 
 class StyleAssetVariant(Base):
@@ -79,6 +105,18 @@ class StyleAssetVariant(Base):
     # Relationship to parent asset
     asset = relationship("StyleAsset", back_populates="variants")
 
+class StyleAssetDerivative(Base):
+    """A resized and/or re-encoded copy of an uploaded image, generated in the background."""
+    __tablename__ = "style_asset_derivatives"
+
+    id = Column(Integer, primary_key=True, index=True)
+    asset_id = Column(Integer, ForeignKey("style_assets.id", ondelete="CASCADE"), index=True)
+    width = Column(Integer)
+    format = Column(String)  # 'png', 'jpeg', 'webp'
+    file_path = Column(String)  # Relative to the asset dir, next to the source blob
+
+    asset = relationship("StyleAsset", back_populates="derivatives")
+
 
 
 
@@ -92,4 +130,33 @@ class BrandLog(Base):
     ref = Column(String(255), nullable=True) # Section reference
     message = Column(Text, nullable=False)
 
-    brand_styling = relationship("BrandStyling") # Optional: if you need to navigate back
\ No newline at end of file
+    brand_styling = relationship("BrandStyling") # Optional: if you need to navigate back
+
+
+# Columns added after the first release. create_all() does not alter existing
+# tables, so they are added here for databases created by older versions.
+ADDED_COLUMNS = {
+    "brand_stylings": {
+        "revision": "INTEGER NOT NULL DEFAULT 0",
+        "updated_at": "DATETIME",
+        "minify_css": "BOOLEAN",
+    },
+    "style_assets": {
+        "image_width": "INTEGER",
+        "image_height": "INTEGER",
+        "image_format": "VARCHAR",
+        "placeholder": "TEXT",
+    },
+}
+
+def upgrade_schema():
+    """Add any missing columns from ADDED_COLUMNS to existing tables."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table_name, columns in ADDED_COLUMNS.items():
+            if not inspector.has_table(table_name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table_name)}
+            for column_name, ddl in columns.items():
+                if column_name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {ddl}"))
@@ -33,11 +33,21 @@ class BrandStylingUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     master_brand_id: Optional[int] = None
+    minify_css: Optional[bool] = None
 
 class BrandStyling(BrandStylingBase):
     id: int
     site_id: int
     master_brand_id: Optional[int] = None
+    minify_css: Optional[bool] = None
+
+    class Config:
+        orm_mode = True
+
+class BrandStylingRevision(BaseModel):
+    id: int
+    revision: int
+    updated_at: Optional[datetime.datetime] = None
 
     class Config:
         orm_mode = True
@@ -114,11 +124,25 @@ class StyleAssetVariant(StyleAssetVariantBase):
     class Config:
         orm_mode = True
 
+class StyleAssetDerivative(BaseModel):
+    id: int
+    width: int
+    format: str
+    file_path: str
+
+    class Config:
+        orm_mode = True
+
 # Update the StyleAsset model to include variants
 class StyleAsset(StyleAssetBase):
     id: int
     brand_styling_id: int
     variants: List[StyleAssetVariant] = []
+    derivatives: List[StyleAssetDerivative] = []
+    image_width: Optional[int] = None
+    image_height: Optional[int] = None
+    image_format: Optional[str] = None
+    placeholder: Optional[str] = None
 
     class Config:
         orm_mode = True
@@ -127,6 +151,35 @@ class StyleAsset(StyleAssetBase):
 BrandStylingWithInheritance.update_forward_refs()
 
 
+# Batch asset mutation schemas
+class StyleAssetBatchOperation(BaseModel):
+    op: str # "create", "update" or "delete"
+    id: Optional[int] = None # Required for update/delete
+    asset_type: Optional[str] = None # Required for create
+    name: Optional[str] = None
+    value: Optional[str] = None
+    selector: Optional[str] = None
+    description: Optional[str] = None
+    is_important: Optional[bool] = None
+    group_name: Optional[str] = None
+    variants: List[StyleAssetVariantCreate] = [] # Created, or replaced by breakpoint on update
+    delete_variants: List[str] = [] # Breakpoints to remove (update only)
+
+class StyleAssetBatchRequest(BaseModel):
+    operations: List[StyleAssetBatchOperation]
+
+class StyleAssetBatchResult(BaseModel):
+    index: int
+    op: str
+    status: str # "created", "updated", "unchanged", "deleted" or "error"
+    id: Optional[int] = None
+    name: Optional[str] = None
+    detail: Optional[str] = None
+
+class StyleAssetBatchResponse(BaseModel):
+    results: List[StyleAssetBatchResult]
+
+
 class BrandStylingInheritanceInfo(BaseModel):
     has_master: bool
     master_brand_id: Optional[int] = None
@@ -0,0 +1,191 @@
+# static_export.py
+import datetime
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session, selectinload
+
+from blobs import BLOB_DIR
+from builds import publishes_minified
+from compression import compress_variants
+from config import CONTAINER_ASSET_DIR_ABS
+from cssmin import minify_css, build_source_map
+from docs import render_docs
+from exports import render_export, EXPORTERS, ARCHIVE_MEDIA_TYPE
+from models import BrandStyling, StyleAsset
+from utils import build_flat_css, write_file_atomic
+
+# Precompressed siblings, as picked up by e.g. nginx gzip_static/brotli_static
+ENCODING_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+# Layout of an export directory:
+#   latest.json                       {"version", "manifest"}; replaced last, so readers switch atomically
+#   blobs/{sha[:2]}/{sha}{ext}        uploaded images and derivatives, shared by every version (immutable)
+#   {version}/manifest.json
+#   {version}/brands/{id}/style.css, style.min.css(.map), docs.html, exports/...
+#   {version}/files/...               older uploads that are not in the blob store
+
+
+def upload_url_rewrites(db: Session, public_url: str, version: str) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """
+    Where uploaded files go in the export tree and how to rewrite their URLs.
+    Returns ([(old URL prefix, new URL prefix)], [(source path, tree path)]), both relative
+    to the asset dir / export root. Prefixes end at the file's stem so derivatives
+    ({stem}-320w.webp) are rewritten along with the original.
+    """
+    rewrites = {}
+    copies = {}
+    assets = db.query(StyleAsset).options(selectinload(StyleAsset.derivatives)).filter(StyleAsset.file_path != None).all()
+    for asset in assets:
+        file_name = os.path.basename(asset.file_path)
+        if not asset.value or not asset.value.endswith("/" + file_name):
+            continue # The value no longer points at the uploaded file
+        if asset.file_path.startswith(f"{BLOB_DIR}/"):
+            tree_dir = os.path.dirname(asset.file_path)
+        else:
+            tree_dir = f"{version}/files/{os.path.dirname(asset.file_path)}".rstrip("/")
+        stem = os.path.splitext(file_name)[0]
+        rewrites[asset.value[:-len(file_name)] + stem] = f"{public_url}/{tree_dir}/{stem}"
+        for file_path in [asset.file_path, *(d.file_path for d in asset.derivatives)]:
+            copies[file_path] = f"{tree_dir}/{os.path.basename(file_path)}"
+    # Longest first, so a prefix never rewrites part of a longer one
+    return sorted(rewrites.items(), key=lambda item: -len(item[0])), sorted(copies.items())
+
+
+def rewrite_urls(text: str, rewrites: Sequence[Tuple[str, str]]) -> str:
+    for old, new in rewrites:
+        text = text.replace(old, new)
+    return text
+
+
+def write_tree_file(root: str, relative_path: str, body: bytes, media_type: str) -> Dict:
+    """Write a file (and its precompressed siblings) into the tree. Returns its manifest entry."""
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(body)
+    encodings = {}
+    for encoding, data in compress_variants(body, media_type).items():
+        with open(path + ENCODING_SUFFIXES[encoding], "wb") as f:
+            f.write(data)
+        encodings[encoding] = relative_path + ENCODING_SUFFIXES[encoding]
+    return {
+        "path": relative_path,
+        "media_type": media_type,
+        "size": len(body),
+        "sha256": hashlib.sha256(body).hexdigest(),
+        "encodings": encodings,
+    }
+
+
+def export_styling_files(
+    styling: BrandStyling,
+    root: str,
+    version: str,
+    public_url: str,
+    rewrites: Sequence[Tuple[str, str]],
+    db: Session,
+) -> Dict:
+    """Write one styling's published files under {version}/brands/{id}/. Returns its manifest entry."""
+    styling_dir = f"{version}/brands/{styling.id}"
+    css_url = f"{public_url}/{styling_dir}/style.css"
+    files = {}
+
+    # Flat builds only: an @import would point back at the API
+    css_content = rewrite_urls(build_flat_css(styling.id, db), rewrites)
+    files["style.css"] = write_tree_file(root, f"{styling_dir}/style.css", css_content.encode("utf-8"), "text/css")
+
+    minified, positions = minify_css(rewrite_urls(build_flat_css(styling.id, db, annotate=True), rewrites))
+    source_map = build_source_map("style.min.css", positions, source_root="assets")
+    # A static host cannot send the SourceMap header, so the map is linked from the file itself
+    minified += "\n/*# sourceMappingURL=style.min.css.map */"
+    files["style.min.css"] = write_tree_file(root, f"{styling_dir}/style.min.css", minified.encode("utf-8"), "text/css")
+    files["style.min.css.map"] = write_tree_file(root, f"{styling_dir}/style.min.css.map", source_map.encode("utf-8"), "application/json")
+
+    html, _ = render_docs(styling.id, f"{public_url}/", db)
+    html = html.replace(f'href="/brand/{styling.id}/css"', 'href="style.css"')
+    html = html.replace(f"{public_url}/brand/{styling.id}/css", css_url)
+    files["docs.html"] = write_tree_file(root, f"{styling_dir}/docs.html", rewrite_urls(html, rewrites).encode("utf-8"), "text/html")
+
+    for format in EXPORTERS:
+        content, file_name, media_type = render_export(styling.id, format, db)
+        if media_type != ARCHIVE_MEDIA_TYPE:
+            content = rewrite_urls(content.decode("utf-8"), rewrites).encode("utf-8")
+        files[f"exports/{format}"] = write_tree_file(root, f"{styling_dir}/exports/{file_name}", content, media_type)
+
+    return {
+        "id": styling.id,
+        "name": styling.name,
+        "site_id": styling.site_id,
+        "master_brand_id": styling.master_brand_id,
+        "revision": styling.revision,
+        "updated_at": styling.updated_at.isoformat() if styling.updated_at else None,
+        "published": "style.min.css" if publishes_minified(styling.id, db) else "style.css",
+        "files": files,
+    }
+
+
+def export_static(out_dir: str, public_url: str, db: Session, styling_ids: Optional[Sequence[int]] = None) -> Dict:
+    """
+    Write every styling's published CSS (readable, minified with source map, precompressed),
+    docs, exports and uploaded images into a new version directory under out_dir, so that a
+    plain static server or CDN can serve them. URLs of uploaded files are rewritten to
+    public_url (the tree's public root; "" for root-relative URLs).
+    The version only becomes visible once complete: it is built under a temporary name and
+    latest.json is switched to it last. Returns the manifest, with any per-styling failures.
+    """
+    public_url = public_url.rstrip("/")
+    version = datetime.datetime.utcnow().strftime("v%Y%m%dT%H%M%S%fZ")
+    # Files are written at their final tree paths under a hidden staging root;
+    # only the finished version directory is moved into out_dir
+    staging_root = os.path.join(out_dir, f".{version}.tmp")
+    os.makedirs(os.path.join(staging_root, version))
+
+    query = db.query(BrandStyling).order_by(BrandStyling.id)
+    if styling_ids is not None:
+        query = query.filter(BrandStyling.id.in_(list(styling_ids)))
+    stylings = query.all()
+
+    rewrites, copies = upload_url_rewrites(db, public_url, version)
+    copied = 0
+    for source_path, tree_path in copies:
+        # Blobs live outside the version directory and are immutable, so existing ones are kept
+        target_root = out_dir if tree_path.startswith(f"{BLOB_DIR}/") else staging_root
+        target = os.path.join(target_root, tree_path)
+        if target_root == out_dir and os.path.exists(target):
+            continue
+        source = os.path.join(CONTAINER_ASSET_DIR_ABS, source_path)
+        if not os.path.isfile(source):
+            continue # Derivatives may still be generating; the original is always exported
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(source, target + ".tmp")
+        os.replace(target + ".tmp", target)
+        copied += 1
+
+    manifest = {
+        "version": version,
+        "generated_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "public_url": public_url,
+        "stylings": {},
+        "failures": [],
+        "files_copied": copied,
+    }
+    for styling in stylings:
+        try:
+            manifest["stylings"][str(styling.id)] = export_styling_files(styling, staging_root, version, public_url, rewrites, db)
+        except HTTPException as e:
+            manifest["failures"].append({"styling_id": styling.id, "error": e.detail})
+        except Exception as e:
+            manifest["failures"].append({"styling_id": styling.id, "error": str(e)})
+
+    manifest_body = json.dumps(manifest, indent=2).encode("utf-8")
+    write_tree_file(staging_root, f"{version}/manifest.json", manifest_body, "application/json")
+    os.replace(os.path.join(staging_root, version), os.path.join(out_dir, version))
+    shutil.rmtree(staging_root, ignore_errors=True)
+
+    write_file_atomic(os.path.join(out_dir, "latest.json"), json.dumps({"version": version, "manifest": f"{version}/manifest.json"}))
+    return manifest
@@ -0,0 +1,69 @@
+# tests/test_concurrency.py
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_HEADERS = {"X-API-Key": "test"}
+SLOW_SECONDS = 1.0
+FAST_REQUESTS = 5
+
+
+@pytest.fixture(scope="module")
+def app_module():
+    """The API on a throwaway database and asset directory (both are set up at import time)."""
+    work_dir = tempfile.mkdtemp(prefix="branding-server-test-")
+    os.makedirs(os.path.join(work_dir, "data")) # Provided by the container's volume otherwise
+    os.environ["DB_URL"] = f"sqlite:///{work_dir}/test.db"
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    sys.path.insert(0, ROOT_DIR)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app
+
+
+def test_slow_request_does_not_block_others(app_module):
+    from fastapi import Request
+
+    app = app_module.app
+
+    def get_db(request: Request):
+        if request.headers.get("X-Slow"):
+            time.sleep(SLOW_SECONDS) # Blocking, like a slow query
+        yield from app_module.get_db()
+
+    app.dependency_overrides[app_module.get_db] = get_db
+
+    async def timed_get(client, url, headers):
+        response = await client.get(url, headers=headers)
+        return response.status_code, time.monotonic()
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            site = await client.post("/sites/", json={"name": "Concurrency"}, headers=API_HEADERS)
+            assert site.status_code == 200, site.text
+            stylings = await client.get(f"/sites/{site.json()['id']}/brand-stylings/", headers=API_HEADERS)
+            url = f"/brand-stylings/{stylings.json()[0]['id']}/revision"
+
+            slow = asyncio.create_task(timed_get(client, url, {**API_HEADERS, "X-Slow": "1"}))
+            await asyncio.sleep(0.05) # Let the slow request reach its dependency first
+            fast = await asyncio.gather(*(timed_get(client, url, API_HEADERS) for _ in range(FAST_REQUESTS)))
+            return await slow, fast
+
+    try:
+        (slow_status, slow_done), fast = asyncio.run(run())
+    finally:
+        app.dependency_overrides.pop(app_module.get_db, None)
+
+    assert slow_status == 200
+    assert [status for status, _ in fast] == [200] * FAST_REQUESTS
+    assert max(done for _, done in fast) < slow_done
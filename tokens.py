@@ -0,0 +1,229 @@
+# tokens.py
+import datetime
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session, selectinload
+
+from cache import css_cache
+from config import settings
+from models import BrandStyling, BrandInheritance, StyleAsset
+
+StylingInfo = namedtuple("StylingInfo", "id name description site_id master_brand_id revision updated_at")
+Variant = namedtuple("Variant", "id asset_id breakpoint value is_important")
+Derivative = namedtuple("Derivative", "width format file_path")
+
+# What a token is, decided once with the rules render_css uses
+VARIABLE = "variable"        # no selector: a custom property declared on :root
+DECLARATION = "declaration"  # css_declaration: one property of a selector block
+LEGACY_RULE = "legacy_rule"  # class_rule: the name is the selector, the value a raw rule string
+OTHER = "other"              # anything else with a selector; not rendered
+
+VAR_REFERENCE_RE = re.compile(r"^\s*var\(\s*(--[\w-]+)\s*(?:,\s*(.*?))?\)\s*$", re.DOTALL)
+
+
+def token_kind(asset) -> str:
+    if asset.selector and asset.type == "css_declaration":
+        return DECLARATION
+    if asset.type == "class_rule":
+        return LEGACY_RULE
+    if not asset.selector:
+        return VARIABLE
+    return OTHER
+
+
+def inheritance_key(asset) -> str:
+    """Key under which declarations of the "same" asset compete across an inheritance chain."""
+    if asset.type == "css_declaration" and asset.selector:
+        # For declarations, the key is a combination of its selector and property name.
+        return f"decl::{asset.selector}::{asset.name}"
+    elif asset.type != "css_declaration" and not asset.selector:
+        # For global CSS variables, the key is just the variable name.
+        return f"var::{asset.name}"
+    # Fallback for legacy or other types.
+    return f"other::{asset.name}"
+
+
+def pick_winner(declarations_with_spec):
+    """
+    Resolve competing declarations given as (asset, specificity) tuples, where a deeper
+    brand has higher specificity. The most specific !important declaration wins,
+    otherwise the most specific declaration.
+    """
+    if not declarations_with_spec:
+        return None
+    ordered = sorted(declarations_with_spec, key=lambda d: d[1])
+    important = [d for d in ordered if d[0].is_important]
+    return (important or ordered)[-1][0]
+
+
+ASSET_COLUMNS = (
+    "id", "brand_styling_id", "name", "type", "value", "description", "file_path", "is_important",
+    "group_name", "selector", "image_width", "image_height", "image_format", "placeholder",
+)
+
+
+class Token:
+    """
+    A style asset detached from the session, with the same attributes as StyleAsset (so
+    render_css and the docs helpers take either), its variants and derivatives as tuples,
+    its kind and inheritance key, and the IDs of the inherited declarations it overrides.
+    """
+    __slots__ = ASSET_COLUMNS + ("variants", "derivatives", "kind", "key", "overrides")
+
+    def __init__(self, asset: StyleAsset):
+        for column in ASSET_COLUMNS:
+            setattr(self, column, getattr(asset, column))
+        self.variants = tuple(sorted(
+            (Variant(v.id, v.asset_id, v.breakpoint, v.value, v.is_important) for v in asset.variants),
+            key=lambda v: v.id,
+        ))
+        self.derivatives = tuple(Derivative(d.width, d.format, d.file_path) for d in asset.derivatives)
+        self.kind = token_kind(asset)
+        self.key = inheritance_key(asset)
+        self.overrides = ()
+
+
+class TokenModel:
+    """
+    Everything the emitters (CSS, docs, exports, backups) need from one styling, compiled
+    once per revision of its inheritance chain and shared read-only between them:
+    tokens      the styling's own assets, by ID
+    winners     the assets the flattened chain resolves to, by ID (provenance: brand_styling_id, overrides)
+    variables   winning variable definitions by name, for resolving var() references
+    breakpoints the styling's own dimension variables by name, as the @import build looks them up
+    """
+    __slots__ = ("styling", "chain", "revisions", "tokens", "winners", "variables", "breakpoints")
+
+    def __init__(self, chain: Tuple[StylingInfo, ...], revisions, tokens, winners):
+        self.styling = chain[-1]
+        self.chain = chain
+        self.revisions = revisions
+        self.tokens = tokens
+        self.winners = winners
+        self.variables: Dict[str, Token] = {t.name: t for t in winners if t.selector is None}
+        self.breakpoints: Dict[str, Token] = {}
+        for token in tokens:
+            if token.type == "dimension" and token.selector is None:
+                self.breakpoints.setdefault(token.name, token)
+
+    @property
+    def master(self) -> Optional[StylingInfo]:
+        return self.chain[-2] if len(self.chain) > 1 else None
+
+    @property
+    def updated_at(self) -> Optional[datetime.datetime]:
+        """Latest change anywhere in the chain: what Last-Modified of anything built from inherited tokens is."""
+        return max((s.updated_at for s in self.chain if s.updated_at), default=None)
+
+    def resolve(self, value: Optional[str]) -> Optional[str]:
+        """
+        Follow a var(--name[, fallback]) value through the winning variables to a literal.
+        None if it ends at an undefined variable without fallback, or in a cycle.
+        """
+        seen = set()
+        while value is not None:
+            match = VAR_REFERENCE_RE.match(value)
+            if not match:
+                return value.strip()
+            name, fallback = match.groups()
+            if name in seen:
+                return None
+            seen.add(name)
+            token = self.variables.get(name)
+            value = token.value if token is not None else fallback
+        return None
+
+
+class TokenModelCache:
+    """
+    Compiled token models by styling ID. An entry is reused while every styling in its
+    chain is at the same revision and the artifact cache has not dropped the styling
+    (css_cache.invalidate/clear), so a change costs one compile however many formats follow.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, Tuple[Tuple, TokenModel]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.compiles = 0
+
+    def get(self, styling_id: int, revisions: Tuple, generation: Tuple) -> Optional[TokenModel]:
+        with self._lock:
+            entry = self._entries.get(styling_id)
+            if entry is None or entry[0] != (revisions, generation):
+                return None
+            self._entries.move_to_end(styling_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, styling_id: int, model: TokenModel, generation: Tuple) -> None:
+        with self._lock:
+            self.compiles += 1
+            if self.max_entries <= 0:
+                return
+            self._entries[styling_id] = ((model.revisions, generation), model)
+            self._entries.move_to_end(styling_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, "hits": self.hits, "compiles": self.compiles}
+
+
+token_models = TokenModelCache(max_entries=settings.TOKEN_MODEL_CACHE_SIZE)
+
+
+def chain_revisions(styling_id: int, db: Session) -> Tuple[Tuple[int, int], ...]:
+    """(id, revision) of the styling and its masters, root master first. Empty if the styling does not exist."""
+    rows = db.query(BrandStyling.id, BrandStyling.revision).join(
+        BrandInheritance, BrandInheritance.ancestor_id == BrandStyling.id
+    ).filter(BrandInheritance.descendant_id == styling_id).order_by(BrandInheritance.depth.desc()).all()
+    return tuple((row.id, row.revision) for row in rows)
+
+
+def compile_tokens(styling_id: int, db: Session) -> Optional[TokenModel]:
+    """The token model of a styling at its current revision, or None if it does not exist."""
+    revisions = chain_revisions(styling_id, db)
+    if not revisions:
+        return None
+    # Read before compiling, like ArtifactCache.generation(): a model built across an invalidation is not reused
+    generation = css_cache.generation((styling_id, "tokens"))
+    model = token_models.get(styling_id, revisions, generation)
+    if model is None:
+        model = build_token_model(revisions, db)
+        token_models.put(styling_id, model, generation)
+    return model
+
+
+def build_token_model(revisions: Tuple[Tuple[int, int], ...], db: Session) -> TokenModel:
+    specificity_by_styling = {styling_id: i for i, (styling_id, _) in enumerate(revisions)}
+    stylings = {s.id: s for s in db.query(BrandStyling).filter(BrandStyling.id.in_(list(specificity_by_styling)))}
+    chain = tuple(
+        StylingInfo(s.id, s.name, s.description, s.site_id, s.master_brand_id, revision, s.updated_at)
+        for s, revision in ((stylings[styling_id], revision) for styling_id, revision in revisions)
+    )
+    assets = db.query(StyleAsset).options(selectinload(StyleAsset.variants), selectinload(StyleAsset.derivatives)).filter(
+        StyleAsset.brand_styling_id.in_(list(specificity_by_styling))
+    ).order_by(StyleAsset.id).all()
+    all_tokens = [Token(asset) for asset in assets]
+
+    styling_id = chain[-1].id
+    tokens = tuple(t for t in all_tokens if t.brand_styling_id == styling_id)
+
+    declarations_by_key = {}
+    for token in all_tokens:
+        if not (token.name and token.type and token.value is not None):
+            continue
+        declarations_by_key.setdefault(token.key, []).append((token, specificity_by_styling[token.brand_styling_id]))
+    winners = []
+    for declarations in declarations_by_key.values():
+        winner = pick_winner(declarations)
+        winner.overrides = tuple(t.id for t, _ in declarations if t is not winner)
+        winners.append(winner)
+    winners.sort(key=lambda t: t.id)
+    return TokenModel(chain, revisions, tokens, tuple(winners))
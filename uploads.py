@@ -0,0 +1,218 @@
+# uploads.py
+import hashlib
+import os
+import re
+import tempfile
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+
+from blobs import BLOB_ROOT_ABS, blob_relative_path, link_blob
+from config import settings, CONTAINER_ASSET_DIR_ABS
+from images import render_placeholder
+
+CHUNK_SIZE = 64 * 1024
+
+# Room for the multipart boundaries and the other form fields sent alongside the file
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Extension used on disk for each sniffed image type (the client's filename is not trusted)
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+}
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Detect an image MIME type from the first bytes of a file. Returns None if unrecognised."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    # SVG is text: allow a BOM, an XML declaration, comments or a doctype before the root element
+    text = head.lstrip(b"\xef\xbb\xbf").lstrip().lower()
+    if text.startswith((b"<?xml", b"<svg", b"<!--", b"<!doctype svg")) and b"<svg" in text:
+        return "image/svg+xml"
+    return None
+
+# Short name stored in StyleAsset.image_format
+IMAGE_FORMATS = {
+    "image/png": "png",
+    "image/jpeg": "jpeg",
+    "image/gif": "gif",
+    "image/webp": "webp",
+    "image/svg+xml": "svg",
+}
+
+SVG_ROOT_RE = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
+SVG_LENGTH_RE = rb'\s%s\s*=\s*["\']\s*([0-9.]+)\s*(?:px)?\s*["\']'
+SVG_VIEWBOX_RE = re.compile(rb'\sviewBox\s*=\s*["\']\s*[-0-9.]+[\s,]+[-0-9.]+[\s,]+([0-9.]+)[\s,]+([0-9.]+)\s*["\']')
+
+
+def read_image_info(path: str, content_type: str) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    """
+    Intrinsic (width, height) and inline placeholder of a stored image. Raster formats are
+    decoded by Pillow (the first frame of an animated GIF) unless that exceeds
+    PLACEHOLDER_MAX_PIXELS, in which case they get no placeholder. SVGs are not rasterised,
+    so they get no placeholder and their size comes from the root element's width/height or viewBox.
+    None for anything that cannot be determined.
+    """
+    try:
+        if content_type != "image/svg+xml":
+            with Image.open(path) as image:
+                size = image.size
+                try:
+                    return (*size, render_placeholder(image, settings.PLACEHOLDER_MAX_PIXELS))
+                except Exception as e: # Truncated or otherwise undecodable pixel data
+                    print(f"Warning: could not render a placeholder for {path}: {e}")
+                    return (*size, None)
+        with open(path, "rb") as f:
+            root = SVG_ROOT_RE.search(f.read(64 * 1024))
+        if root is None:
+            return None, None, None
+        width = re.search(SVG_LENGTH_RE % b"width", root.group(0))
+        height = re.search(SVG_LENGTH_RE % b"height", root.group(0))
+        if width and height:
+            return round(float(width.group(1))), round(float(height.group(1))), None
+        view_box = SVG_VIEWBOX_RE.search(root.group(0))
+        if view_box:
+            return round(float(view_box.group(1))), round(float(view_box.group(2))), None
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not read image size of {path}: {e}")
+    return None, None, None
+
+
+class StoredUpload:
+    """An upload that passed validation and was linked into the blob store."""
+    __slots__ = ("file_name", "relative_path", "sha256", "size", "content_type", "width", "height", "placeholder")
+
+    def __init__(self, file_name: str, relative_path: str, sha256: str, size: int, content_type: str,
+                 width: Optional[int] = None, height: Optional[int] = None, placeholder: Optional[str] = None):
+        self.file_name = file_name
+        self.relative_path = relative_path
+        self.sha256 = sha256
+        self.size = size
+        self.content_type = content_type
+        self.width = width
+        self.height = height
+        self.placeholder = placeholder
+
+    @property
+    def image_format(self) -> str:
+        return IMAGE_FORMATS[self.content_type]
+
+
+def save_image_upload(file: UploadFile) -> StoredUpload:
+    """
+    Stream an uploaded image into the content-addressed blob store in fixed-size chunks.
+
+    The content is hashed and checked against UPLOAD_SIZE_LIMIT as it is copied,
+    and its type is taken from the magic bytes rather than the client's content_type.
+    Data goes to a temp file inside the store and is only renamed into place once it
+    passes, so a rejected or failed upload never leaves a partial file behind.
+    Identical content uploaded again reuses the existing blob.
+    """
+    os.makedirs(BLOB_ROOT_ABS, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    content_type = None
+    tmp = tempfile.NamedTemporaryFile(dir=BLOB_ROOT_ABS, prefix=".upload-", delete=False)
+    try:
+        with tmp:
+            while True:
+                chunk = file.file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if content_type is None:
+                    content_type = sniff_image_type(chunk)
+                    if content_type not in settings.ALLOWED_IMAGE_TYPES:
+                        raise HTTPException(
+                            status_code=400,
+                            detail=f"Invalid image file. Allowed types: {', '.join(settings.ALLOWED_IMAGE_TYPES)}"
+                        )
+                size += len(chunk)
+                if size > settings.UPLOAD_SIZE_LIMIT:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the upload limit of {settings.UPLOAD_SIZE_LIMIT} bytes.")
+                digest.update(chunk)
+                tmp.write(chunk)
+        if content_type is None:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty.")
+
+        file_name = link_blob(tmp.name, digest.hexdigest(), IMAGE_EXTENSIONS[content_type])
+    except HTTPException:
+        os.unlink(tmp.name)
+        raise
+    except Exception as e:
+        os.unlink(tmp.name)
+        raise HTTPException(status_code=500, detail=f"Failed to save image file: {str(e)}")
+
+    relative_path = blob_relative_path(file_name)
+    width, height, placeholder = read_image_info(os.path.join(CONTAINER_ASSET_DIR_ABS, relative_path), content_type)
+    return StoredUpload(
+        file_name=file_name,
+        relative_path=relative_path,
+        sha256=digest.hexdigest(),
+        size=size,
+        content_type=content_type,
+        width=width,
+        height=height,
+        placeholder=placeholder,
+    )
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject multipart request bodies larger than UPLOAD_SIZE_LIMIT while they are still
+    being received, before Starlette spools them to disk: up front when the declared
+    Content-Length is too large, otherwise as soon as the streamed body passes the limit.
+    """
+
+    def __init__(self, app, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_size:
+            await self._reject(send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # Raised inside the route's body parsing, so it surfaces as a normal 413
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {settings.UPLOAD_SIZE_LIMIT} bytes.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, send):
+        body = b'{"detail":"Upload exceeds the limit of %d bytes."}' % settings.UPLOAD_SIZE_LIMIT
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"connection", b"close")],
+        })
+        await send({"type": "http.response.body", "body": body})
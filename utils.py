@@ -1,13 +1,18 @@
 # utils.py
 import os
-from sqlalchemy.orm import Session
-from models import StyleAsset, BrandStyling, StyleAssetVariant 
+from typing import Optional
+from sqlalchemy import select, insert, delete, literal, func, true
+from sqlalchemy.orm import Session, aliased
+from models import StyleAsset, BrandStyling, BrandInheritance
 
 import re
 import json
 import datetime
+import tempfile
 
-from config import settings, CONTAINER_ASSET_DIR_ABS
+from config import settings, CONTAINER_ASSET_DIR_ABS, FSYNC_POLICIES
+from images import DERIVATIVE_SOURCE_FORMATS, FORMAT_MEDIA_TYPES
+from tokens import compile_tokens
 
 
 def parse_css_variables(css_content):
@@ -57,12 +62,25 @@ def parse_css_variables(css_content):
 
 def create_directories_if_not_exist():
     pass
+
+def bump_revision(styling_id: int, db: Session):
+    """
+    Increment a styling's revision inside the caller's transaction.
+    Call before db.commit() in every write path so the bump lands atomically with the change.
+    """
+    db.query(BrandStyling).filter(BrandStyling.id == styling_id).update(
+        {
+            BrandStyling.revision: BrandStyling.revision + 1,
+            BrandStyling.updated_at: datetime.datetime.utcnow(),
+        },
+        synchronize_session=False,
+    )
  
 def save_local_backup(styling_id: int, db: Session) -> str:
-    styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if not styling:
+    model = compile_tokens(styling_id, db)
+    if model is None:
         return None
-    assets = db.query(StyleAsset).filter(StyleAsset.brand_styling_id == styling_id).all()
+    styling = model.styling
     backup_data = {
         "styling": {
             "id": styling.id, "name": styling.name, "description": styling.description,
@@ -74,7 +92,7 @@ def save_local_backup(styling_id: int, db: Session) -> str:
                 "description": asset.description, "file_path": asset.file_path,
                 "is_important": asset.is_important, "group_name": asset.group_name,
                 "selector": asset.selector 
-            } for asset in assets
+            } for asset in model.tokens
         ]
     }
     backup_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, "exports", "backups")
@@ -83,30 +101,298 @@ def save_local_backup(styling_id: int, db: Session) -> str:
     sanitized_name = re.sub(r'[^\w\-_\.]', '_', styling.name)
     filename = os.path.join(backup_dir, f"{sanitized_name}_{timestamp}.json")
     try:
-        with open(filename, "w") as f:
-            json.dump(backup_data, f, indent=2)
+        write_file_atomic(filename, json.dumps(backup_data, indent=2))
         # print(f"Backup created successfully: {filename}")
         return filename
     except Exception as e:
         # print(f"Error creating backup for styling {styling_id}: {e}")
         return None
 
-def generate_css(styling_id: int, db: Session):
-    db_styling = db.query(BrandStyling).filter(BrandStyling.id == styling_id).first()
-    if not db_styling:
-        return False
+# Guard against runaway recursion if bad data ever introduces an inheritance cycle
+MAX_INHERITANCE_DEPTH = 64
+
+def get_ancestors_with_depth(styling_id: int, db: Session):
+    """
+    Return [(styling, depth)] for a styling and all its masters in one indexed lookup,
+    where depth is 0 for the styling itself, 1 for its master, and so on.
+    """
+    return db.query(BrandStyling, BrandInheritance.depth).join(
+        BrandInheritance, BrandInheritance.ancestor_id == BrandStyling.id
+    ).filter(BrandInheritance.descendant_id == styling_id).order_by(BrandInheritance.depth).all()
+
+def get_descendants_with_depth(styling_id: int, db: Session):
+    """Return [(styling, depth)] for every sub-brand below a styling (depth >= 1) in one indexed lookup."""
+    return db.query(BrandStyling, BrandInheritance.depth).join(
+        BrandInheritance, BrandInheritance.descendant_id == BrandStyling.id
+    ).filter(
+        BrandInheritance.ancestor_id == styling_id, BrandInheritance.depth > 0
+    ).order_by(BrandInheritance.depth, BrandStyling.id).all()
+
+def is_descendant_or_self(styling_id: int, ancestor_id: int, db: Session) -> bool:
+    """True if styling_id is ancestor_id itself or sits anywhere below it."""
+    return db.query(BrandInheritance.depth).filter(
+        BrandInheritance.ancestor_id == ancestor_id, BrandInheritance.descendant_id == styling_id
+    ).first() is not None
+
+def subtree_ids_query(styling_id: int):
+    """Subquery of a styling's ID and the IDs of all its sub-brands, for use in IN / NOT IN filters."""
+    return select(BrandInheritance.descendant_id).where(BrandInheritance.ancestor_id == styling_id)
+
+# The closure table is kept in step with master_brand_id by the functions below. They run
+# inside the caller's transaction; commit together with the master_brand_id change.
+
+def add_to_inheritance_closure(styling_id: int, master_brand_id, db: Session):
+    """Register a newly created styling (a leaf) under its master, if any."""
+    db.add(BrandInheritance(ancestor_id=styling_id, descendant_id=styling_id, depth=0))
+    if master_brand_id is not None:
+        db.execute(insert(BrandInheritance).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(BrandInheritance.ancestor_id, literal(styling_id), BrandInheritance.depth + 1)
+            .where(BrandInheritance.descendant_id == master_brand_id)
+        ))
+
+def move_in_inheritance_closure(styling_id: int, new_master_id, db: Session):
+    """Re-parent a styling and its whole subtree under new_master_id (None detaches it)."""
+    subtree = subtree_ids_query(styling_id)
+    db.execute(delete(BrandInheritance).where(
+        BrandInheritance.descendant_id.in_(subtree),
+        BrandInheritance.ancestor_id.not_in(subtree),
+    ).execution_options(synchronize_session=False))
+    if new_master_id is not None:
+        above = aliased(BrandInheritance)
+        below = aliased(BrandInheritance)
+        db.execute(insert(BrandInheritance).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            # Every ancestor of the new master paired with every member of the moved subtree
+            select(above.ancestor_id, below.descendant_id, above.depth + below.depth + 1)
+            .join_from(above, below, true())
+            .where(above.descendant_id == new_master_id, below.ancestor_id == styling_id)
+        ))
+
+def remove_from_inheritance_closure(styling_id: int, db: Session):
+    """Forget a deleted styling; its sub-brands keep their own subtrees but lose the chain above it."""
+    move_in_inheritance_closure(styling_id, None, db)
+    db.execute(delete(BrandInheritance).where(
+        (BrandInheritance.ancestor_id == styling_id) | (BrandInheritance.descendant_id == styling_id)
+    ).execution_options(synchronize_session=False))
+
+def rebuild_inheritance_closure(db: Session):
+    """Recompute the whole closure table from master_brand_id with one recursive query."""
+    closure = select(
+        BrandStyling.id.label("ancestor_id"), BrandStyling.id.label("descendant_id"), literal(0).label("depth")
+    ).cte("closure", recursive=True)
+    node = aliased(BrandStyling)
+    master = aliased(BrandStyling)
+    closure = closure.union_all(
+        select(master.id, closure.c.descendant_id, closure.c.depth + 1)
+        .select_from(closure.join(node, node.id == closure.c.ancestor_id).join(master, master.id == node.master_brand_id))
+        .where(closure.c.depth < MAX_INHERITANCE_DEPTH)
+    )
+    # A styling reachable along a (corrupt) cycle appears at several depths; keep the nearest
+    db.execute(delete(BrandInheritance))
+    db.execute(insert(BrandInheritance).from_select(
+        ["ancestor_id", "descendant_id", "depth"],
+        select(closure.c.ancestor_id, closure.c.descendant_id, func.min(closure.c.depth))
+        .group_by(closure.c.ancestor_id, closure.c.descendant_id)
+    ))
+    db.commit()
+
+def get_ancestor_chain(styling_id: int, db: Session):
+    """Return [root master, ..., styling] following master_brand_id. Empty if the styling does not exist."""
+    return [styling for styling, _ in reversed(get_ancestors_with_depth(styling_id, db))]
+
+def get_ancestor_ids(styling_id: int, db: Session):
+    """IDs of every master above a styling, nearest first."""
+    return [row.ancestor_id for row in db.query(BrandInheritance.ancestor_id).filter(
+        BrandInheritance.descendant_id == styling_id, BrandInheritance.depth > 0
+    ).order_by(BrandInheritance.depth)]
+
+def get_descendant_ids(styling_id: int, db: Session):
+    """IDs of every sub-brand below a styling, at any depth, nearest first."""
+    return [row.descendant_id for row in db.query(BrandInheritance.descendant_id).filter(
+        BrandInheritance.ancestor_id == styling_id, BrandInheritance.depth > 0
+    ).order_by(BrandInheritance.depth, BrandInheritance.descendant_id)]
+
+def build_css(styling_id: int, db: Session, annotate: bool = False):
+    """
+    Compile the stylesheet for a styling from the database. Returns None if the styling does not exist.
+    annotate=True marks every declaration with the ID of the asset it came from (see render_css).
+    """
+    sources = load_css_sources(styling_id, db)
+    if sources is None:
+        return None
+    css_parts, assets, load_variants, find_breakpoint_asset = sources
+    return render_css(css_parts, assets, load_variants, find_breakpoint_asset, annotate)
+
+def load_css_sources(styling_id: int, db: Session, import_query: str = ""):
+    """
+    What render_css needs for the @import build of a styling: (header lines, local assets,
+    load_variants, find_breakpoint_asset), taken from its token model. None if the styling
+    does not exist. import_query is appended to the master brand's @import URL.
+    """
+    model = compile_tokens(styling_id, db)
+    if model is None:
+        return None
+    db_styling = model.styling
 
     css_parts = [f"/* CSS for Brand Styling: {db_styling.name} (ID: {styling_id}) */"]
     
     if db_styling.master_brand_id:
-        master_styling = db.query(BrandStyling).filter(BrandStyling.id == db_styling.master_brand_id).first()
+        master_styling = model.master
         master_name = master_styling.name if master_styling else "Unknown Master Brand"
         base_url = settings.BASE_URL or "http://localhost:8000"
         css_parts.append(f"/* Inherits from Master Brand: {master_name} (ID: {db_styling.master_brand_id}) */")
-        css_parts.append(f"@import url('{base_url}/brand/{db_styling.master_brand_id}/css');\n")
-    
-    local_assets = db.query(StyleAsset).filter(StyleAsset.brand_styling_id == styling_id).all()
-    
+        css_parts.append(f"@import url('{base_url}/brand/{db_styling.master_brand_id}/css{import_query}');\n")
+
+    tokens_by_id = {token.id: token for token in model.tokens}
+
+    def load_variants(asset_ids):
+        return sorted((v for asset_id in asset_ids for v in tokens_by_id[asset_id].variants), key=lambda v: v.id)
+
+    return css_parts, list(model.tokens), load_variants, model.breakpoints.get
+
+def build_flat_css(styling_id: int, db: Session, annotate: bool = False, scope: Optional[str] = None):
+    """
+    Compile a self-contained stylesheet that merges the whole master-brand chain
+    instead of emitting @import, using the same winner rules as the inheritance view.
+    scope renders it under a selector instead of :root (see render_css).
+    Returns None if the styling does not exist.
+    """
+    sources = load_flat_css_sources(styling_id, db)
+    if sources is None:
+        return None
+    css_parts, assets, load_variants, find_breakpoint_asset = sources
+    return render_css(css_parts, assets, load_variants, find_breakpoint_asset, annotate, scope)
+
+def load_flat_css_sources(styling_id: int, db: Session):
+    """Like load_css_sources, for the flattened build: the winning assets of the whole chain."""
+    model = compile_tokens(styling_id, db)
+    if model is None:
+        return None
+    chain = model.chain
+    db_styling = model.styling
+
+    css_parts = [f"/* CSS for Brand Styling: {db_styling.name} (ID: {styling_id}) */"]
+    if len(chain) > 1:
+        chain_desc = " > ".join(f"{s.name} (ID: {s.id})" for s in chain)
+        css_parts.append(f"/* Flattened inheritance chain: {chain_desc} */\n")
+
+    winners_by_id = {token.id: token for token in model.winners}
+
+    def load_variants(asset_ids):
+        return [v for asset_id in asset_ids for v in winners_by_id[asset_id].variants]
+
+    def find_breakpoint_asset(breakpoint_key):
+        bp_asset = model.variables.get(breakpoint_key)
+        return bp_asset if bp_asset is not None and bp_asset.type == "dimension" else None
+
+    return css_parts, list(model.winners), load_variants, find_breakpoint_asset
+
+def css_group_name(asset: StyleAsset) -> str:
+    """The group an asset is rendered under (same fallbacks as render_css)."""
+    if asset.type == "class_rule":
+        return asset.group_name or "Legacy Selector Rules"
+    if asset.selector:
+        return asset.group_name or "General Selectors"
+    return asset.group_name or "General Variables"
+
+def build_css_fragments(styling_id: int, db: Session, flat: bool, groups=None, types=None, import_query: str = ""):
+    """
+    Render one stylesheet fragment per group (only the requested ones if groups is given,
+    matched case-insensitively), optionally limited to the given asset types. Each fragment
+    is self-contained: its own :root block, selector rules and @media variants. Groups with
+    no matching assets are left out. Returns (header lines, {group: css}) or None if the
+    styling does not exist.
+    """
+    if flat:
+        sources = load_flat_css_sources(styling_id, db)
+    else:
+        sources = load_css_sources(styling_id, db, import_query)
+    if sources is None:
+        return None
+    css_parts, assets, load_variants, find_breakpoint_asset = sources
+
+    wanted = {group.lower(): group for group in groups} if groups is not None else None
+    assets_by_group = {}
+    for asset in assets:
+        if types and asset.type not in types:
+            continue
+        group = css_group_name(asset)
+        if wanted is not None:
+            group = wanted.get(group.lower())
+            if group is None:
+                continue
+        assets_by_group.setdefault(group, []).append(asset)
+    fragments = {
+        group: render_css([], group_assets, load_variants, find_breakpoint_asset)
+        for group, group_assets in assets_by_group.items()
+    }
+    return css_parts, fragments
+
+# Comment placed before a declaration in annotated builds; cssmin maps it back to the asset
+ASSET_MARKER = "/*@asset:%d*/"
+
+def derivative_url(asset: StyleAsset, file_path: str):
+    """
+    Public URL of a derivative of an uploaded image, served alongside the image itself.
+    None if the asset's value no longer points at its uploaded file.
+    """
+    source_name = os.path.basename(asset.file_path or "")
+    if not source_name or not asset.value or not asset.value.endswith("/" + source_name):
+        return None
+    return asset.value[:-len(source_name)] + os.path.basename(file_path)
+
+def responsive_image_sources(asset: StyleAsset):
+    """
+    srcset strings per format ({"png": "url 320w, ...", "webp": ...}) and an image-set()
+    preferring WebP, built from an image asset's derivatives. None if it has none.
+    """
+    if asset.type != "image" or not asset.file_path or not asset.derivatives:
+        return None
+    source_format = DERIVATIVE_SOURCE_FORMATS.get(os.path.splitext(asset.file_path)[1])
+    candidates = {}
+    for derivative in asset.derivatives:
+        url = derivative_url(asset, derivative.file_path)
+        if url is None:
+            return None
+        candidates.setdefault(derivative.format, []).append((derivative.width, url))
+    if source_format != "webp" and "webp" in candidates:
+        # The widest WebP is the full-size re-encode; the original completes its own srcset
+        full_width, full_webp_url = max(candidates["webp"])
+        candidates.setdefault(source_format, []).append((full_width, asset.value))
+        image_set = f'image-set(url("{full_webp_url}") type("image/webp"), url("{asset.value}") type("{FORMAT_MEDIA_TYPES[source_format]}"))'
+    else:
+        image_set = None
+    srcsets = {fmt: ", ".join(f"{url} {width}w" for width, url in sorted(items)) for fmt, items in candidates.items()}
+    return {"image_set": image_set, "srcsets": srcsets}
+
+def render_css(css_parts, assets, load_variants, find_breakpoint_asset, annotate: bool = False, scope: Optional[str] = None):
+    """
+    Render assets into stylesheet text, appended to the header lines in css_parts.
+    load_variants(asset_ids) returns the variants of the given CSS variable assets and
+    find_breakpoint_asset(name) the dimension asset defining a breakpoint (or None).
+    With annotate=True each declaration is preceded by an ASSET_MARKER comment naming
+    its asset, which the minifier turns into source map entries.
+    With a scope selector, variables are declared on it instead of :root and every
+    selector rule is nested under it, so several brands can share one page.
+    """
+    mark = (lambda asset_id: ASSET_MARKER % asset_id) if annotate else (lambda asset_id: "")
+    root_selector = scope or ":root"
+
+    def scoped(selector_str):
+        if not scope:
+            return selector_str
+        # Split on top-level commas only, so ":is(a, b)" stays one selector
+        parts, depth, start = [], 0, 0
+        for i, ch in enumerate(selector_str):
+            depth += ch in "(["
+            depth -= ch in ")]"
+            if ch == "," and depth == 0:
+                parts.append(selector_str[start:i])
+                start = i + 1
+        parts.append(selector_str[start:])
+        return ", ".join(f"{scope} {part.strip()}" for part in parts)
+
     root_variables_by_group = {}
     selector_declarations_by_ui_group_then_selector = {} # New structure for declarations
 
@@ -114,7 +400,7 @@ def generate_css(styling_id: int, db: Session):
     css_declaration_assets = [] 
     legacy_class_rule_assets = []
 
-    for asset in local_assets:
+    for asset in assets:
         if asset.selector and asset.type == "css_declaration": # New type for individual rules
             css_declaration_assets.append(asset)
         elif asset.type == "class_rule": # Old type, for temporary handling if needed
@@ -129,7 +415,14 @@ def generate_css(styling_id: int, db: Session):
             root_variables_by_group[group_name] = []
         important_suffix = " !important" if asset.is_important else ""
         # Include asset.type in a comment for clarity if desired
-        root_variables_by_group[group_name].append(f"  {asset.name}: {asset.value}{important_suffix}; /* TYPE: {asset.type} */")
+        root_variables_by_group[group_name].append(f"  {mark(asset.id)}{asset.name}: {asset.value}{important_suffix}; /* TYPE: {asset.type} */")
+        # Uploaded images with generated derivatives also get image-set()/srcset-ready companions
+        sources = responsive_image_sources(asset)
+        if sources:
+            if sources["image_set"]:
+                root_variables_by_group[group_name].append(f"  {mark(asset.id)}{asset.name}-set: {sources['image_set']}{important_suffix}; /* TYPE: image-set */")
+            for fmt, srcset in sorted(sources["srcsets"].items()):
+                root_variables_by_group[group_name].append(f'  {mark(asset.id)}{asset.name}-srcset-{fmt}: "{srcset}"{important_suffix}; /* TYPE: srcset */')
 
     if root_variables_by_group:
         root_content_parts = []
@@ -139,7 +432,7 @@ def generate_css(styling_id: int, db: Session):
                 root_content_parts.extend(vars_in_group)
                 root_content_parts.append("") 
         if root_content_parts:
-            css_parts.append(":root {\n" + "\n".join(root_content_parts).strip() + "\n}")
+            css_parts.append(f"{root_selector} {{\n" + "\n".join(root_content_parts).strip() + "\n}")
 
     # Process new individual CSS declarations
     for asset_decl in css_declaration_assets:
@@ -154,7 +447,7 @@ def generate_css(styling_id: int, db: Session):
         prop_name = asset_decl.name # CSS Property
         prop_value = asset_decl.value # CSS Value
         important_suffix = " !important" if asset_decl.is_important else ""
-        selector_declarations_by_ui_group_then_selector[ui_group_name][selector_str].append(f"  {prop_name}: {prop_value}{important_suffix};")
+        selector_declarations_by_ui_group_then_selector[ui_group_name][selector_str].append(f"  {mark(asset_decl.id)}{prop_name}: {prop_value}{important_suffix};")
 
     # Process legacy class_rule assets (should be migrated)
     for asset_legacy_rule in legacy_class_rule_assets:
@@ -179,14 +472,14 @@ def generate_css(styling_id: int, db: Session):
             css_parts.append(f"\n/* UI GROUP: {ui_group_name} */")
             for selector_str, declarations in sorted(selectors_in_group.items()):
                 if declarations: # Only print if there are actual rules
-                    css_parts.append(f"{selector_str} {{")
+                    css_parts.append(f"{scoped(selector_str)} {{")
                     css_parts.extend(declarations)
                     css_parts.append("}")
             
     # Variants for CSS variables (assets where asset.selector is NULL)
     css_variable_asset_ids = [asset.id for asset in css_variables_assets]
     if css_variable_asset_ids:
-        variants = db.query(StyleAssetVariant).filter(StyleAssetVariant.asset_id.in_(css_variable_asset_ids)).all()
+        variants = load_variants(css_variable_asset_ids)
         assets_by_id = {asset.id: asset for asset in css_variables_assets}
         variants_by_breakpoint = {}
 
@@ -196,18 +489,13 @@ def generate_css(styling_id: int, db: Session):
                 if variant.breakpoint not in variants_by_breakpoint:
                     variants_by_breakpoint[variant.breakpoint] = []
                 variants_by_breakpoint[variant.breakpoint].append({
-                    "name": parent_asset.name, "value": variant.value, "is_important": variant.is_important
+                    "name": parent_asset.name, "value": variant.value, "is_important": variant.is_important, "asset_id": parent_asset.id
                 })
         
         for breakpoint_key, vars_in_bp in sorted(variants_by_breakpoint.items()):
             if not vars_in_bp: continue
             
-            bp_asset = db.query(StyleAsset).filter(
-                StyleAsset.brand_styling_id == styling_id, 
-                StyleAsset.name == breakpoint_key,    
-                StyleAsset.type == "dimension",
-                StyleAsset.selector == None          
-            ).first()
+            bp_asset = find_breakpoint_asset(breakpoint_key)
 
             media_query_condition = breakpoint_key 
             if bp_asset:
@@ -230,25 +518,62 @@ def generate_css(styling_id: int, db: Session):
                 else: 
                     media_query_condition = f"({bp_asset.value})" 
             # else:
-                # print(f"Warning: Breakpoint dimension asset '{breakpoint_key}' not found for styling {styling_id}. Using key as media condition.")
+                # print(f"Warning: Breakpoint dimension asset '{breakpoint_key}' not found. Using key as media condition.")
 
-            css_parts.append(f"\n@media {media_query_condition} {{\n  :root {{")
+            css_parts.append(f"\n@media {media_query_condition} {{\n  {root_selector} {{")
             for var_item in vars_in_bp:
                 important = " !important" if var_item["is_important"] else ""
-                css_parts.append(f"    {var_item['name']}: {var_item['value']}{important};")
+                css_parts.append(f"    {mark(var_item['asset_id'])}{var_item['name']}: {var_item['value']}{important};")
             css_parts.append("  }\n}")
 
-    final_css = "\n".join(css_parts).strip()
-    
-    css_dir = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id))
-    os.makedirs(css_dir, exist_ok=True)
-    css_path = os.path.join(css_dir, "style.css")
-    
+    return "\n".join(css_parts).strip()
+
+def write_file_atomic(path: str, content, fsync: Optional[str] = None) -> None:
+    """
+    Replace the file at path with content (str is written as UTF-8). The data goes to a
+    temporary file in the same directory that is then os.replace()d over path, so a
+    concurrent reader (FileResponse, sendfile, a static server, another worker) gets either
+    the old or the new file in full. fsync defaults to settings.FILE_FSYNC.
+    """
+    fsync = fsync or settings.FILE_FSYNC
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(f"Unknown fsync policy '{fsync}', expected one of {', '.join(FSYNC_POLICIES)}")
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            if fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644) # mkstemp creates it private; the file is meant to be served
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if fsync == "full":
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def write_css(styling_id: int, final_css: str):
+    css_path = os.path.join(CONTAINER_ASSET_DIR_ABS, "brands", str(styling_id), "style.css")
     try:
-        with open(css_path, "w") as f:
-            f.write(final_css)
+        write_file_atomic(css_path, final_css)
     except Exception as e:
         # print(f"Error writing CSS file for styling {styling_id}: {e}")
         return False
         
-    return True
\ No newline at end of file
+    return True
+
+def generate_css(styling_id: int, db: Session):
+    final_css = build_css(styling_id, db)
+    if final_css is None:
+        return False
+    return write_css(styling_id, final_css)